@@ -0,0 +1,72 @@
+"""
+  Compare whole-struct encoding and decoding (`toDict`/`fromDict`) against field by field access, using the real
+  layouts from `sustaingineering_defs`. This runs on a normal computer, no board required. From the repo root:
+
+    python3 benchmarks/bench_bulk_codec.py
+"""
+import benchutil
+benchutil.setupPaths()
+
+from sustaingineering_defs import SustaingineeringPropertyRegistry
+from extendedstruct_compiler import compileStruct, uncompileStruct
+
+def benchLayout(name, s, values, duration = 0.5):
+  s.fromDict(values)
+  names = list(s)
+
+  # Clear the value cache first, so these measure the actual decoding
+  def decodeFields():
+    s.value_cache.clear()
+    return { k: s[k] for k in names }
+  def decodeBulk():
+    s.value_cache.clear()
+    return s.toDict()
+  def encodeFields():
+    for k in names: s[k] = values[k]
+  def encodeBulk(): s.fromDict(values)
+
+  assert(decodeFields() == decodeBulk())
+  results = {
+    "bulk/" + name + "/decode_per_field": benchutil.opsPerSecond(decodeFields, duration),
+    "bulk/" + name + "/decode_bulk": benchutil.opsPerSecond(decodeBulk, duration),
+    "bulk/" + name + "/encode_per_field": benchutil.opsPerSecond(encodeFields, duration),
+    "bulk/" + name + "/encode_bulk": benchutil.opsPerSecond(encodeBulk, duration),
+  }
+
+  # The same bulk calls again, through the generated code
+  expected = decodeBulk()
+  assert(compileStruct(s))
+  assert(decodeBulk() == expected)
+  results["bulk/" + name + "/decode_compiled"] = benchutil.opsPerSecond(decodeBulk, duration)
+  results["bulk/" + name + "/encode_compiled"] = benchutil.opsPerSecond(encodeBulk, duration)
+  uncompileStruct(s)
+  return results
+
+def run(duration = 0.5):
+  registry = SustaingineeringPropertyRegistry()
+  results = {}
+  results.update(benchLayout("weatherstation_ambient", registry.getPropEntry("weatherstation_ambient").prop, {
+    "temperature": 21.5,
+    "humidity": 45.0,
+    "pressure": 1013.25,
+  }, duration))
+  results.update(benchLayout("StatusProperty", registry.getPropEntry("weatherstation_status").prop, {
+    "release_build": False,
+    "is_first_message": True,
+    "reset_reason": "WATCHDOG",
+    "proto_version": 3,
+  }, duration))
+  return results
+
+if __name__ == "__main__":
+  results = run()
+  for layout in ("weatherstation_ambient", "StatusProperty"):
+    print(layout)
+    for op in ("decode_per_field", "decode_bulk", "decode_compiled", "encode_per_field", "encode_bulk", "encode_compiled"):
+      print("  {:<18} {:>12,.0f} ops/s".format(op, results["bulk/" + layout + "/" + op]))
+    print("  decode speedup {:.2f}x ({:.2f}x compiled), encode speedup {:.2f}x ({:.2f}x compiled)".format(
+      results["bulk/" + layout + "/decode_bulk"] / results["bulk/" + layout + "/decode_per_field"],
+      results["bulk/" + layout + "/decode_compiled"] / results["bulk/" + layout + "/decode_per_field"],
+      results["bulk/" + layout + "/encode_bulk"] / results["bulk/" + layout + "/encode_per_field"],
+      results["bulk/" + layout + "/encode_compiled"] / results["bulk/" + layout + "/encode_per_field"]
+    ))
@@ -0,0 +1,52 @@
+"""
+  Measure field encoding and decoding speed for every field type, over a range of bit widths and every bit alignment.
+  Results are keyed as `extendedstruct/<encode|decode|decode_cached>/<field type>/w<bit width>/a<bit alignment>`.
+  From the repo root:
+
+    python3 benchmarks/bench_extendedstruct.py
+"""
+import benchutil
+benchutil.setupPaths()
+
+from extendedstruct import ExtendedStruct, ReservedField, BoolField, IntField, EnumField
+
+INT_WIDTHS = (4, 8, 12, 16, 24, 32)
+ENUM_WIDTHS = (2, 3, 4, 8)
+ALIGNMENTS = range(8)
+
+# Yields (field type, bit width, field factory, value to encode) for every case
+def fieldCases():
+  yield ("BoolField", 1, lambda name: BoolField(name), True)
+  for width in INT_WIDTHS:
+    yield ("IntField", width, lambda name, w=width: IntField(name, w), (1 << width) - 2)
+    yield ("IntField_signed", width, lambda name, w=width: IntField(name, w, signed = True), -(1 << (width - 2)))
+    yield ("IntField_scaled", width, lambda name, w=width: IntField(name, w, base = -10.0, scale = 0.1),
+      -10.0 + 0.1*((1 << width) // 3))
+  for width in ENUM_WIDTHS:
+    values = [("E{:d}".format(k), k) for k in range(min(1 << width, 8))]
+    yield ("EnumField", width, lambda name, w=width, v=values: EnumField(name, w, *v), values[-1][0])
+
+def run(duration = 0.5):
+  results = {}
+  for (kind, width, factory, value) in fieldCases():
+    for alignment in ALIGNMENTS:
+      name = "field"
+      field = factory(name)
+      s = ExtendedStruct(ReservedField(alignment), field) if alignment else ExtendedStruct(field)
+      
+      def encode(): s[name] = value
+      def decode():
+        s.value_cache.clear() # Measure the actual decoding, not the cache
+        return s[name]
+      def decodeCached(): return s[name]
+      encode()
+      assert(decode() == value or abs(decode() - value) < 0.1)
+      
+      key = "{}/w{:d}/a{:d}".format(kind, width, alignment)
+      results["extendedstruct/encode/" + key] = benchutil.opsPerSecond(encode, duration)
+      results["extendedstruct/decode/" + key] = benchutil.opsPerSecond(decode, duration)
+      results["extendedstruct/decode_cached/" + key] = benchutil.opsPerSecond(decodeCached, duration)
+  return results
+
+if __name__ == "__main__":
+  for (name, ops) in run(0.1).items(): print("{:<50} {:>12,.0f} ops/s".format(name, ops))
@@ -0,0 +1,65 @@
+"""
+  Measure how struct operations scale with the payload size: 8 bytes (classic CAN), and 32 and 64 bytes (CAN FD).
+  Each layout is packed with 12 bit fields, plus one wide field filling the rest of the payload. Results are keyed as
+  `payload/b<payload bytes>/<operation>`. From the repo root:
+
+    python3 benchmarks/bench_payload.py
+"""
+import benchutil
+benchutil.setupPaths()
+
+from extendedstruct import ExtendedStruct, IntField
+
+PAYLOAD_SIZES = (8, 32, 64)
+NARROW_BITS = 12
+
+# A struct of `size` bytes: As many 12 bit fields as fit in half the payload, then one wide field for the rest
+def makeLayout(size):
+  count = (size*4) // NARROW_BITS
+  fields = [IntField("f{:d}".format(k), NARROW_BITS, scale = 0.1) for k in range(count)]
+  fields.append(IntField("wide", size*8 - count*NARROW_BITS))
+  return ExtendedStruct(*fields)
+
+def run(duration = 0.5):
+  results = {}
+  for size in PAYLOAD_SIZES:
+    s = makeLayout(size)
+    assert(s.getByteLength() == size)
+    values = { name: (k % 100) * 1.5 for (k, name) in enumerate(s) if not name == "wide" }
+    values["wide"] = (1 << (s.field_codecs["wide"][0].getBitWidth() - 1)) + 12345
+    s.fromDict(values)
+    frame = s.getBytes()
+    other = bytes(b ^ 0xFF for b in frame)
+    end = s.getBitLength()
+    middle = "f{:d}".format(len(values) // 2)
+    
+    def toDict():
+      s.value_cache.clear() # Measure the decoding, not the cache
+      return s.toDict()
+    def fromDict(): s.fromDict(values)
+    def getNarrow():
+      s.value_cache.clear()
+      return s[middle]
+    def setNarrow(): s[middle] = 12.0
+    def getWide():
+      s.value_cache.clear()
+      return s["wide"]
+    def setWide(): s["wide"] = 12345
+    def getSlice(): return s[3:end - 5]
+    def setSlice(): s[3:end - 5] = 0x5A5A5A5A5A
+    def setBytes():
+      # Alternate frames so every field changes each time
+      s.setBytes(other)
+      s.setBytes(frame)
+    
+    prefix = "payload/b{:d}/".format(size)
+    for (name, f) in (
+      ("to_dict", toDict), ("from_dict", fromDict), ("get_narrow", getNarrow), ("set_narrow", setNarrow),
+      ("get_wide", getWide), ("set_wide", setWide), ("get_slice", getSlice), ("set_slice", setSlice),
+      ("set_bytes_x2", setBytes),
+    ):
+      results[prefix + name] = benchutil.opsPerSecond(f, duration)
+  return results
+
+if __name__ == "__main__":
+  for (name, ops) in run(0.2).items(): print("{:<40} {:>12,.0f} ops/s".format(name, ops))
@@ -0,0 +1,92 @@
+"""
+  Measure PropertyRegistry throughput with N registered properties: Direct `receive` calls (with and without expiring
+  each property again), and whole `eventLoop` calls that drain a receiver or flush queued transmits. Per-frame costs
+  should stay flat as N grows. All numbers are in frames (or names, for iteration) per second. From the repo root:
+
+    python3 benchmarks/bench_registry.py
+"""
+import benchutil
+benchutil.setupPaths()
+
+from property_advertiser import PropertyRegistry, Transmitter, Receiver
+from property_advertiser.extendedstruct import ExtendedStructProperty, IntField
+
+PROPERTY_COUNTS = (10, 100, 1000, 2000)
+FRAMES_PER_LOOP = 100
+
+# Hands out a fixed list of frames, FRAMES_PER_LOOP at a time, then reports an empty bus until the next batch
+class ReplayReceiver(Receiver):
+  def __init__(self, frames):
+    self.frames = frames
+    self.i = 0
+    self.remaining = FRAMES_PER_LOOP
+  def receive(self):
+    if not self.remaining:
+      self.remaining = FRAMES_PER_LOOP
+      return None
+    self.remaining -= 1
+    frame = self.frames[self.i]
+    self.i = (self.i + 1) % len(self.frames)
+    return frame
+class NullTransmitter(Transmitter):
+  def send(self, can_id, msg): return True
+
+# Same layout as weatherstation_ambient
+def ambientProperty(): return ExtendedStructProperty(
+  IntField("temperature", 16, base = -200, scale = 0.01, signed = False),
+  IntField("humidity", 8, base = 0, scale = 100.0/255.0, signed = False),
+  IntField("pressure", 16, base = 800.0, scale = 0.01, signed = False),
+)
+
+def makeRegistry(count, **kwargs):
+  pr = PropertyRegistry(data_timeout = 60*60*1000, **kwargs)
+  for can_id in range(count): pr.addProperty(can_id, "prop" + str(can_id), ambientProperty())
+  return pr
+
+def makeFrames(count):
+  frames = []
+  for can_id in range(count):
+    prop = ambientProperty()
+    prop.fromDict({ "temperature": 20 + can_id % 10, "humidity": 50.0, "pressure": 1000.0 })
+    frames.append((can_id, prop.getBytes()))
+  return frames
+
+def run(duration = 0.5):
+  results = {}
+  for count in PROPERTY_COUNTS:
+    frames = makeFrames(count)
+    
+    pr = makeRegistry(count)
+    state = { "i": 0 }
+    def receive():
+      (can_id, msg) = frames[state["i"]]
+      state["i"] = (state["i"] + 1) % count
+      pr.receive(can_id, msg)
+    results["registry/receive/n{:d}".format(count)] = benchutil.opsPerSecond(receive, duration)
+    
+    pr = makeRegistry(count, receiver = ReplayReceiver(frames))
+    results["registry/eventloop_receive/n{:d}".format(count)] = \
+      benchutil.opsPerSecond(pr.eventLoop, duration) * FRAMES_PER_LOOP
+    
+    results["registry/iterate_names/n{:d}".format(count)] = benchutil.opsPerSecond(lambda: list(pr), duration) * count
+    
+    # Every property is remote and expires right away, so each frame also costs an expiry
+    pr = makeRegistry(count)
+    pr.data_timeout = 0
+    def receiveExpire():
+      receive()
+      pr.eventLoop()
+    results["registry/receive_expire/n{:d}".format(count)] = benchutil.opsPerSecond(receiveExpire, duration)
+    
+    pr = makeRegistry(count, transmitter = NullTransmitter())
+    names = list(pr)[:FRAMES_PER_LOOP]
+    for name in names: pr[name] = { "temperature": 21.0 }
+    def transmit():
+      for name in names: pr[name] = { "humidity": 40.0 }
+      pr.eventLoop()
+    results["registry/eventloop_transmit/n{:d}".format(count)] = \
+      benchutil.opsPerSecond(transmit, duration) * len(names)
+  return results
+
+if __name__ == "__main__":
+  for (name, ops) in run(0.2).items(): print("{:<50} {:>12,.0f} frames/s".format(name, ops))
@@ -0,0 +1,60 @@
+"""
+  Replay a CAN trace (see property_advertiser.trace) through SustaingineeringPropertyRegistry's event loop as fast as
+  possible, so decoder and expiry changes can be measured against real bus traffic. Without a trace, a synthetic one
+  (every weatherstation property, in turn) is used. Numbers are in frames per second. From the repo root:
+
+    python3 benchmarks/bench_replay.py
+    python3 benchmarks/bench_replay.py field.trace # Record one on the Pi with CAN_TRACE=field.trace
+"""
+import os
+import sys
+import tempfile
+import time
+
+import benchutil
+benchutil.setupPaths()
+
+from sustaingineering_defs import SustaingineeringPropertyRegistry
+from property_advertiser.trace import TraceRecorder, TraceReceiver, readTrace
+
+SYNTHETIC_FRAMES = 10000
+
+# Write a trace of every property in a registry sending in turn, one frame a millisecond, with varying values
+def makeTrace(path):
+  pr = SustaingineeringPropertyRegistry()
+  props = [pr.getPropEntry(name) for name in pr]
+  with TraceRecorder(path) as recorder:
+    for i in range(SYNTHETIC_FRAMES):
+      prop_entry = props[i % len(props)]
+      msg = bytearray(prop_entry.prop.getPayloadLength() or 8)
+      for j in range(len(msg)): msg[j] = (i + j) % 256
+      recorder.record(prop_entry.can_id, bytes(msg), i*1000)
+
+# Frames per second replaying the whole trace through `pr`, over and over for about `duration` seconds
+def replayFramesPerSecond(pr, frames, duration):
+  count = 0
+  start = time.perf_counter()
+  while True:
+    pr.receiver = TraceReceiver(frames, speed = None)
+    while pr.eventLoop(): pass
+    count += len(frames)
+    elapsed = time.perf_counter() - start
+    if elapsed >= duration: return count / elapsed
+
+def run(duration = 0.5, path = None):
+  if path is None:
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, "synthetic.trace")
+      makeTrace(path)
+      (started, frames) = readTrace(path)
+  else: (started, frames) = readTrace(path)
+  results = {}
+  for compile_codecs in (False, True):
+    pr = SustaingineeringPropertyRegistry(compile_codecs = compile_codecs)
+    name = "replay/eventloop/{}".format("compiled" if compile_codecs else "generic")
+    results[name] = replayFramesPerSecond(pr, frames, duration)
+  return results
+
+if __name__ == "__main__":
+  path = sys.argv[1] if len(sys.argv) > 1 else None
+  for (name, ops) in run(1.0, path).items(): print("{:<50} {:>12,.0f} frames/s".format(name, ops))
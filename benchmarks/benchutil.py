@@ -0,0 +1,57 @@
+"""
+  Shared helpers for the benchmark scripts: library paths, timing, and saving/comparing JSON results.
+"""
+import json
+import os
+import platform
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Make the repository's libraries importable the same way they are on a device (everything flat in `lib`)
+def setupPaths():
+  for path in (
+    "common", "libraries/extendedstruct.py", "libraries/extendedstruct_compiler.py", "libraries/instant.py",
+    "libraries/property_advertiser"
+  ):
+    path = os.path.join(ROOT, path)
+    if not path in sys.path: sys.path.insert(0, path)
+
+# Run `f` repeatedly for about `duration` seconds and return how many calls per second it managed
+def opsPerSecond(f, duration = 0.5):
+  count = 0
+  batch = 100
+  start = time.perf_counter()
+  while True:
+    for _ in range(batch): f()
+    count += batch
+    elapsed = time.perf_counter() - start
+    if elapsed >= duration: return count / elapsed
+
+# Describe the machine the results came from, so results from different computers aren't compared by accident
+def environment():
+  return {
+    "python": sys.version.split()[0],
+    "implementation": platform.python_implementation(),
+    "machine": platform.machine(),
+    "platform": platform.platform(),
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+  }
+
+def saveResults(path, results):
+  with open(path, "w") as f:
+    json.dump({ "environment": environment(), "results": results }, f, indent=2, sort_keys=True)
+
+def loadResults(path):
+  with open(path) as f: return json.load(f)["results"]
+
+"""
+  Compare results against a baseline. Returns a list of (name, baseline ops/s, current ops/s, ratio) for every benchmark
+  present in both, where a ratio above 1 means the current results are faster.
+"""
+def compareResults(baseline, results):
+  return [
+    (name, baseline[name], results[name], results[name] / baseline[name])
+    for name in sorted(results.keys()) if name in baseline and baseline[name] > 0
+  ]
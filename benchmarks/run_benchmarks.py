@@ -0,0 +1,60 @@
+"""
+  Run every benchmark and optionally save the results as JSON, or compare them against a saved baseline. Use this to
+  check that a codec or registry change is actually faster before flashing new firmware. From the repo root:
+
+    python3 benchmarks/run_benchmarks.py --out baseline.json
+    # ... make some changes ...
+    python3 benchmarks/run_benchmarks.py --out new.json --baseline baseline.json
+
+  Results map a benchmark name to operations (or frames) per second, so bigger is always better.
+"""
+import argparse
+import sys
+
+import benchutil
+import bench_extendedstruct
+import bench_bulk_codec
+import bench_payload
+import bench_registry
+import bench_replay
+
+SUITES = {
+  "extendedstruct": bench_extendedstruct,
+  "bulk": bench_bulk_codec,
+  "payload": bench_payload,
+  "registry": bench_registry,
+  "replay": bench_replay,
+}
+
+def main():
+  parser = argparse.ArgumentParser(description = "Run the codec, registry and replay benchmarks")
+  parser.add_argument("--out", help = "Write the results to this JSON file")
+  parser.add_argument("--baseline", help = "Compare the results against this JSON file")
+  parser.add_argument("--duration", type = float, default = 0.05, help = "Seconds to spend on each benchmark")
+  parser.add_argument("--suite", action = "append", choices = sorted(SUITES.keys()), help = "Only run these suites")
+  parser.add_argument(
+    "--fail-below", type = float, default = None,
+    help = "Exit with an error if any benchmark runs slower than this fraction of the baseline (such as 0.9)"
+  )
+  args = parser.parse_args()
+
+  results = {}
+  for name in (args.suite or SUITES.keys()):
+    print("Running", name, "benchmarks...", file = sys.stderr)
+    results.update(SUITES[name].run(args.duration))
+
+  if args.out: benchutil.saveResults(args.out, results)
+
+  if not args.baseline:
+    for name in sorted(results.keys()): print("{:<56} {:>14,.0f}".format(name, results[name]))
+    return 0
+
+  slower = []
+  for (name, before, after, ratio) in benchutil.compareResults(benchutil.loadResults(args.baseline), results):
+    print("{:<56} {:>14,.0f} {:>14,.0f} {:>7.2f}x".format(name, before, after, ratio))
+    if not args.fail_below is None and ratio < args.fail_below: slower.append(name)
+  for name in slower: print("SLOWER THAN BASELINE:", name, file = sys.stderr)
+  return 1 if slower else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
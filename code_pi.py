@@ -9,6 +9,20 @@ from datetime import datetime, timezone
 
 # Thingspeak can only accept updates every 15s at max
 thingspeak_update_ival = 15
+# Remote data is saved here every few seconds (when it has changed), and loaded back on startup, so a restart doesn't
+# lose it
+snapshot_path = os.environ.get('REGISTRY_SNAPSHOT', 'registry.snapshot')
+snapshot_ival = 5
+# Ambient readings kept for averaging between uploads. Plenty for one upload interval
+ambient_history_size = 64
+# Every frame received is also kept on disk here, for looking back further than the last upload. Unflushed frames are
+# written at least this often, even when the bus is quiet
+history_dir = os.environ.get('HISTORY_DIR', 'history')
+history_flush_ival = 30
+# Set to record every raw frame received to a trace file, for replaying later (see property_advertiser.trace). Buffered
+# frames are written at least this often
+trace_path = os.environ.get('CAN_TRACE', None)
+trace_flush_ival = 10
 
 def passfunc(): pass
 
@@ -30,33 +44,112 @@ bus = serial_can2.SerialBus(channel='/dev/ttyACM0')
   there's an update, or every SUSTAINGINEERING_TRANSMIT_IVAL milliseconds.
 """
 def runPycanReceiveLoop(loop, setup = passfunc):
-  from property_advertiser.pycan import PycanReceiver
-  iface = PycanReceiver(can=bus, timeout = 1.0) # Time out after 1s of waiting; Keep the scheduler ticking
-  pr = SustaingineeringPropertyRegistry(transmitter = iface, receiver = iface)
+  from property_advertiser.pycan import PycanTransmitter, PycanReceiver
+  from property_advertiser.threaded import ThreadedReceiver
+  receiver = PycanReceiver(can=bus, timeout = 0.1)
+  recorder = None
+  if trace_path:
+    from property_advertiser.trace import TraceRecorder
+    # Recorded on the receive thread, so frames are timestamped as they arrive rather than when they're processed
+    receiver = recorder = TraceRecorder(trace_path, receiver)
+  # A separate thread keeps draining the serial port while uploads block this one. Time out after 1s of waiting for a
+  # frame; Keep the scheduler ticking
+  receiver = ThreadedReceiver(receiver, timeout = 1.0)
+  pr = SustaingineeringPropertyRegistry(
+    transmitter = PycanTransmitter(bus), receiver = receiver, compile_codecs = True
+  )
+  if not recorder is None: schedule.every(trace_flush_ival).seconds.do(flushTrace, registry=pr, recorder=recorder)
   setup(pr)
-  while True:
-    loop(pr)
-    pr.eventLoop()
+  # Stops the receive thread and closes the trace, if there is one, so the end of it makes it to disk
+  with receiver:
+    while True:
+      loop(pr)
+      pr.eventLoop()
+
+# Registry version as of the last upload. Only upload when a property has changed since then
+last_update_version = 0
 
 def doUpdate(registry):
+  global last_update_version
+  if not registry.changedSince(last_update_version): return
+  last_update_version = registry.version
+  
   update_base = { "created_at" : str(datetime.now(timezone.utc)), "status": "UNKNOWN" }
-  if not registry["weatherstation_status"] is None:
+  status = registry["weatherstation_status"]
+  if not status is None:
+    status = status.toDict() # Decode every field at once
     update_base["status"] = "ONLINE({}) v{:d}{}".format(
-      str(registry["weatherstation_status"]["reset_reason"]) + (", FIRST" if registry["weatherstation_status"]["is_first_message"] else ""),
-      int(registry["weatherstation_status"]["proto_version"]),
-      "" if registry["weatherstation_status"]["release_build"] else "DEV"
+      str(status["reset_reason"]) + (", FIRST" if status["is_first_message"] else ""),
+      int(status["proto_version"]),
+      "" if status["release_build"] else "DEV"
     )
-    
-  if not registry["weatherstation_ambient"] is None:
-    update_base["field1"] = registry["weatherstation_ambient"]["temperature"]
-    update_base["field2"] = registry["weatherstation_ambient"]["humidity"]
-    update_base["field3"] = registry["weatherstation_ambient"]["pressure"]
+  
+  ambient = registry["weatherstation_ambient"]
+  if not ambient is None:
+    ambient = ambient.toDict()
+    history = registry.getHistory("weatherstation_ambient")
+    # Average over the whole upload interval, rather than taking whichever sample happened to be last
+    for (field, name) in (("field1", "temperature"), ("field2", "humidity"), ("field3", "pressure")):
+      summary = history.aggregate(name, thingspeak_update_ival*1000)
+      update_base[field] = ambient[name] if summary is None else summary["mean"]
 
   print(update_base)
   #ch.bulk_update(data = { "updates": [update_base] })
 
+# Registry version as of the last snapshot. Only write one when a property has changed since then, to spare the SD card
+last_snapshot_version = None
+
+def doSnapshot(registry):
+  global last_snapshot_version
+  if registry.version == last_snapshot_version: return
+  from property_advertiser.snapshot import saveSnapshot
+  # A full or read-only SD card shouldn't stop the gateway. Try again next time
+  try: saveSnapshot(registry, snapshot_path)
+  except OSError as e:
+    registry.warn("snapshot_save", "Couldn't save the snapshot to {}:", snapshot_path, exception = e)
+    return
+  last_snapshot_version = registry.version
+
+# Write frames the history store has buffered. Like snapshots, a failed write is reported and retried next time
+def flushHistory(registry, store):
+  try: store.flush()
+  except OSError as e:
+    registry.warn("history_flush", "Couldn't write to the history store in {}:", history_dir, exception = e)
+
+# Write frames the trace recorder has buffered, so a crash or power cut only loses the last few seconds
+def flushTrace(registry, recorder):
+  try: recorder.flush()
+  except OSError as e: registry.warn("trace_flush", "Couldn't write to the trace at {}:", trace_path, exception = e)
+
+def logStatusChange(name, status):
+  if not status.isValid(): print("Property", name, "is now", str(status))
+
+# Summarize how the bus is doing: Frame rates, decode failures, and frames the receive thread had to drop
+def logStats(registry):
+  stats = registry.getStats()
+  rates = ", ".join(
+    "{} {:.1f}/s".format(name, prop["rate"]) for (name, prop) in stats["properties"].items() if prop["rate"]
+  )
+  print("Stats:", rates or "no frames", "| corrupt:", sum(p["corrupt"] for p in stats["properties"].values()),
+    "| unknown IDs:", stats["unknown_ids"], "| receiver:", stats["receiver"])
+
 def setup(registry):
+  registry.enableHistory("weatherstation_ambient", ambient_history_size)
+  
+  from property_advertiser.snapshot import loadSnapshot
+  print("Restored", loadSnapshot(registry, snapshot_path), "properties from", snapshot_path)
+  schedule.every(snapshot_ival).seconds.do(doSnapshot, registry=registry)
+  
+  # Attached after the snapshot is loaded, so restored data isn't recorded a second time
+  from property_advertiser.store import HistoryStore
+  store = HistoryStore(history_dir, flush_interval_ms = history_flush_ival*1000)
+  store.attach(registry)
+  schedule.every(history_flush_ival).seconds.do(flushHistory, registry=registry, store=store)
+  
+  # Only expired or corrupt data gets logged, but every change counts towards the next upload
+  registry.subscribe(None, logStatusChange)
   schedule.every(thingspeak_update_ival).seconds.do(doUpdate, registry=registry)
+  schedule.every(60).seconds.do(logStats, registry=registry)
 
 def loop(registry): schedule.run_pending()
 
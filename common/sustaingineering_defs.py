@@ -1,5 +1,5 @@
 import time
-from property_advertiser import PropertyRegistry, StructProperty, DummyTransceiver
+from property_advertiser import PropertyRegistry, StructProperty, DummyTransceiver, TransmitPolicy
 from property_advertiser.extendedstruct import ExtendedStructProperty, BoolField, IntField, ReservedField, EnumField
 
 # So, here's the thing: With a CAN bus, we can't just send JSON messages -- Each message has to fit in 6 bytes. That
@@ -42,8 +42,17 @@ except:
 # Addition of properties should not need a change, but removal or change does.
 PROTOCOL_VERSION = 0
 
-SUSTAINGINEERING_TRANSMIT_IVAL = 2000 # How frequently data is transmitted
+SUSTAINGINEERING_TRANSMIT_IVAL = 2000 # How frequently sensors are read, and changed data is transmitted
 SUSTAINGINEERING_DATA_TIMEOUT = 10000 # How frequently data is cleared out if not received
+# How frequently data is transmitted when it hasn't changed. The event loop only checks this every
+# SUSTAINGINEERING_TRANSMIT_IVAL, so there's room for a lost frame before the data times out.
+SUSTAINGINEERING_HEARTBEAT_IVAL = 4000
+# Most frames a device sends per event loop; The rest wait for the next one. The MCP2515 only has 3 transmit buffers,
+# so this keeps a device from flooding it (and the bus) when lots of properties change at once.
+SUSTAINGINEERING_TRANSMIT_BUDGET = 8
+# Most frames a device processes per event loop, so a flood on the bus can't stall its own sensor readings and sends.
+# Whatever's left is picked up on the next event loop.
+SUSTAINGINEERING_RECEIVE_BUDGET = 32
 
 # ID Allocations:
 # ID allocations are arbitrary; This does not *need* to be done any particular way. However, for the sake of
@@ -81,8 +90,19 @@ class StatusProperty(ExtendedStructProperty):
 
 """Define a custom property registry for sustaingineering information"""
 class SustaingineeringPropertyRegistry(PropertyRegistry):
-  def __init__(self, transmitter = None, receiver = None):
-    super().__init__(data_timeout = SUSTAINGINEERING_DATA_TIMEOUT, transmitter = transmitter, receiver = receiver)
+  """
+  Arguments
+    compile_codecs - Compile each struct layout into specialized encode/decode functions (see extendedstruct_compiler).
+      Much faster on the Pi, but uses more memory, so leave it off on the boards
+  """
+  def __init__(self, transmitter = None, receiver = None, compile_codecs = False):
+    super().__init__(
+      data_timeout = SUSTAINGINEERING_DATA_TIMEOUT,
+      transmitter = transmitter,
+      receiver = receiver,
+      transmit_budget_frames = SUSTAINGINEERING_TRANSMIT_BUDGET,
+      receive_budget_frames = SUSTAINGINEERING_RECEIVE_BUDGET
+    )
     
     # Now, set up the properties
     self.addProperty(sid(DEVICE_STATUS, DEVICE_WEATHERSTATION), "weatherstation_status", StatusProperty())
@@ -106,6 +126,32 @@ class SustaingineeringPropertyRegistry(PropertyRegistry):
       IntField("hourly", 12, base = 0, scale = 0.1, signed = False), # 0 to 409.6 mm
       IntField("boot", 4, base = 0, scale = 0.1, signed = False), # 0 to 1.6 mm
     ))
+    
+    # Status messages go out before any sensor data
+    self.setTransmitPriority("weatherstation_status", -1)
+    
+    # Only send sensor values that moved more than this; Smaller changes go out with the heartbeat
+    self.setTransmitPolicy("weatherstation_status", TransmitPolicy(SUSTAINGINEERING_HEARTBEAT_IVAL))
+    self.setTransmitPolicy("weatherstation_ambient", TransmitPolicy(SUSTAINGINEERING_HEARTBEAT_IVAL, deadbands = {
+      "temperature": 0.1, # C
+      "humidity": 1.0, # %
+      "pressure": 0.5, # hPa
+    }))
+    self.setTransmitPolicy("weatherstation_windspeed", TransmitPolicy(
+      SUSTAINGINEERING_HEARTBEAT_IVAL, default_deadband = 1.0 # km/hr
+    ))
+    self.setTransmitPolicy("weatherstation_winddir", TransmitPolicy(
+      SUSTAINGINEERING_HEARTBEAT_IVAL, default_deadband = 10.0 # deg
+    ))
+    self.setTransmitPolicy("weatherstation_rain", TransmitPolicy(
+      SUSTAINGINEERING_HEARTBEAT_IVAL, default_deadband = 0.1 # mm
+    ))
+    
+    if compile_codecs:
+      from extendedstruct_compiler import compileStruct
+      for name in self:
+        prop = self.getPropEntry(name).prop
+        if isinstance(prop, ExtendedStructProperty): compileStruct(prop)
   
   first_msg = True # Set to true if this is the first message sent
   def assignStatusProperty(self, device_id):
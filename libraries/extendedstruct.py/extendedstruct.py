@@ -1,5 +1,13 @@
 import math
 
+# Fields this wide or narrower decode through a lookup table with an entry for every possible raw value, instead of
+# doing the math each time. Tables are built the first time a field is decoded, so transmit-only devices never pay for
+# them. Lower this to save memory.
+DECODE_TABLE_MAX_BITS = 8
+# Named fields spanning more bytes than this are read and written through `int.from_bytes` on a slice of the buffer.
+# Narrower fields are quicker to walk byte by byte, since that doesn't allocate a slice.
+WIDE_FIELD_BYTES = 4
+
 """Base class for all bitfields"""
 class BitField:
   """Name of property"""
@@ -10,6 +18,15 @@ class BitField:
   def deserialize(self, data): return None
   """Serialize a value and return a bytearray"""
   def serialize(self, val): return bytearray()
+  """
+    Encode a value into its raw, unsigned integer form. ExtendedStruct uses this (and `decodeInt`) to read and write
+    fields without building intermediate bytearrays. The default goes through `serialize`, so custom fields only need
+    to override these two methods if they care about speed.
+  """
+  def encodeInt(self, val): return int.from_bytes(bytes(self.serialize(val)), "little")
+  """Decode a raw, unsigned integer form of this field. See `encodeInt`."""
+  def decodeInt(self, raw):
+    return self.deserialize(bytearray(raw.to_bytes(math.ceil(self.getBitWidth() / 8), "little")))
 
 """A reserved bitfield. Has no name, always evaluates to zero."""
 class ReservedField(BitField):
@@ -18,6 +35,8 @@ class ReservedField(BitField):
   def getBitWidth(self): return self.bitwidth
   def deserialize(self, data): return None
   def serialize(self, val): return bytearray(math.ceil(self.getBitWidth() / 8))
+  def encodeInt(self, val): return 0
+  def decodeInt(self, raw): return None
 
 """A bitfield that encodes a Boolean value"""
 class BoolField(BitField):
@@ -29,12 +48,16 @@ class BoolField(BitField):
   def getBitWidth(self): return 1
   def deserialize(self, data): return True if data[0] & 0x1 else False
   def serialize(self, val): return bytearray([0x1 if val else 0x0])
+  def encodeInt(self, val): return 0x1 if val else 0x0
+  def decodeInt(self, raw): return BOOL_VALUES[raw & 0x1]
+BOOL_VALUES = (False, True)
 
 """
   A bitfield that encodes a value as an integer. Depending on how you set the scale, you don't actually have to
   assign an integer to this field: An appropriate scale could allow for decimals to be sent.
 """
 class IntField(BitField):
+  decode_table = None # See DECODE_TABLE_MAX_BITS
   """
   Arguments:
     name - The name of the bitfield
@@ -50,45 +73,29 @@ class IntField(BitField):
     self.scale = scale
     self.signed = signed
   def getBitWidth(self): return self.bitwidth
-  def serialize(self, val):
-    if not (isinstance(val, int) or isinstance(val, float)): raise ValueError("Invalid type of numeric field")
-    
-    unsigned_bitwidth = self.bitwidth - (1 if self.signed else 0)
-    
-    val = int((val - self.base) / self.scale)
-    sign = val < 0
-    val = abs(val)
-    if val >> unsigned_bitwidth: raise OverflowError("Bitfield overflow")
-    if sign:
-      val = ~val
-      val ^= (val >> unsigned_bitwidth) << unsigned_bitwidth
-      val |= 1 << unsigned_bitwidth
-      val += 1
-    
-    buf = bytearray(math.ceil(self.bitwidth / 8))
-    i = 0
-    while val:
-      buf[i] = val & 0xFF
-      val = val >> 8
-      i += 1
-    return buf
+  def serialize(self, val): return bytearray(self.encodeInt(val).to_bytes(math.ceil(self.bitwidth / 8), "little"))
   def deserialize(self, data):
     if len(data) != math.ceil(self.bitwidth/8): raise RuntimeError("Wrong data length passed to deserialize")
-    unsigned_bitwidth = self.bitwidth - (1 if self.signed else 0)
-    
-    val = 0
-    i = len(data)
-    while i > 0:
-      i -= 1
-      val = (val << 8) | data[i]
-    
-    sign = self.signed if (val >> unsigned_bitwidth) & 0x1 else False
-    if sign: val = ~val
-    val ^= (val >> unsigned_bitwidth) << unsigned_bitwidth
-    if sign: val = -val - 1
+    return self.decodeInt(int.from_bytes(bytes(data), "little") & ((1 << self.bitwidth) - 1))
+  def encodeInt(self, val):
+    if not (isinstance(val, int) or isinstance(val, float)): raise ValueError("Invalid type of numeric field")
     
-    val = (self.base + float(val)*self.scale)
+    val = int((val - self.base) / self.scale)
+    if val < 0:
+      # Negative values are stored in two's complement, so only signed fields can hold them
+      if not self.signed or (-val) >> (self.bitwidth - 1): raise OverflowError("Bitfield overflow")
+      return val & ((1 << self.bitwidth) - 1)
+    if val >> (self.bitwidth - (1 if self.signed else 0)): raise OverflowError("Bitfield overflow")
     return val
+  def decodeInt(self, raw):
+    if self.decode_table is None:
+      if self.bitwidth > DECODE_TABLE_MAX_BITS: return self.calculateValue(raw)
+      self.decode_table = tuple(self.calculateValue(i) for i in range(1 << self.bitwidth))
+    return self.decode_table[raw]
+  """Do the actual math behind `decodeInt`, without the lookup table"""
+  def calculateValue(self, raw):
+    if self.signed and (raw >> (self.bitwidth - 1)): raw -= 1 << self.bitwidth
+    return (self.base + float(raw)*self.scale)
 
 """ Value for a Enum. See the EnumField """
 class EnumValue:
@@ -109,11 +116,13 @@ class EnumValue:
   something that is human-readable. For more info on the data type, see https://en.wikipedia.org/wiki/Enumerated_type
 """
 class EnumField(IntField):
-  enum_map = {}
+  enum_map = None # Maps both names and ints to EnumValues. Initialized in the constructor so it isn't shared
+  enum_table = None # Maps ints straight to EnumValues (or the default) for narrow fields. See DECODE_TABLE_MAX_BITS
   default_value = None
   def __init__(self, name, bitwidth, *values, default_value = None):
     super().__init__(name, bitwidth, base = 0, scale = 1, signed = False)
     self.default_value = default_value
+    self.enum_map = {}
     for value in values:
       if isinstance(value, tuple) and len(value) == 2: value = EnumValue(value[0], value[1])
       if not isinstance(value, EnumValue): raise ValueError("Invalid value type")
@@ -121,56 +130,28 @@ class EnumField(IntField):
       if str(value) in self.enum_map or value.toInt() in self.enum_map: raise ValueError("Duplicate enum value")
       self.enum_map[value.toInt()] = value
       self.enum_map[str(value)] = value
+    
+    if bitwidth <= DECODE_TABLE_MAX_BITS:
+      self.enum_table = [self.default_value] * (1 << bitwidth)
+      for (key, value) in self.enum_map.items():
+        if isinstance(key, int): self.enum_table[key] = value
   def getBitWidth(self): return self.bitwidth
-  def serialize(self, val):
-    return super().serialize(val.toInt()) if isinstance(val, EnumValue) else self.serialize(self.enum_map[val])
-  def deserialize(self, data):
-    decoded = super().deserialize(data)
-    return self.default_value if not decoded in self.enum_map else self.enum_map[decoded]
+  def encodeInt(self, val):
+    return super().encodeInt(val.toInt()) if isinstance(val, EnumValue) else self.encodeInt(self.enum_map[val])
+  def decodeInt(self, raw):
+    if self.enum_table is None: return self.enum_map.get(raw, self.default_value)
+    return self.enum_table[raw]
 
 """Bit shift an entire byte array left. This is like number << bits, but for a bytearray."""
 def bitShiftBytearrayLeft(ba, bits):
-  bytes = math.floor(bits / 8)
-  bits = bits % 8
-  if bytes:
-    ba[bytes:] = ba[:-bytes]
-    ba[0:bytes] = [0] * bytes
-  
-  carryover = 0
-  for i in range(bytes, len(ba)):
-    cn = ba[i] >> (8 - bits)
-    ba[i] = carryover | ((ba[i] << bits) & 0xFF)
-    carryover = cn
+  length = len(ba)
+  ba[:] = ((int.from_bytes(ba, "little") << bits) & ((1 << (length*8)) - 1)).to_bytes(length, "little")
 """Bit shift an entire byte array right. This is like number >> bits, but for a bytearray."""
 def bitShiftBytearrayRight(ba, bits):
-  bytes = math.floor(bits / 8)
-  bits = bits % 8
-  if bytes:
-    ba[0:len(ba)-bytes] = ba[bytes:]
-    ba[len(ba)-bytes:] = [0] * bytes
-  
-  carryover = 0
-  for i in reversed(range(0, len(ba) - bytes)):
-    cn = ba[i] & (0xFF >> (8 - bits))
-    ba[i] = ba[i] >> bits | (carryover << (8 - bits))
-    carryover = cn
+  ba[:] = (int.from_bytes(ba, "little") >> bits).to_bytes(len(ba), "little")
 """Create a mask bytearray. This is `bitlen` ones offset by `start`."""
 def bitmaskByteArray(bitlen, start = 0):
-  length = bitlen + start
-  bytelength = math.ceil(length/8)
-  buf = bytearray(bytelength)
-  
-  bits_remaining = bitlen
-  i = 0
-  while bits_remaining >= 8:
-    buf[i] = 0xFF
-    i += 1
-    bits_remaining -= 8
-    
-  if bits_remaining: buf[i] = 0xFF >> (8 - bits_remaining)
-  bitShiftBytearrayLeft(buf, start)
-  
-  return buf
+  return bytearray((((1 << max(bitlen, 0)) - 1) << start).to_bytes(math.ceil((bitlen + start)/8), "little"))
 
 """
   A C bitfield-like struct that stores data directly in a bytearray. Set up your bitfields, then simply assign them by
@@ -180,8 +161,18 @@ class ExtendedStruct:
   # Python has a little trick where member variables like this are initialized once
   # If they weren't initialized manually in the constructor, the dict would end up getting shared between every instance
   field_name_mappings = None
+  # Precomputed (field, start byte, stop byte, bit shift, mask) for each named field. Named reads and writes only touch
+  # the bytes a field overlaps, so they never need to build masks or shift scratch bytearrays around
+  field_codecs = None
   bit_length = 0
-  buf = None
+  buf = None # The buffer fields are read from. This is `own_buf`, unless another buffer has been attached
+  own_buf = None
+  # Decoded values of named fields, filled in as they're read. Anything that changes the buffer drops the entries it
+  # affects, so repeated reads between writes (or between identical frames) are just a dictionary lookup
+  value_cache = None
+  # Optional specialized functions that replace the generic loops in `toDict` and `fromDict`. See `setCodec`
+  compiled_decoder = None
+  compiled_encoder = None
   
   """
   Arguments
@@ -189,51 +180,71 @@ class ExtendedStruct:
   """
   def __init__(self, *fields):
     if self.field_name_mappings is None: self.field_name_mappings = {}
+    if self.field_codecs is None: self.field_codecs = {}
+    if self.value_cache is None: self.value_cache = {}
     
     for field in fields:
       if field.name in self.field_name_mappings: raise AttributeError("Duplicate prop name " + str(field.name))
       bitwidth = field.getBitWidth()
       sl = slice(self.bit_length, self.bit_length + bitwidth)
       self.bit_length += bitwidth
-      if not field.name is None: self.field_name_mappings[field.name] = (sl, field)
+      if not field.name is None:
+        self.field_name_mappings[field.name] = (sl, field)
+        self.field_codecs[field.name] = (
+          field,
+          math.floor(sl.start/8),
+          math.ceil(sl.stop/8),
+          sl.start % 8,
+          (1 << bitwidth) - 1
+        )
     
-    self.buf = bytearray(math.ceil(self.bit_length/8))
+    self.own_buf = bytearray(math.ceil(self.bit_length/8))
+    self.buf = self.own_buf
   
   def __setitem__(self, i, v):
+    if not self.buf is self.own_buf: self.detach() # Never write into an attached buffer
     if isinstance(i, int):
       if i < 0 or i >= self.bit_length: raise IndexError("Bit outside of struct")
       
       if v: self.buf[math.floor(i/8)] |= (1 << (i%8))
       else: self.buf[math.floor(i/8)] &= (1 << (i%8)) ^ 0xFF
+      self.invalidateBits(i, i + 1)
     elif isinstance(i, slice):
       start = max(i.start, 0)
       stop = min(i.stop, self.bit_length)
+      length = max(stop - start, 0)
       start_byte = math.floor(start/8)
-      length = stop - start
       start_offset = start % 8
+      stop_byte = start_byte + math.ceil((length + start_offset)/8)
       
-      mask = bitmaskByteArray(length, start_offset)
-      data = bytearray(len(mask))
-      
-      if isinstance(v, int):
-        i = 0
-        while not v == 0 and i < len(data):
-          data[i] = v & 0xFF
-          v = v >> 8
-          i += 1
-      elif isinstance(v, bytearray):
-        data[0:min(len(v), len(data))] = v[0:min(len(v), len(data))]
+      # Work on the bytes the slice overlaps as a single int, however long the struct is
+      if isinstance(v, int): data = v
+      elif isinstance(v, bytearray): data = int.from_bytes(v[0:stop_byte - start_byte], "little")
       else: raise ValueError("Invalid value assignment to bitfield")
       
-      bitShiftBytearrayLeft(data, start_offset)
-      
-      for i in range(0, len(data)):
-        self.buf[start_byte + i] &= mask[i] ^ 0xFF
-        self.buf[start_byte + i] |= data[i] & mask[i]
+      mask = ((1 << length) - 1) << start_offset
+      raw = int.from_bytes(self.buf[start_byte:stop_byte], "little")
+      raw = (raw & ~mask) | ((data << start_offset) & mask)
+      self.buf[start_byte:stop_byte] = raw.to_bytes(stop_byte - start_byte, "little")
+      self.invalidateBits(start, stop)
     else:
-      if not i in self.field_name_mappings: raise KeyError("Field name not in struct")
-      (sl, field) = self.field_name_mappings[i] # Lookup the field object and corresponding slice
-      self[sl] = field.serialize(v) # Now set the corresponding slice to the field object's encoded version
+      if not i in self.field_codecs: raise KeyError("Field name not in struct")
+      (field, start_byte, stop_byte, shift, mask) = self.field_codecs[i]
+      # Encode first so that a bad value leaves the buffer untouched, then merge it in one byte at a time
+      raw = (field.encodeInt(v) & mask) << shift
+      mask = mask << shift
+      buf = self.buf
+      if stop_byte - start_byte > WIDE_FIELD_BYTES:
+        merged = (int.from_bytes(buf[start_byte:stop_byte], "little") & ~mask) | raw
+        buf[start_byte:stop_byte] = merged.to_bytes(stop_byte - start_byte, "little")
+      else:
+        j = start_byte
+        while j < stop_byte:
+          buf[j] = (buf[j] & (~mask & 0xFF)) | (raw & 0xFF)
+          raw = raw >> 8
+          mask = mask >> 8
+          j += 1
+      if i in self.value_cache: del self.value_cache[i]
   
   def __getitem__(self, i):
     if isinstance(i, int):
@@ -242,30 +253,120 @@ class ExtendedStruct:
     elif isinstance(i, slice):
       start = 0 if i.start is None else max(i.start, 0)
       stop = self.bit_length if i.stop is None else min(i.stop, self.bit_length)
-      start_offset = start % 8
-      stop_offset = 8 - (stop % 8)
+      length = max(stop - start, 0)
       
-      data = self.buf[math.floor(start/8):math.ceil(stop/8)]
-      if not stop_offset == 8: data[-1] &= 0xFF >> stop_offset
-      bitShiftBytearrayRight(data, start_offset)
+      raw = int.from_bytes(self.buf[math.floor(start/8):math.ceil(stop/8)], "little")
+      return bytearray(((raw >> (start % 8)) & ((1 << length) - 1)).to_bytes(math.ceil(length/8), "little"))
+    else:
+      buf = self.buf
+      cached = buf is self.own_buf # An attached buffer can change under us, so it's never cached
+      if cached and i in self.value_cache: return self.value_cache[i]
       
-      return data[0:math.ceil((stop-start)/8)]
+      if not i in self.field_codecs: raise KeyError("Field name not in struct")
+      (field, start_byte, stop_byte, shift, mask) = self.field_codecs[i]
+      # Read the bytes the field overlaps into an int (little endian), then shift and mask out the field
+      if stop_byte - start_byte > WIDE_FIELD_BYTES: raw = int.from_bytes(buf[start_byte:stop_byte], "little")
+      else:
+        raw = 0
+        j = stop_byte
+        while j > start_byte:
+          j -= 1
+          raw = (raw << 8) | buf[j]
+      value = field.decodeInt((raw >> shift) & mask)
+      if cached: self.value_cache[i] = value
+      return value
+  
+  """Decode every named field in a single pass. Returns a new dictionary of field names to values."""
+  def toDict(self):
+    cached = self.buf is self.own_buf
+    if cached and len(self.value_cache) == len(self.field_codecs): return dict(self.value_cache)
+    
+    values = self.decodeBytes(self.buf)
+    if cached: self.value_cache.update(values)
+    return values
+  """Decode every named field of `buf` (as long as the struct) into a new dictionary, without touching the struct"""
+  def decodeBytes(self, buf):
+    if not self.compiled_decoder is None: return self.compiled_decoder(buf)
+    raw = int.from_bytes(buf, "little")
+    values = {}
+    for (name, (field, start_byte, stop_byte, shift, mask)) in self.field_codecs.items():
+      values[name] = field.decodeInt((raw >> (start_byte*8 + shift)) & mask)
+    return values
+  """
+    Encode a dictionary of field names to values into the struct in a single pass. Fields that aren't in the
+    dictionary keep their current value, and keys that aren't fields raise KeyError, like assigning them one at a time
+    would. Every value is encoded before the buffer is written, so the struct is left untouched if any of them fails.
+  """
+  def fromDict(self, values):
+    for name in values:
+      if not name in self.field_codecs: raise KeyError("Field name not in struct")
+    if not self.compiled_encoder is None: data = self.compiled_encoder(values, self.buf)
     else:
-      if not i in self.field_name_mappings: raise KeyError("Field name not in struct")
-      (sl, field) = self.field_name_mappings[i] # Lookup the field object and corresponding slice
-      return field.deserialize(self[sl]) # Now return the field object's interpretation of these bits
+      raw = int.from_bytes(self.buf, "little")
+      for (name, (field, start_byte, stop_byte, shift, mask)) in self.field_codecs.items():
+        if name in values:
+          start = start_byte*8 + shift
+          raw = (raw & ~(mask << start)) | ((field.encodeInt(values[name]) & mask) << start)
+      data = raw.to_bytes(len(self.own_buf), "little")
+    self.buf = self.own_buf # The whole buffer gets rewritten, so there's no need to copy an attached buffer first
+    self.buf[:] = data
+    for name in values:
+      if name in self.value_cache: del self.value_cache[name]
+  
+  """
+    Replace the generic loops behind `toDict` and `fromDict` with specialized functions, such as the ones built by the
+    `extendedstruct_compiler` library. `decoder(buf)` must return the same dictionary `toDict` would, and
+    `encoder(values, buf)` must return the new contents of the buffer (or raise without side effects). Pass None for
+    both to go back to the generic path.
+  """
+  def setCodec(self, encoder, decoder):
+    self.compiled_encoder = encoder
+    self.compiled_decoder = decoder
   
   def getBytes(self): return bytes(self.buf)
   def setBytes(self, buf):
-    if not len(buf) == len(self.buf): raise ValueError("Invalid struct length")
-    self.buf[:] = buf[:]
+    if not len(buf) == len(self.own_buf): raise ValueError("Invalid struct length")
+    if self.value_cache and self.buf is self.own_buf:
+      # Only forget the fields that this frame actually changes
+      changed = int.from_bytes(self.buf, "little") ^ int.from_bytes(buf, "little")
+      if changed: self.invalidateBits(0, self.bit_length, changed)
+    self.buf = self.own_buf
+    self.buf[:] = buf
+  """
+    Read fields straight out of `buf` instead of copying it into the struct. `buf` can be a memoryview (such as a slot
+    in a receive ring buffer), bytes or a bytearray, and must be exactly as long as the struct. Reads allocate nothing
+    and see whatever is in `buf` at the time, so it's only valid until the owner reuses that memory. The struct never
+    writes to an attached buffer: Writing to a field copies the attached bytes into the struct's own buffer first.
+  """
+  def attach(self, buf):
+    if not len(buf) == len(self.own_buf): raise ValueError("Invalid struct length")
+    self.buf = buf
+    self.value_cache.clear()
+  """Stop reading from an attached buffer, keeping a copy of its current contents"""
+  def detach(self):
+    if self.buf is self.own_buf: return
+    self.own_buf[:] = self.buf
+    self.buf = self.own_buf
+  def isAttached(self): return not self.buf is self.own_buf
+  """
+    Drop cached values of fields that overlap bits `start` to `stop`. If `changed` is given, only fields with a set bit
+    in `changed` (an int of the whole struct, little endian) are dropped. Call `invalidateBits(0, getBitLength())` if you
+    modify `buf` by hand.
+  """
+  def invalidateBits(self, start, stop, changed = -1):
+    if not self.value_cache: return
+    for (name, (field, start_byte, stop_byte, shift, mask)) in self.field_codecs.items():
+      field_start = start_byte*8 + shift
+      if field_start < stop and field_start + field.getBitWidth() > start and (changed >> field_start) & mask:
+        if name in self.value_cache: del self.value_cache[name]
   def getBitLength(self): return self.bit_length
   def getByteLength(self): return math.ceil(self.bit_length / 8)
   def __iter__(self): return iter(self.field_name_mappings.keys())
   
   def __str__(self):
     s = "ExtendedStruct[" + " ".join(map(hex, self.buf)) + "\n"
-    s += "".join([("  " + str(k) + " = " + str(self[k]) + "\n") for k in self.field_name_mappings.keys()])
+    values = self.toDict()
+    s += "".join([("  " + str(k) + " = " + str(values[k]) + "\n") for k in self.field_name_mappings.keys()])
     s += "]"
     return s
 
@@ -380,6 +481,149 @@ if __name__ == "__main__":
   assert(isinstance(s["test4"], EnumValue))
   print(s)
   
+  # Named fields must agree with the equivalent slices when they don't line up with byte boundaries
+  s = ExtendedStruct(
+    ReservedField(3),
+    IntField("a", 12, base = 0, scale = 0.1),
+    IntField("b", 12, signed = True),
+    BoolField("c"),
+    IntField("d", 20, base = -200, scale = 0.01),
+  )
+  s["a"] = 409.5
+  s["b"] = -2048 + 1
+  s["c"] = True
+  s["d"] = 455.35
+  assert(s[3:15] == bytearray([0xFF, 0x0F]))
+  assert(s[15:27] == bytearray([0x01, 0x08]))
+  assert(s[27:28] == bytearray([0x1]))
+  assert(s[28:48] == s.field_name_mappings["d"][1].serialize(455.35))
+  assert(s.buf[0] & 0x7 == 0)
+  assert(s["a"] == 409.5)
+  assert(s["b"] == -2047)
+  assert(s["c"] == True)
+  assert(abs(s["d"] - 455.35) < 0.005)
+  s["b"] = 5
+  assert(s["a"] == 409.5 and s["b"] == 5 and s["c"] == True)
+  
+  # A failed write must not clobber the buffer
+  before = s.getBytes()
+  for (name, value) in (("a", 409.7), ("b", 2048), ("b", -2048), ("d", -201)):
+    try: s[name] = value
+    except OverflowError: pass
+    else: assert(False)
+  assert(s.getBytes() == before)
+  
+  # Bulk encode/decode must match field by field access
+  values = s.toDict()
+  assert(values == { "a": 409.5, "b": 5, "c": True, "d": s["d"] })
+  s.fromDict({ "a": 1.5, "c": False })
+  assert(s["a"] == 1.5 and s["b"] == 5 and s["c"] == False and s["d"] == values["d"])
+  before = s.getBytes()
+  try: s.fromDict({ "a": 0.0, "not_a_field": 123 }) # Misspelled names aren't silently dropped
+  except KeyError: pass
+  else: assert(False)
+  assert(s.getBytes() == before)
+  try: s.fromDict({ "a": 0.0, "b": 4096 })
+  except OverflowError: pass
+  else: assert(False)
+  assert(s.getBytes() == before)
+  t = ExtendedStruct(ReservedField(3), *[s.field_name_mappings[k][1] for k in ("a", "b", "c", "d")])
+  t.fromDict(s.toDict())
+  assert(t.toDict() == s.toDict())
+  
+  # Attached buffers are read in place, and never written to
+  frames = bytearray(t.getBytes() + bytes(t.getByteLength()))
+  ring = memoryview(frames)
+  t.fromDict({ "a": 0.0, "b": 0, "c": False, "d": 0 })
+  t.attach(ring[0:t.getByteLength()])
+  assert(t.isAttached())
+  assert(t.toDict() == s.toDict())
+  assert(t["b"] == 5)
+  assert(t[3:15] == s[3:15])
+  assert(t.getBytes() == s.getBytes())
+  frames[0:t.getByteLength()] = bytes(t.getByteLength())
+  assert(t["b"] == 0) # The view follows its buffer
+  frames[0:t.getByteLength()] = s.getBytes()
+  t["c"] = False
+  assert(not t.isAttached())
+  assert(t["b"] == 5 and t["c"] == False)
+  assert(frames[0:t.getByteLength()] == s.getBytes())
+  t.attach(ring[t.getByteLength():])
+  assert(t["b"] == 0)
+  t.fromDict({ "b": 7 })
+  assert(not t.isAttached() and t["b"] == 7 and t["a"] == 0.0)
+  assert(frames[t.getByteLength():] == bytes(t.getByteLength()))
+  t.attach(bytes(s.getBytes()))
+  t.setBytes(bytes(t.getByteLength()))
+  assert(not t.isAttached() and t["b"] == 0)
+  try: t.attach(ring)
+  except ValueError: pass
+  else: assert(False)
+  
+  # Decoded values are cached until a write touches the field
+  s = ExtendedStruct(IntField("a", 4), IntField("b", 8), BoolField("c"), ReservedField(3))
+  s.fromDict({ "a": 1, "b": 2, "c": True })
+  assert(s.value_cache == {})
+  assert(s.toDict() == { "a": 1, "b": 2, "c": True })
+  assert(s.value_cache == { "a": 1, "b": 2, "c": True })
+  s["a"] = 3
+  assert(s.value_cache == { "b": 2, "c": True })
+  assert(s["a"] == 3 and s.value_cache["a"] == 3)
+  s.setBytes(s.getBytes()) # Nothing changed, so nothing gets dropped
+  assert(len(s.value_cache) == 3)
+  s.setBytes(bytes((s.buf[0] ^ 0x10, s.buf[1]))) # Only touches b
+  assert(s.value_cache == { "a": 3, "c": True } and s["b"] == 3)
+  s[4:12] = 0x5 # Slices and bits drop whatever they overlap
+  assert(s.value_cache == { "a": 3, "c": True } and s["b"] == 5)
+  s[12] = 0
+  assert(s.value_cache == { "a": 3, "b": 5 } and s["c"] == False)
+  s.fromDict({ "b": 6 })
+  assert(s.value_cache == { "a": 3, "c": False })
+  assert(s.toDict() == { "a": 3, "b": 6, "c": False })
+  s.attach(bytes(2))
+  assert(s.value_cache == {} and s["a"] == 0 and s.value_cache == {})
+  s.detach()
+  assert(s.toDict() == { "a": 0, "b": 0, "c": False })
+  
+  # Narrow fields decode through lookup tables, which must agree with the math
+  for field in (IntField("a", 8, base = -0.1, scale = 0.1), IntField("b", 7, signed = True), IntField("c", 1)):
+    assert(field.decode_table is None)
+    s = ExtendedStruct(field)
+    s.setBytes(bytes(s.getByteLength()))
+    s[field.name]
+    assert(len(field.decode_table) == 1 << field.bitwidth)
+    for raw in range(1 << field.bitwidth): assert(field.decodeInt(raw) == field.calculateValue(raw))
+  assert(IntField("wide", DECODE_TABLE_MAX_BITS + 1).decodeInt(3) == 3.0)
+  
+  # Every enum field has its own values, so the same values can be used in more than one field
+  e1 = EnumField("e1", 3, ("a", 0), ("b", 1), default_value = "?")
+  e2 = EnumField("e2", 3, ("a", 0), ("c", 7))
+  e3 = EnumField("e3", 12, ("a", 0), ("d", 0xABC), default_value = "?")
+  assert(e1.decodeInt(1) == "b" and e1.decodeInt(7) == "?" and e1.decodeInt(0) == "a")
+  assert(e2.decodeInt(7) == "c" and e2.decodeInt(1) is None)
+  assert(e3.enum_table is None and e3.decodeInt(0xABC) == "d" and e3.decodeInt(1) == "?")
+  
+  # CAN FD sized structs: Wide fields, and slices across the whole payload
+  for size in (8, 32, 64):
+    bits = size*8
+    s = ExtendedStruct(ReservedField(3), IntField("wide", bits//2 - 3, signed = True), IntField("rest", bits//2))
+    assert(s.getByteLength() == size)
+    # IntField values go through floats, so they only stay exact up to 53 bits no matter how wide the field is
+    s["wide"] = -(1 << min(bits//2 - 5, 50)) + 7
+    s["rest"] = (1 << min(bits//2, 52)) - 2
+    assert(s["wide"] == -(1 << min(bits//2 - 5, 50)) + 7 and s["rest"] == (1 << min(bits//2, 52)) - 2)
+    raw = int.from_bytes(s.buf, "little")
+    assert(s[5:bits - 1] == bytearray(((raw >> 5) & ((1 << (bits - 6)) - 1)).to_bytes(size, "little")))
+    s[1:bits - 2] = 0
+    assert(int.from_bytes(s.buf, "little") == raw & ((0x3 << (bits - 2)) | 0x1))
+    s[1:bits - 2] = bytearray([0xFF]*size)
+    assert(int.from_bytes(s.buf, "little") == (raw & ((0x3 << (bits - 2)) | 0x1)) | (((1 << (bits - 3)) - 1) << 1))
+    ba = bytearray(s.buf)
+    bitShiftBytearrayLeft(ba, bits//2 + 3)
+    assert(int.from_bytes(ba, "little") == (int.from_bytes(s.buf, "little") << (bits//2 + 3)) & ((1 << bits) - 1))
+    bitShiftBytearrayRight(ba, bits - 1)
+    assert(int.from_bytes(ba, "little") == (int.from_bytes(s.buf, "little") >> (bits//2 - 4)) & 0x1)
+  
   #s["a"] = 256 # <- Overflow!
   #s["b"] = 128 # <- Overflow!
 
@@ -0,0 +1,118 @@
+import numpy as np
+from extendedstruct import BoolField, IntField, EnumField
+
+# Enum fields up to this width are decoded through a lookup table with one entry per possible raw value. Wider ones
+# only look up the values that actually show up in the batch.
+ENUM_TABLE_MAX_BITS = 16
+
+"""
+  Turn a batch of frames into an N x (struct length) uint8 array. Accepts a 2D uint8 array, or a bytes-like blob of
+  frames concatenated back to back.
+"""
+def asFrameArray(struct, frames):
+  length = struct.getByteLength()
+  if isinstance(frames, np.ndarray):
+    if frames.ndim != 2 or frames.shape[1] != length: raise ValueError("Frame array must be N x {:d}".format(length))
+    return frames if frames.dtype == np.uint8 else frames.astype(np.uint8)
+
+  frames = np.frombuffer(frames, dtype=np.uint8)
+  if length == 0 or len(frames) % length: raise ValueError("Blob length is not a multiple of the struct length")
+  return frames.reshape(-1, length)
+
+"""Pull the raw, unsigned value of one field out of every frame. Returns a uint64 column."""
+def extractRaw(frames, start_byte, stop_byte, shift, mask):
+  if mask >> 64: raise ValueError("Fields wider than 64 bits can't be batch decoded")
+  raw = np.zeros(len(frames), dtype=np.uint64)
+  for j in range(start_byte, stop_byte):
+    # Line each byte up with where it lands in the field; The first byte may need to lose the bits below the field
+    offset = 8*(j - start_byte) - shift
+    column = frames[:, j].astype(np.uint64)
+    raw |= (column >> np.uint64(-offset)) if offset < 0 else (column << np.uint64(offset))
+  return raw & np.uint64(mask)
+
+# Decode through the field itself, but only once for each distinct raw value in the batch
+def decodeUnique(field, raw):
+  uniques, inverse = np.unique(raw, return_inverse=True)
+  decoded = np.empty(len(uniques), dtype=object)
+  for (k, value) in enumerate(uniques): decoded[k] = field.decodeInt(int(value))
+  return decoded[inverse]
+
+"""Decode a uint64 column of raw values with the same semantics as `field.decodeInt`"""
+def decodeColumn(field, raw):
+  bitwidth = field.getBitWidth()
+  if isinstance(field, EnumField):
+    if bitwidth > ENUM_TABLE_MAX_BITS: return decodeUnique(field, raw)
+    table = np.empty(1 << bitwidth, dtype=object)
+    for value in range(len(table)): table[value] = field.decodeInt(value)
+    return table[raw]
+  if isinstance(field, IntField):
+    if field.signed:
+      # Move the sign bit to the top, then let an arithmetic shift sign extend it back down
+      unused = np.uint64(64 - bitwidth)
+      values = (raw << unused).view(np.int64) >> unused.astype(np.int64)
+    else: values = raw
+    return field.base + values.astype(np.float64)*field.scale
+  if isinstance(field, BoolField): return (raw & np.uint64(0x1)) != 0
+  return decodeUnique(field, raw)
+
+"""
+  Decode a whole batch of frames that all share the layout of `struct`. Returns a dictionary of field names to NumPy
+  columns, one entry per frame. Integer fields come back as float64 (base and scale applied), booleans as bool, and
+  enums (or any custom field) as object arrays of whatever the field decodes to.
+
+  Arguments:
+    struct - An ExtendedStruct (or ExtendedStructProperty) describing the layout. Its own contents aren't touched.
+    frames - An N x (struct length) uint8 array, or a bytes-like blob of frames concatenated back to back
+    fields - Optionally, an iterable of the field names to decode. Defaults to every field.
+"""
+def decodeFrames(struct, frames, fields = None):
+  frames = asFrameArray(struct, frames)
+  columns = {}
+  for name in (struct.field_codecs.keys() if fields is None else fields):
+    if not name in struct.field_codecs: raise KeyError("Field name not in struct")
+    (field, start_byte, stop_byte, shift, mask) = struct.field_codecs[name]
+    columns[name] = decodeColumn(field, extractRaw(frames, start_byte, stop_byte, shift, mask))
+  return columns
+
+if __name__ == "__main__":
+  import random
+  from extendedstruct import ExtendedStruct, ReservedField, EnumValue
+
+  random.seed(0)
+
+  # Same layout as weatherstation_windspeed
+  windspeed = ExtendedStruct(
+    IntField("10min", 12, base = 0, scale = 0.1, signed = False),
+    IntField("gust", 12, base = 0, scale = 0.1, signed = False),
+    IntField("instant", 12, base = 0, scale = 0.1, signed = False),
+  )
+  mixed = ExtendedStruct(
+    BoolField("flag"),
+    EnumField("mode", 3, ("IDLE", 0), ("RUN", 1), ("FAULT", 5), default_value = "?"),
+    ReservedField(5),
+    IntField("signed", 13, base = 10, scale = 0.5, signed = True),
+    IntField("wide", 64),
+    IntField("wide_signed", 33, signed = True),
+  )
+
+  for s in (windspeed, mixed):
+    frames = [bytes(random.randrange(256) for _ in range(s.getByteLength())) for _ in range(2000)]
+    expected = []
+    for frame in frames:
+      s.setBytes(frame)
+      expected.append(s.toDict())
+
+    # Both input forms must decode to exactly what the struct decodes one frame at a time
+    blob = b"".join(frames)
+    for columns in (decodeFrames(s, blob), decodeFrames(s, np.frombuffer(blob, dtype=np.uint8).reshape(len(frames), -1))):
+      assert(set(columns.keys()) == set(s.field_codecs.keys()))
+      for name in columns:
+        assert(len(columns[name]) == len(frames))
+        for (k, values) in enumerate(expected): assert(columns[name][k] == values[name])
+
+  assert(list(decodeFrames(windspeed, bytes(10), fields = ["gust"]).keys()) == ["gust"])
+  try: decodeFrames(windspeed, bytes(11))
+  except ValueError: pass
+  else: assert(False)
+
+  print("All tests passed")
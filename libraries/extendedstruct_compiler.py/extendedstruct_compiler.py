@@ -0,0 +1,226 @@
+from extendedstruct import BoolField, IntField, EnumField
+
+"""
+  Compiles ExtendedStruct layouts into specialized encode/decode functions. The generic `toDict` and `fromDict` loop
+  over every field and call into the field objects; The compiled versions are straight-line Python with every shift,
+  mask, base and scale inlined as a constant, which is several times faster.
+
+  Source is generated and `exec`'d once per distinct layout (see `layoutFingerprint`), then bound to each struct's own
+  field objects. If a layout can't be compiled, or `exec` isn't available, structs simply keep the generic path.
+"""
+
+# Compiled factories, keyed by layout fingerprint. Each factory takes a struct's field objects (in order) and returns a
+# new (encoder, decoder) pair bound to them. Layouts that failed to compile map to None.
+compiled_factories = {}
+
+# A list of (name, field, kind, start bit, bit width, mask) for every named field in the struct, in order. `kind`
+# decides how the field gets compiled. Only exact types are inlined: A subclass could override any of the codec methods,
+# so it's called through its own `encodeInt`/`decodeInt` like any other custom field.
+def fieldPlans(struct):
+  plans = []
+  for (name, (field, start_byte, stop_byte, shift, mask)) in struct.field_codecs.items():
+    kind = type(field)
+    if kind is IntField: kind = "int"
+    elif kind is BoolField: kind = "bool"
+    elif kind is EnumField: kind = "enum"
+    else: kind = "field"
+    plans.append((name, field, kind, start_byte*8 + shift, field.getBitWidth(), mask))
+  return plans
+
+"""
+  A string that identifies everything the generated source depends on. Structs with the same fingerprint share the
+  same compiled code.
+"""
+def layoutFingerprint(struct):
+  parts = [str(struct.getByteLength())]
+  for (name, field, kind, start, width, mask) in fieldPlans(struct):
+    part = (kind, name, start, width)
+    if kind == "int": part += (repr(field.base), repr(field.scale), field.signed)
+    if kind == "enum": part += (field.enum_table is None,)
+    parts.append(repr(part))
+  return "|".join(parts)
+
+# Write a number as source. `inf` and `nan` have no literal, so those raise ValueError.
+def literal(value):
+  if value != value or value in (float("inf"), float("-inf")): raise ValueError("Can't write {!r} as source".format(value))
+  return repr(value)
+
+"""Generate the source of a factory function `make(fields)` that returns a specialized (encoder, decoder) pair."""
+def generateSource(struct):
+  plans = fieldPlans(struct)
+  length = struct.getByteLength()
+  full_mask = (1 << (length*8)) - 1
+
+  lines = ["def make(fields):"]
+  for (i, (name, field, kind, start, width, mask)) in enumerate(plans):
+    lines.append("  f{:d} = fields[{:d}]".format(i, i))
+    if kind == "enum" and not field.enum_table is None: lines.append("  t{0:d} = f{0:d}.enum_table".format(i))
+
+  lines.append("  def decode(buf):")
+  lines.append("    raw = int.from_bytes(buf, 'little')")
+  for (i, (name, field, kind, start, width, mask)) in enumerate(plans):
+    raw = "(raw >> {:d}) & {:#x}".format(start, mask) if start else "raw & {:#x}".format(mask)
+    if kind == "int":
+      if field.signed:
+        lines.append("    v = " + raw)
+        lines.append("    if v >> {:d}: v -= {:#x}".format(width - 1, 1 << width))
+        raw = "v"
+      lines.append("    d{:d} = ({}) + float({})*({})".format(i, literal(field.base), raw, literal(field.scale)))
+    elif kind == "bool": lines.append("    d{:d} = ({}) & 0x1 == 0x1".format(i, raw))
+    elif kind == "enum" and not field.enum_table is None: lines.append("    d{0:d} = t{0:d}[{1}]".format(i, raw))
+    else: lines.append("    d{0:d} = f{0:d}.decodeInt({1})".format(i, raw))
+  lines.append("    return {" + ", ".join("{!r}: d{:d}".format(plan[0], i) for (i, plan) in enumerate(plans)) + "}")
+
+  # Mirrors the generic `fromDict`: Every value is encoded (and checked) before anything is returned
+  lines.append("  def encode(values, buf):")
+  lines.append("    raw = int.from_bytes(buf, 'little')")
+  for (i, (name, field, kind, start, width, mask)) in enumerate(plans):
+    lines.append("    if {!r} in values:".format(name))
+    lines.append("      v = values[{!r}]".format(name))
+    if kind == "int":
+      lines.append("      if not (isinstance(v, int) or isinstance(v, float)): "
+        "raise ValueError('Invalid type of numeric field')")
+      lines.append("      v = int((v - ({})) / ({}))".format(literal(field.base), literal(field.scale)))
+      if field.signed:
+        lines.append("      if v < 0:")
+        lines.append("        if (-v) >> {:d}: raise OverflowError('Bitfield overflow')".format(width - 1))
+        lines.append("        v &= {:#x}".format(mask))
+        lines.append("      elif v >> {:d}: raise OverflowError('Bitfield overflow')".format(width - 1))
+      else: lines.append("      if v < 0 or v >> {:d}: raise OverflowError('Bitfield overflow')".format(width))
+    elif kind == "bool": lines.append("      v = 0x1 if v else 0x0")
+    else: lines.append("      v = f{:d}.encodeInt(v) & {:#x}".format(i, mask))
+    lines.append("      raw = (raw & {:#x}) | (v << {:d})".format(full_mask ^ (mask << start), start))
+  lines.append("    return raw.to_bytes({:d}, 'little')".format(length))
+
+  lines.append("  return (encode, decode)")
+  return "\n".join(lines) + "\n"
+
+"""Get a compiled (encoder, decoder) pair for a struct, or None if it can't be compiled. See `ExtendedStruct.setCodec`"""
+def getCodec(struct):
+  fingerprint = layoutFingerprint(struct)
+  if not fingerprint in compiled_factories:
+    namespace = {}
+    try:
+      exec(generateSource(struct), namespace)
+      compiled_factories[fingerprint] = namespace["make"]
+    except Exception as e:
+      # No exec on this platform, or a field that can't be written as source (like a base of `inf`)
+      print("WARN: Couldn't compile struct layout, using the generic codec:", repr(e))
+      compiled_factories[fingerprint] = None
+
+  factory = compiled_factories[fingerprint]
+  return None if factory is None else factory([plan[1] for plan in fieldPlans(struct)])
+
+"""
+  Switch a struct (or ExtendedStructProperty) over to compiled `toDict`/`fromDict` functions. Returns True if it was
+  compiled, or False if it's staying on the generic path.
+"""
+def compileStruct(struct):
+  codec = getCodec(struct)
+  if codec is None: return False
+  struct.setCodec(*codec)
+  return True
+
+"""Go back to the generic `toDict`/`fromDict` path"""
+def uncompileStruct(struct): struct.setCodec(None, None)
+
+if __name__ == "__main__":
+  import random
+  from extendedstruct import ExtendedStruct, ReservedField, BitField
+
+  random.seed(0)
+
+  # A custom field, which can't be inlined and has to go through its own methods
+  class NibbleSwapField(BitField):
+    def __init__(self, name): self.name = name
+    def getBitWidth(self): return 8
+    def encodeInt(self, val): return ((val & 0xF) << 4) | ((val >> 4) & 0xF)
+    def decodeInt(self, raw): return ((raw & 0xF) << 4) | (raw >> 4)
+
+  RESET_REASONS = [("POWER_ON", 0), ("BROWNOUT", 1), ("SOFTWARE", 2), ("WATCHDOG", 5)]
+  LAYOUTS = [
+    # Same as StatusProperty in sustaingineering_defs
+    lambda: ExtendedStruct(
+      BoolField("release_build"),
+      BoolField("is_first_message"),
+      EnumField("reset_reason", 3, *RESET_REASONS),
+      ReservedField(3),
+      IntField("proto_version", 8),
+    ),
+    # Same as weatherstation_ambient
+    lambda: ExtendedStruct(
+      IntField("temperature", 16, base = -200, scale = 0.01, signed = False),
+      IntField("humidity", 8, base = 0, scale = 100.0/255.0, signed = False),
+      IntField("pressure", 16, base = 800.0, scale = 0.01, signed = False),
+    ),
+    # Same as weatherstation_windspeed
+    lambda: ExtendedStruct(
+      IntField("10min", 12, base = 0, scale = 0.1, signed = False),
+      IntField("gust", 12, base = 0, scale = 0.1, signed = False),
+      IntField("instant", 12, base = 0, scale = 0.1, signed = False),
+    ),
+    lambda: ExtendedStruct(
+      ReservedField(5),
+      IntField("signed", 11, base = -3.5, scale = 0.25, signed = True),
+      EnumField("wide_enum", 12, ("A", 0), ("B", 0xABC), default_value = "?"),
+      NibbleSwapField("custom"),
+      IntField("wide", 40, signed = True),
+      BoolField("flag"),
+    ),
+  ]
+
+  def randomValue(field):
+    width = field.getBitWidth()
+    if isinstance(field, BoolField): return random.random() < 0.5
+    if isinstance(field, EnumField): return random.choice([k for k in field.enum_map.keys() if isinstance(k, str)])
+    if isinstance(field, IntField):
+      raw = random.randrange(-(1 << width), 1 << (width + 1)) # Some of these overflow on purpose
+      return field.base + raw*field.scale + (random.random() if random.random() < 0.3 else 0)
+    return random.randrange(256)
+
+  for layout in LAYOUTS:
+    generic = layout()
+    compiled = layout()
+    assert(compileStruct(compiled))
+    assert(compiled.compiled_encoder and compiled.compiled_decoder)
+
+    # Decoding any frame must give exactly the same values
+    for _ in range(2000):
+      frame = bytes(random.randrange(256) for _ in range(generic.getByteLength()))
+      generic.setBytes(frame)
+      compiled.setBytes(frame)
+      assert(generic.toDict() == compiled.toDict())
+      assert(list(generic.toDict().keys()) == list(compiled.toDict().keys()))
+
+    # Encoding must give the same bytes, and fail the same way without touching the buffer
+    for _ in range(2000):
+      values = { name: randomValue(generic.field_codecs[name][0]) for name in generic if random.random() < 0.7 }
+      errors = []
+      for s in (generic, compiled):
+        before = s.getBytes()
+        try:
+          s.fromDict(values)
+          errors.append(None)
+        except Exception as e:
+          assert(s.getBytes() == before)
+          errors.append(type(e))
+      assert(errors[0] == errors[1])
+      assert(generic.getBytes() == compiled.getBytes())
+      assert(generic.toDict() == compiled.toDict())
+
+  # Layouts are only compiled once, but every struct gets functions bound to its own fields
+  count = len(compiled_factories)
+  a = LAYOUTS[0]()
+  b = LAYOUTS[0]()
+  assert(compileStruct(a) and compileStruct(b))
+  assert(len(compiled_factories) == count)
+  assert(not a.compiled_decoder is b.compiled_decoder)
+
+  # Layouts that can't be written as source fall back to the generic path
+  s = ExtendedStruct(IntField("x", 8, base = float("inf")))
+  assert(not compileStruct(s))
+  assert(s.compiled_decoder is None and s.compiled_encoder is None)
+  uncompileStruct(a)
+  assert(a.compiled_decoder is None)
+
+  print("All tests passed")
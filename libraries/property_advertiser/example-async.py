@@ -0,0 +1,42 @@
+import asyncio
+import can
+from property_advertiser import StructProperty
+from property_advertiser.aio import AsyncPropertyRegistry
+from property_advertiser.pycan import PycanTransmitter, AsyncPycanReceiver
+
+# Two registries on one (virtual) CAN bus, both in the same asyncio event loop. On the Pi, this would be one registry
+# and a real bus, with the sensor node on the other end.
+class TestPropertyRegistry(AsyncPropertyRegistry):
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.addProperty(0, "TEST", StructProperty(">H"))
+
+async def sensorNode(bus):
+  reg = TestPropertyRegistry(transmitter = PycanTransmitter(bus))
+  running = asyncio.create_task(reg.run()) # Nothing to receive, but it still sends updates
+  for value in range(5):
+    reg["TEST"] = (value,) # Sent right away by `run`; No need to call eventLoop
+    await asyncio.sleep(0.5)
+  running.cancel()
+
+# A sink is any async function. It only ever sees the latest change, so a slow upload never backs up the bus
+async def upload(name, status):
+  print("Uploading", name, status)
+  await asyncio.sleep(1.0) # Pretend to be a slow HTTP request
+
+async def main():
+  reg = TestPropertyRegistry()
+  with can.Bus(interface = "virtual", channel = "example") as sensor_bus, \
+      can.Bus(interface = "virtual", channel = "example") as bus, \
+      AsyncPycanReceiver(bus) as receiver:
+    asyncio.create_task(reg.run(receiver)) # Receive from as many buses as you like: reg.run(receiver1, receiver2)
+    asyncio.create_task(reg.feedSink(None, upload))
+    asyncio.create_task(sensorNode(sensor_bus))
+    
+    # Wait for the first value, then print every change until the sensor stops sending and the data expires
+    print("TEST is now", await reg.waitFor("TEST", timeout = 5.0), reg["TEST"])
+    async for (name, status) in reg.changes("TEST"):
+      print(name, "is now", status, reg[name])
+      if not status.isValid(): break
+
+asyncio.run(main())
@@ -0,0 +1,271 @@
+import asyncio
+from adafruit_ticks import ticks_ms, ticks_diff
+from .base import PropertyRegistry, LOCAL_DATA
+
+"""
+  An asyncio version of PropertyRegistry, for devices with a full asyncio (the Pi). Rather than polling `eventLoop` with
+  a receive timeout, `run` consumes frames from async receivers as they arrive, and only wakes up for housekeeping
+  (sending, heartbeats and expiry) when there's something to do. Everything else in the program (uploads, local APIs,
+  other buses) can share the same event loop.
+
+  An async receiver is anything that works with `async for` and yields (CAN ID, message) pairs, like
+  `pycan.AsyncPycanReceiver`. Transmitters are the usual synchronous ones.
+"""
+class AsyncPropertyRegistry(PropertyRegistry):
+  # How long to wait before sending more when the transmit budget left some properties queued
+  transmit_interval_ms = None # Defined in ctor
+  wakeup = None # asyncio.Event, set when there's something new to send or expire. Created by `run`
+
+  def __init__(self, *args, transmit_interval_ms = 10, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.transmit_interval_ms = transmit_interval_ms
+
+  def queueTransmit(self, prop_entry):
+    super().queueTransmit(prop_entry)
+    if not self.wakeup is None: self.wakeup.set()
+  # Restored data can expire sooner than housekeeping was going to wake up, so it has to work out its sleep again.
+  # Received data doesn't need this: It never expires sooner than `data_timeout`, the longest housekeeping sleeps
+  def restoreRemote(self, prop_entry, msg, remaining_ms):
+    restored = super().restoreRemote(prop_entry, msg, remaining_ms)
+    if restored and not self.wakeup is None: self.wakeup.set()
+    return restored
+
+  # Milliseconds until housekeeping has something to do: Sending what the budget held back, a heartbeat, or an expiry
+  def nextWakeup(self, now):
+    if self.transmit_queue: return self.transmit_interval_ms
+    # Anything received while asleep expires at least `data_timeout` from now, so that's the longest it can sleep
+    wait = self.data_timeout
+    if self.property_expiry: wait = min(wait, self.property_expiry[0][0] - ticks_diff(now, self.expiry_base))
+    if not self.transmitter is None:
+      for prop in self.policy_entries:
+        if prop.status is LOCAL_DATA and not prop.sent_at is None:
+          wait = min(wait, prop.policy.heartbeat - ticks_diff(now, prop.sent_at))
+    return max(wait, 0)
+
+  # Send queued properties and expire old data whenever it's due. Frames come in through `receiveFrom` instead
+  async def housekeeping(self):
+    while True:
+      self.wakeup.clear()
+      self.eventLoop()
+      try: await asyncio.wait_for(self.wakeup.wait(), self.nextWakeup(ticks_ms()) / 1000)
+      except asyncio.TimeoutError: pass
+
+  # Process every frame from an async receiver until it runs out
+  async def receiveFrom(self, receiver):
+    async for (can_id, msg) in receiver:
+      try: self.receive(can_id, msg)
+      except Exception as e: self.warn("packet", "Exception processing packet with ID 0x{:03X}:", can_id, exception = e)
+
+  """
+    Run the registry: Receive from every one of `receivers` and send updates until cancelled. A synchronous `receiver`
+    passed to the constructor would still be polled (and block the event loop), so leave that one out.
+  """
+  async def run(self, *receivers):
+    self.wakeup = asyncio.Event()
+    tasks = [asyncio.ensure_future(self.housekeeping())]
+    tasks += [asyncio.ensure_future(self.receiveFrom(receiver)) for receiver in receivers]
+    try: await asyncio.gather(*tasks)
+    finally:
+      for task in tasks: task.cancel()
+      self.wakeup = None
+
+  """
+    Wait for a property's next change (new data, expiry or a corrupt frame), and return its new status. Raises
+    asyncio.TimeoutError if `timeout` seconds pass first.
+  """
+  async def waitFor(self, name_or_can_id, timeout = None):
+    prop_entry = self.getPropEntry(name_or_can_id)
+    changed = asyncio.get_running_loop().create_future()
+    def onChange(name, status):
+      if not changed.done(): changed.set_result(status)
+    self.subscribe(prop_entry.can_id, onChange)
+    try: return await asyncio.wait_for(changed, timeout)
+    finally: self.unsubscribe(prop_entry.can_id, onChange)
+
+  """
+    An async iterator of (name, status) for each change to a property, or to every property if `name_or_can_id` is
+    None. Changes are coalesced: A property that changes several times while the consumer is busy comes up once, with
+    its latest status. So a slow consumer (like an upload) only ever sees the current state, and never holds up
+    receiving.
+  """
+  async def changes(self, name_or_can_id = None):
+    pending = {} # Names that changed, in order. Only the keys are used
+    ready = asyncio.Event()
+    def onChange(name, status):
+      pending[name] = None
+      ready.set()
+    self.subscribe(name_or_can_id, onChange)
+    try:
+      while True:
+        await ready.wait()
+        ready.clear()
+        while pending:
+          name = next(iter(pending))
+          del pending[name]
+          yield (name, self.getStatus(name))
+    finally: self.unsubscribe(name_or_can_id, onChange)
+
+  """
+    Await `sink(name, status)` for every change to a property (or every property, with None) until cancelled. Run it
+    as a task next to `run`, e.g. `asyncio.create_task(registry.feedSink(None, upload))`. Exceptions in the sink are
+    warned about (see `warn`), and it keeps getting later changes.
+  """
+  async def feedSink(self, name_or_can_id, sink):
+    async for (name, status) in self.changes(name_or_can_id):
+      try: await sink(name, status)
+      except Exception as e: self.warn("sink", "Exception in sink for {}:", name, exception = e)
+
+if __name__ == "__main__":
+  import traceback
+  from .base import StructProperty, Transmitter, NO_DATA, REMOTE_DATA, EXPIRED
+
+  tests = {}
+  failed_tests = set()
+
+  def test(f):
+    tests[f.__name__] = f
+
+  # Yields each (delay in seconds, CAN ID, message), after its delay
+  class ScriptedReceiver:
+    def __init__(self, *frames): self.frames = frames
+    async def __aiter__(self):
+      for (delay, can_id, msg) in self.frames:
+        await asyncio.sleep(delay)
+        yield (can_id, msg)
+  class RecordingTransmitter(Transmitter):
+    def __init__(self): self.sent = []
+    def send(self, can_id, msg):
+      self.sent.append((can_id, bytes(msg)))
+      return True
+
+  def makeRegistry(**kwargs):
+    pr = AsyncPropertyRegistry(**kwargs)
+    pr.addProperty(0, "a", StructProperty(">B"))
+    pr.addProperty(1, "b", StructProperty(">B"))
+    return pr
+
+  # Run `pr` with `receivers` next to `main`, then stop it
+  def runWith(pr, main, *receivers):
+    async def both():
+      runner = asyncio.ensure_future(pr.run(*receivers))
+      try: return await main()
+      finally:
+        runner.cancel()
+        try: await runner
+        except asyncio.CancelledError: pass
+    return asyncio.run(both())
+
+  @test
+  def WaitForReceivedData():
+    pr = makeRegistry()
+    async def main():
+      assert(pr.getStatus("a") is NO_DATA)
+      assert(await pr.waitFor("a", timeout = 1.0) is REMOTE_DATA)
+      assert(pr["a"] == (7,))
+    runWith(pr, main, ScriptedReceiver((0.01, 0, b"\x07")))
+  @test
+  def WaitForTimesOut():
+    pr = makeRegistry()
+    async def main():
+      try:
+        await pr.waitFor("a", timeout = 0.02)
+        assert(False)
+      except asyncio.TimeoutError: pass
+      assert(not pr.getPropEntry("a").subscribers)
+    runWith(pr, main)
+  @test
+  def ReceivesFromSeveralBuses():
+    pr = makeRegistry()
+    async def main():
+      await asyncio.gather(pr.waitFor("a", timeout = 1.0), pr.waitFor("b", timeout = 1.0))
+      assert(pr["a"] == (1,) and pr["b"] == (2,))
+    runWith(pr, main, ScriptedReceiver((0.01, 0, b"\x01")), ScriptedReceiver((0.02, 1, b"\x02")))
+  @test
+  def AssignmentsAreSentWithoutPolling():
+    txn = RecordingTransmitter()
+    pr = makeRegistry(transmitter = txn)
+    async def main():
+      await asyncio.sleep(0.01)
+      assert(not txn.sent)
+      pr["b"] = (5,)
+      await asyncio.sleep(0.01)
+      assert(txn.sent == [(1, b"\x05")])
+    runWith(pr, main)
+  @test
+  def TransmitBudgetIsPaced():
+    txn = RecordingTransmitter()
+    pr = makeRegistry(transmitter = txn, transmit_budget_frames = 1, transmit_interval_ms = 5)
+    async def main():
+      pr["a"] = (1,)
+      pr["b"] = (2,)
+      await asyncio.sleep(0.001)
+      assert(txn.sent == [(0, b"\x01")])
+      await asyncio.sleep(0.05)
+      assert(txn.sent == [(0, b"\x01"), (1, b"\x02")])
+    runWith(pr, main)
+  @test
+  def RemoteDataExpiresOnTime():
+    pr = makeRegistry(data_timeout = 30)
+    async def main():
+      assert(await pr.waitFor("a", timeout = 1.0) is REMOTE_DATA)
+      start = ticks_ms()
+      assert(await pr.waitFor("a", timeout = 1.0) is EXPIRED)
+      assert(ticks_diff(ticks_ms(), start) < 200)
+    runWith(pr, main, ScriptedReceiver((0.01, 0, b"\x01")))
+  @test
+  def RestoredDataExpiresOnTime():
+    pr = makeRegistry(data_timeout = 10000)
+    async def main():
+      await asyncio.sleep(0.01) # Housekeeping is asleep for the whole data timeout
+      start = ticks_ms()
+      assert(pr.restoreRemote(pr.getPropEntry("a"), b"\x01", 30))
+      assert(await pr.waitFor("a", timeout = 1.0) is EXPIRED)
+      assert(ticks_diff(ticks_ms(), start) < 200)
+    runWith(pr, main)
+  @test
+  def ChangesAreCoalesced():
+    pr = makeRegistry()
+    async def main():
+      changes = pr.changes()
+      first = asyncio.ensure_future(changes.__anext__())
+      await asyncio.sleep(0) # Let it subscribe
+      pr["a"] = (1,)
+      pr["b"] = (1,)
+      pr["a"] = (2,)
+      seen = [await first, await changes.__anext__()]
+      assert([name for (name, status) in seen] == ["a", "b"])
+      assert(seen[0][1] is LOCAL_DATA)
+      await changes.aclose()
+      assert(not pr.subscribers_all)
+    asyncio.run(main())
+  @test
+  def SinkErrorsAreContained():
+    pr = makeRegistry()
+    seen = []
+    async def sink(name, status):
+      seen.append(name)
+      if name == "a": raise ValueError("oops")
+    async def main():
+      feeding = asyncio.ensure_future(pr.feedSink(None, sink))
+      await asyncio.sleep(0)
+      pr["a"] = (1,)
+      await asyncio.sleep(0.01)
+      pr["b"] = (1,)
+      await asyncio.sleep(0.01)
+      feeding.cancel()
+      assert(seen == ["a", "b"])
+    asyncio.run(main())
+
+  for test in tests.keys():
+    print("Test", test, "----------------")
+    try:
+      tests[test]()
+      print("TEST PASSED")
+    except:
+      failed_tests.add(test)
+      print("TEST FAILED", traceback.format_exc())
+
+  print()
+  print("All tests complete,", len(failed_tests), "failed")
+  for test in failed_tests:
+    print(test, "FAILED")
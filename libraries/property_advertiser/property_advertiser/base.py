@@ -1,6 +1,85 @@
 import traceback
 import struct
 from instant import Instant
+from adafruit_ticks import ticks_ms, ticks_add, ticks_diff
+# Nanosecond clock for timing decodes. Boards without long ints don't have it, and skip decode timing
+try: from time import monotonic_ns
+except ImportError: monotonic_ns = None
+
+# Pure Python versions of `heapq.heappush`, `heapq.heappop` and `heapq.heapify`, for boards that don't have heapq
+def heapPush(heap, item):
+  heap.append(item)
+  i = len(heap) - 1
+  while i:
+    parent = (i - 1) >> 1
+    if not item < heap[parent]: break
+    heap[i] = heap[parent]
+    i = parent
+  heap[i] = item
+def heapPop(heap):
+  last = heap.pop()
+  if not heap: return last
+  top = heap[0]
+  i = 0
+  while True:
+    child = 2*i + 1
+    if child >= len(heap): break
+    if child + 1 < len(heap) and heap[child + 1] < heap[child]: child += 1
+    if not heap[child] < last: break
+    heap[i] = heap[child]
+    i = child
+  heap[i] = last
+  return top
+def heapMake(heap):
+  items = heap[:]
+  heap[:] = []
+  for item in items: heapPush(heap, item)
+try: from heapq import heappush, heappop, heapify
+except ImportError: (heappush, heappop, heapify) = (heapPush, heapPop, heapMake)
+
+# How long expiry deadlines are measured from the same base time before they're rebased. Ticks wrap around, so
+# deadlines are stored relative to a recent base instead of as raw tick values. Must be well under `ticks_diff`'s range.
+EXPIRY_REBASE_INTERVAL = 60*60*1000
+# Number of standard (11-bit) CAN IDs
+CAN_ID_COUNT = 0x800
+# Set in a CAN ID (like Linux's CAN_EFF_FLAG) to mark an extended (29-bit) ID, which can also be numerically small
+EXTENDED_ID_FLAG = 0x80000000
+EXTENDED_ID_MASK = 0x1FFFFFFF
+# Histogram bucket bounds for `PropertyRegistry.getStats`: Decode times in nanoseconds, and expiry lag in milliseconds
+DECODE_TIME_BOUNDS_NS = (1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000)
+EXPIRY_LAG_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# Most distinct unknown CAN IDs counted individually. Past this, they're all counted under None
+UNKNOWN_ID_LIMIT = 32
+
+# Counts values into buckets: `counts[i]` is how many were under `bounds[i]` but not an earlier bound, and the last
+# count is everything past the last bound
+class Histogram:
+  __slots__ = ("bounds", "counts", "count", "total", "maximum")
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.reset()
+  def reset(self):
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.count = 0
+    self.total = 0
+    self.maximum = 0
+  def add(self, value):
+    i = 0
+    for bound in self.bounds:
+      if value < bound: break
+      i += 1
+    self.counts[i] += 1
+    self.count += 1
+    self.total += value
+    if value > self.maximum: self.maximum = value
+  def toDict(self):
+    return {
+      "bounds": self.bounds,
+      "counts": list(self.counts),
+      "count": self.count,
+      "mean": self.total / self.count if self.count else None,
+      "max": self.maximum
+    }
 
 # A base class for all property types
 class BaseProperty:
@@ -11,6 +90,17 @@ class BaseProperty:
   
   def deserializeValue(self, msg): return True
   def serializeValue(self): return bytes()
+  # A dictionary of the property's current field values, used by `TransmitPolicy` to decide whether a change is worth
+  # sending. None if the property can't tell, in which case every update is sent.
+  def fieldValues(self): return None
+  # Decode a payload into field values (like `fieldValues`) without changing the property. None if it can't
+  def decodePayload(self, msg): return None
+  # How many bytes `serializeValue` always returns, or None if it varies. Needed to pack it into a multiplexed property,
+  # or keep its history
+  def getPayloadLength(self): return None
+  # Called after `serializeValue`'s bytes were sent. Return True to be queued again, for properties that take several
+  # frames to send
+  def valueSent(self): return False
   
   def __str__(self): return "BaseProperty: No data"
 
@@ -22,14 +112,15 @@ class StructProperty(BaseProperty):
     self.value = value
     return True
   def getValue(self, update_callback): return self.value
+  # The registry warns about packets that fail to decode
   def deserializeValue(self, msg):
-    try:
-      self.value = struct.unpack(self.fmt, msg)
-      return True
-    except Exception as e:
-      print("WARN: Bad struct packet:", traceback.format_exception(e))
-      return False
+    try: self.value = struct.unpack(self.fmt, msg)
+    except Exception: return False
+    return True
   def serializeValue(self): return struct.pack(self.fmt, *self.value)
+  def fieldValues(self): return None if self.value is None else dict(enumerate(self.value))
+  def decodePayload(self, msg): return dict(enumerate(struct.unpack(self.fmt, msg)))
+  def getPayloadLength(self): return struct.calcsize(self.fmt)
   def __str__(self): return "StructProperty: " + str(self.value)
 
 # Base class for transmitters
@@ -53,37 +144,102 @@ class DummyTransceiver(Transmitter, Receiver):
   def receive(self):
     return self.buf.pop() if self.buf else None
 
+# Statuses don't hold any state, so every property shares the instances below rather than allocating new ones. Check
+# them with `isinstance` or `is`. A remote property's expiry lives in its entry; See `PropertyRegistry.getExpiry`
 class PropertyStatus: # Status of a particular property; See PropertyRegistry
   def isValid(self): return False
   def isLocal(self): return None
-  def expiry(self): return None
   def __str__(self): return "UNKNOWN STATUS"
 class NoDataStatus(PropertyStatus): # Nothing received or recorded
   def isValid(self): return False
   def isLocal(self): return True
-  def expiry(self): return None
   def __str__(self): return "NO DATA"
 class LocalDataStatus(PropertyStatus): # Data recorded locally
   def isValid(self): return True
   def isLocal(self): return True
-  def expiry(self): return None
   def __str__(self): return "LOCAL"
 class RemoteDataStatus(PropertyStatus): # Data received from remote
-  def __init__(self, expiry_instant): self.expiry_instant = expiry_instant
   def isValid(self): return True
   def isLocal(self): return False
-  def expiry(self): return self.expiry_instant
   def __str__(self): return "REMOTE"
 class ExpiredStatus(PropertyStatus): # Data received from remote, but expired
   def isValid(self): return False
   def isLocal(self): return False
-  def expiry(self): return None
   def __str__(self): return "REMOTE/EXPIRED"
 class ErrorStatus(PropertyStatus): # Corrupt data received from remote
   def isValid(self): return False
   def isLocal(self): return False
-  def expiry(self): return None
   def __str__(self): return "REMOTE/ERROR"
+NO_DATA = NoDataStatus()
+LOCAL_DATA = LocalDataStatus()
+REMOTE_DATA = RemoteDataStatus()
+EXPIRED = ExpiredStatus()
+ERROR = ErrorStatus()
+
+"""
+  Decides when a local property is actually sent. Normally, every assignment is sent on the next event loop. With a
+  policy, an assignment is only sent if some field moved further than its deadband from the last value sent;
+  Otherwise, the property is sent as a heartbeat every `heartbeat` milliseconds, whether it was reassigned or not. Keep
+  the heartbeat comfortably shorter than the receivers' data timeout, so a lost frame or two doesn't expire the data.
+  
+  Arguments
+    heartbeat - Milliseconds between sends when nothing changes
+    deadbands - A dictionary of field names (see `BaseProperty.fieldValues`) to how far that field has to move before
+      it's sent early. Fields that aren't numbers are sent whenever they change.
+    default_deadband - Deadband for numeric fields that aren't in `deadbands`. None sends any change.
+"""
+class TransmitPolicy:
+  def __init__(self, heartbeat, deadbands = None, default_deadband = None):
+    self.heartbeat = heartbeat
+    self.deadbands = {} if deadbands is None else deadbands
+    self.default_deadband = default_deadband
+  
+  # Whether `values` moved far enough from `sent` (both from `fieldValues`) to send right away
+  def hasChanged(self, sent, values):
+    if sent is None or values is None: return True
+    for (name, value) in values.items():
+      if not name in sent: return True
+      previous = sent[name]
+      deadband = self.deadbands.get(name, self.default_deadband)
+      if deadband is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+        if not value == previous: return True
+      elif abs(value - previous) > deadband: return True
+    return False
+
+# The slots `PropertyEntry` indexes like the old tuples
+ENTRY_ITEMS = ("can_id", "name", "prop", "status")
+# A registered property. The same entry is stored under its CAN ID and its name, and it's updated in place, so
+# receiving a frame doesn't allocate anything. Indexing still works like the old (CAN ID, name, property, status) tuples
+class PropertyEntry:
+  __slots__ = (
+    "can_id", "name", "prop", "status", "deadline", "update_callback", "version", "subscribers",
+    "policy", "sent_values", "sent_at", "priority", "received", "corrupt", "sent", "send_failures", "carrier",
+    "history"
+  )
+  def __init__(self, can_id, name, prop, status):
+    self.can_id = can_id
+    self.name = name
+    self.prop = prop
+    self.status = status
+    self.deadline = 0 # Ticks (see adafruit_ticks) when remote data expires. Only meaningful with REMOTE_DATA
+    self.update_callback = None # Handed to the property by `getValue`, so reads don't build a new closure
+    self.version = 0 # The registry's `version` when this property last changed
+    self.subscribers = () # Callbacks for this property. See `PropertyRegistry.subscribe`
+    self.policy = None # TransmitPolicy, if any
+    self.sent_values = None # `fieldValues` as of the last successful send (only tracked with a policy)
+    self.sent_at = None # Ticks of the last successful send (only tracked with a policy)
+    self.priority = can_id # Lower is sent first. Defaults to CAN arbitration order
+    self.carrier = None # Entry of the multiplexed property that sends this one, if any. See `addMultiplexed`
+    self.history = None # HistoryRing of received payloads, if enabled. See `enableHistory`
+    # Counters for `PropertyRegistry.getStats`
+    self.received = 0 # Frames received, including corrupt ones
+    self.corrupt = 0 # Frames that failed to decode
+    self.sent = 0
+    self.send_failures = 0
+  def __getitem__(self, i):
+    if isinstance(i, slice): return tuple(getattr(self, slot) for slot in ENTRY_ITEMS[i])
+    return getattr(self, ENTRY_ITEMS[i]) # Straight to the slot, so indexing doesn't build a tuple
+  def __len__(self): return len(ENTRY_ITEMS)
 
 # A dictionary of registered property names and types
 # Each property name is given a BaseProperty instance, which is used to track
@@ -92,27 +248,107 @@ class PropertyRegistry:
   transmitter = None # Defined in ctor
   receiver = None # Defined in ctor
   
-  properties = None
-  property_updates = None
+  properties_by_id = None # A list with a slot for every CAN ID, holding its property entry (or None)
+  properties_by_name = None # Property entries by name
+  property_names = None # Names in the order they were registered
+  property_updates = None # CAN IDs waiting to be sent
+  transmit_queue = None # A min-heap of (priority, CAN ID) for every ID in `property_updates`
+  transmit_budget_frames = None # Most frames sent per event loop, or None for no limit
+  transmit_budget_bytes = None # Most payload bytes sent per event loop, or None for no limit
+  receive_budget_frames = None # Most frames processed per event loop, or None for no limit
+  receive_budget_ms = None # Most milliseconds spent receiving per event loop, or None for no limit
+  # Whether the last event loop stopped receiving because it ran out of budget, so there could still be frames waiting
+  receive_pending = False
+  # A min-heap of (deadline, CAN ID) for remote properties, with deadlines in milliseconds after `expiry_base`. Each
+  # property has at most one item (see `expiry_queued`). Items aren't updated when a property gets newer data; Instead,
+  # the event loop checks the property's real status when its item comes up, and pushes it again if it was renewed.
   property_expiry = None
+  expiry_queued = None # CAN IDs that have an item in `property_expiry`
+  expiry_base = None # Ticks, defined in ctor
   data_timeout = None # Defined in ctor
+  # Goes up by one every time any property gets new data or changes status. See `changedSince`
+  version = 0
+  subscribers_all = () # Callbacks subscribed to every property
+  policy_entries = None # Entries that have a TransmitPolicy, which get checked for heartbeats
   
   warn_count_unknown_id = 0
   warn_count_corrupt = 0
   warn_id_local_transition = None
+  # Each kind of warning is printed at most once per `warn_interval_ms`. See `warn`
+  warn_interval_ms = 5000
+  warnings = None # Kind of warning to [ticks last printed, number held back since, total number]
+  
+  # Stats; See `getStats`
+  decode_times = None # Histogram of decode times, or None when they aren't timed
+  # Only every `decode_sample_interval`th decode is timed, since reading the clock costs about as much as a decode
+  decode_sample_interval = None # Defined in ctor
+  decode_countdown = 1 # Decodes until the next timed one
+  expiry_lag = None # Histogram of how late expiries were processed
+  unknown_ids = None # Frames received for each unregistered CAN ID
+  transmit_queue_high_water = 0 # The most properties that have been queued for sending at once
+  receive_high_water = 0 # The most frames processed in one event loop
+  stats_mark = None # (ticks, frames received for each CAN ID) as of the last `getStats`, for rates
   
   def __init__(
     self,
     data_timeout = 10000, # Interval after which data is considered expired
     transmitter = None,
-    receiver = None
+    receiver = None,
+    # Limit how much each event loop sends. Anything past the limit is sent on the next event loop, highest priority
+    # first, so a burst of updates can't overrun the CAN controller's transmit buffers
+    transmit_budget_frames = None,
+    transmit_budget_bytes = None,
+    # Limit how long each event loop keeps receiving, so a flood of frames can't keep it from returning. Frames past
+    # the limit stay with the receiver until the next event loop
+    receive_budget_frames = None,
+    receive_budget_ms = None,
+    # Time one in this many decodes for the decode time histogram (if the board has `time.monotonic_ns`). 0 turns it off
+    decode_sample_interval = 16
   ):
     self.transmitter = transmitter
     self.receiver = receiver
+    self.transmit_budget_frames = transmit_budget_frames
+    self.transmit_budget_bytes = transmit_budget_bytes
+    self.receive_budget_frames = receive_budget_frames
+    self.receive_budget_ms = receive_budget_ms
     self.data_timeout = data_timeout
-    self.properties = {}
+    self.properties_by_id = [None] * CAN_ID_COUNT
+    self.properties_by_name = {}
+    self.property_names = []
     self.property_updates = set()
+    self.transmit_queue = []
     self.property_expiry = []
+    self.expiry_queued = set()
+    self.expiry_base = ticks_ms()
+    self.policy_entries = []
+    self.warnings = {}
+    self.decode_sample_interval = decode_sample_interval
+    if decode_sample_interval and not monotonic_ns is None: self.decode_times = Histogram(DECODE_TIME_BOUNDS_NS)
+    self.expiry_lag = Histogram(EXPIRY_LAG_BOUNDS_MS)
+    self.unknown_ids = {}
+    self.stats_mark = (ticks_ms(), {})
+  
+  """
+    Print a warning, unless one of the same `kind` was printed in the last `warn_interval_ms`, in which case it's just
+    counted; The next one printed says how many were held back. `message` is only formatted (with `args`, and the
+    traceback of `exception`) when it's printed, so warnings are cheap on a noisy bus.
+  """
+  def warn(self, kind, message, *args, exception = None):
+    now = ticks_ms()
+    warning = self.warnings.get(kind)
+    if warning is None:
+      warning = [ticks_add(now, -self.warn_interval_ms), 0, 0]
+      self.warnings[kind] = warning
+    warning[2] += 1
+    if ticks_diff(now, warning[0]) < self.warn_interval_ms:
+      warning[1] += 1
+      return
+    text = message.format(*args)
+    if not exception is None: text += " " + str(traceback.format_exception(exception))
+    if warning[1]: text += " ({:d} more since the last one)".format(warning[1])
+    warning[0] = now
+    warning[1] = 0
+    print("WARN:", text)
   
   def flushWarnings(self):
     warnings = {
@@ -125,15 +361,75 @@ class PropertyRegistry:
     self.warn_id_local_transition = None
     return warnings
   
+  """
+    Get a dictionary of stats:
+      properties - For each property by name: Frames `received` (and `rate`, per second since the last `getStats`),
+        `corrupt` frames, frames `sent` and `send_failures`
+      unknown_ids - Frames received for each unregistered CAN ID
+      decode_ns - A histogram of how long decoding took (see `Histogram.toDict`), or None if decodes aren't timed
+      expiry_lag_ms - A histogram of how long after their deadline expiries were processed
+      transmit_queue, expiry_queue - How many properties are waiting to be sent / to expire, and `*_high_water` the most
+        there have been since `resetStats`
+      receive_high_water - The most frames processed by one event loop
+      warnings - The number of warnings of each kind, including the ones that weren't printed
+      receiver - The receiver's own stats, if it has a `getStats` method
+    Counting is always on and only costs a few increments per frame. Decodes are timed by sampling (see
+    `decode_sample_interval`), so the histogram shows the spread of decode times, but not every decode.
+  """
+  def getStats(self):
+    now = ticks_ms()
+    (mark, last_received) = self.stats_mark
+    elapsed = ticks_diff(now, mark) / 1000
+    received = {}
+    properties = {}
+    for name in self.property_names:
+      prop_entry = self.properties_by_name[name]
+      received[prop_entry.can_id] = prop_entry.received
+      count = prop_entry.received - last_received.get(prop_entry.can_id, 0)
+      properties[name] = {
+        "received": prop_entry.received,
+        "rate": count / elapsed if elapsed > 0 else None,
+        "corrupt": prop_entry.corrupt,
+        "sent": prop_entry.sent,
+        "send_failures": prop_entry.send_failures
+      }
+    self.stats_mark = (now, received)
+    return {
+      "properties": properties,
+      "unknown_ids": dict(self.unknown_ids),
+      "decode_ns": None if self.decode_times is None else self.decode_times.toDict(),
+      "expiry_lag_ms": self.expiry_lag.toDict(),
+      "transmit_queue": len(self.transmit_queue),
+      "transmit_queue_high_water": self.transmit_queue_high_water,
+      "expiry_queue": len(self.property_expiry),
+      "receive_high_water": self.receive_high_water,
+      "warnings": { kind: warning[2] for (kind, warning) in self.warnings.items() },
+      "receiver": self.receiver.getStats() if hasattr(self.receiver, "getStats") else None
+    }
+  # Zero every counter and histogram in `getStats`
+  def resetStats(self):
+    for name in self.property_names:
+      prop_entry = self.properties_by_name[name]
+      prop_entry.received = 0
+      prop_entry.corrupt = 0
+      prop_entry.sent = 0
+      prop_entry.send_failures = 0
+    self.unknown_ids = {}
+    if not self.decode_times is None: self.decode_times.reset()
+    self.expiry_lag.reset()
+    self.transmit_queue_high_water = len(self.transmit_queue)
+    self.receive_high_water = 0
+    for warning in self.warnings.values(): warning[2] = 0
+    self.stats_mark = (ticks_ms(), {})
+  
   # See `addProperty` for usage
   def setPropEntry(self, prop_entry):
-    # The map is done by CAN ID and name, both stored in the same map
-    self.properties[prop_entry[0]] = prop_entry
-    self.properties[prop_entry[1]] = prop_entry
+    # The same entry is indexed by CAN ID and by name
+    self.properties_by_id[prop_entry.can_id] = prop_entry
+    if not prop_entry.name in self.properties_by_name: self.property_names.append(prop_entry.name)
+    self.properties_by_name[prop_entry.name] = prop_entry
   def updatePropStatus(self, prop_entry, status):
-    if prop_entry in self.property_expiry: self.property_expiry.remove(prop_entry)
-    prop_entry = prop_entry[:3] + (status,)
-    self.setPropEntry(prop_entry)
+    prop_entry.status = status
     return prop_entry
   
   # Register a new property
@@ -142,115 +438,339 @@ class PropertyRegistry:
       raise Exception("Provided CAN ID is not a valid 11-bit CAN identifier. It might be too big")
     if not isinstance(name, str):
       raise Exception("Provided name is not a string")
-    if can_id in self.properties:
+    if not self.properties_by_id[can_id] is None:
       raise Exception("Provided CAN ID is already registered")
-    if name in self.properties:
+    if name in self.properties_by_name:
       raise Exception("Provided name is already registered")
     if not isinstance(prop, BaseProperty):
       raise Exception("Provided property is not an instance of BaseProperty")
     
-    self.setPropEntry((can_id, name, prop, NoDataStatus()))
+    prop_entry = PropertyEntry(can_id, name, prop, NO_DATA)
+    prop_entry.update_callback = lambda: self.flagLocalPropertyUpdate(prop_entry)
+    self.setPropEntry(prop_entry)
+  
+  """
+    Register a multiplexed property, which sends several small properties in one CAN frame. `groups` is a list of
+    lists of names of properties that are already registered: Each list (a group) goes in one frame, with the group's
+    index as the selector. See `multiplexed.MultiplexedProperty` for the format.
+
+    The properties keep their own names, CAN IDs, statuses and expiry, and are still received if they're sent on their
+    own ID, but this registry only sends them through the multiplexed property. Their CAN IDs never go on the wire.
+  """
+  def addMultiplexed(self, can_id, name, groups):
+    from .multiplexed import MultiplexedProperty
+    prop = MultiplexedProperty(self, groups) # Checks the groups
+    self.addProperty(can_id, name, prop)
+    carrier = self.getPropEntry(name)
+    for prop_entry in prop.entries: prop_entry.carrier = carrier
   
+  """
+    Keep the last `capacity` payloads received for a property, with when they arrived, and return the
+    `history.HistoryRing` they're kept in. Only received data is recorded. Calling it again starts a new, empty history.
+  """
+  def enableHistory(self, name_or_can_id, capacity):
+    from .history import HistoryRing
+    prop_entry = self.getPropEntry(name_or_can_id)
+    prop_entry.history = HistoryRing(capacity, prop_entry.prop)
+    return prop_entry.history
+  def getHistory(self, name_or_can_id): return self.getPropEntry(name_or_can_id).history
+  
+  # Look up a property entry by name or CAN ID. Returns None if there isn't one
+  def findPropEntry(self, name_or_can_id):
+    if isinstance(name_or_can_id, str): return self.properties_by_name.get(name_or_can_id)
+    if isinstance(name_or_can_id, int) and not name_or_can_id >> 11: return self.properties_by_id[name_or_can_id]
+    return None
   def getPropEntry(self, name_or_can_id):
-    if not name_or_can_id in self.properties:
-      raise Exception("Property " + str(name_or_can_id) + " not found")
-    return self.properties[name_or_can_id]
+    prop_entry = self.findPropEntry(name_or_can_id)
+    if prop_entry is None: raise Exception("Property " + str(name_or_can_id) + " not found")
+    return prop_entry
   
   # Marks a proprety as local and flag it for sending
   def flagLocalPropertyUpdate(self, prop_entry):
-    prop_entry = self.properties[prop_entry[0]] # Get the latest prop entry
-    self.property_updates.add(prop_entry)
-    self.updatePropStatus(prop_entry, LocalDataStatus())
+    self.queueTransmit(prop_entry)
+    if not prop_entry.status is LOCAL_DATA: self.updatePropStatus(prop_entry, LOCAL_DATA)
+    self.propertyChanged(prop_entry)
+  
+  """
+    Call `callback(name, status)` whenever a property gets new data (received or assigned locally), expires, or
+    receives a corrupt frame. Pass None instead of a name or CAN ID to subscribe to every property. Callbacks run
+    inside `receive`/`eventLoop`/assignments, so keep them short: Note what changed and do the real work later.
+  """
+  def subscribe(self, name_or_can_id, callback):
+    # Subscriber lists are tuples, so callbacks can safely (un)subscribe while they're being called
+    if name_or_can_id is None: self.subscribers_all = self.subscribers_all + (callback,)
+    else:
+      prop_entry = self.getPropEntry(name_or_can_id)
+      prop_entry.subscribers = prop_entry.subscribers + (callback,)
+  def unsubscribe(self, name_or_can_id, callback):
+    def without(subscribers): return tuple(c for c in subscribers if not c == callback)
+    if name_or_can_id is None: self.subscribers_all = without(self.subscribers_all)
+    else:
+      prop_entry = self.getPropEntry(name_or_can_id)
+      prop_entry.subscribers = without(prop_entry.subscribers)
+  
+  # Names of the properties that changed after `version` (a previous value of `registry.version`), in order
+  def changedSince(self, version):
+    return [name for name in self.property_names if self.properties_by_name[name].version > version]
+  
+  # Record that a property got new data or a new status, and tell its subscribers
+  def propertyChanged(self, prop_entry):
+    self.version += 1
+    prop_entry.version = self.version
+    if prop_entry.subscribers: self.notifySubscribers(prop_entry.subscribers, prop_entry)
+    if self.subscribers_all: self.notifySubscribers(self.subscribers_all, prop_entry)
+  def notifySubscribers(self, subscribers, prop_entry):
+    for callback in subscribers:
+      try: callback(prop_entry.name, prop_entry.status)
+      except Exception as e: self.warn("subscriber", "Exception in subscriber for {}:", prop_entry.name, exception = e)
+  
+  # Queue a property to be sent. It's queued by CAN ID, so a property is only sent once however often it's queued
+  def queueTransmit(self, prop_entry):
+    if not prop_entry.carrier is None:
+      # Sent in its multiplexed property's frame instead
+      prop_entry.carrier.prop.markPending(prop_entry)
+      prop_entry = prop_entry.carrier
+      if not prop_entry.status is LOCAL_DATA: self.updatePropStatus(prop_entry, LOCAL_DATA)
+    if prop_entry.can_id in self.property_updates: return
+    self.property_updates.add(prop_entry.can_id)
+    heappush(self.transmit_queue, (prop_entry.priority, prop_entry.can_id))
+    if len(self.transmit_queue) > self.transmit_queue_high_water:
+      self.transmit_queue_high_water = len(self.transmit_queue)
+  
+  # Set the order queued properties are sent in: Lower priorities go first. By default, the priority is the CAN ID.
+  def setTransmitPriority(self, name_or_can_id, priority):
+    prop_entry = self.getPropEntry(name_or_can_id)
+    prop_entry.priority = priority
+    if prop_entry.can_id in self.property_updates:
+      # Requeue it with the new priority
+      self.transmit_queue[:] = [item for item in self.transmit_queue if not item[1] == prop_entry.can_id]
+      heapify(self.transmit_queue)
+      self.property_updates.discard(prop_entry.can_id)
+      self.queueTransmit(prop_entry)
+  
+  # Set how a local property is sent; See `TransmitPolicy`. Pass None to send every update again.
+  def setTransmitPolicy(self, name_or_can_id, policy):
+    prop_entry = self.getPropEntry(name_or_can_id)
+    if not prop_entry.carrier is None:
+      raise Exception("Property " + prop_entry.name + " is sent by " + prop_entry.carrier.name + "; Set the policy there")
+    prop_entry.policy = policy
+    prop_entry.sent_values = None
+    prop_entry.sent_at = None
+    if policy is None:
+      if prop_entry in self.policy_entries: self.policy_entries.remove(prop_entry)
+    elif not prop_entry in self.policy_entries: self.policy_entries.append(prop_entry)
   
   def getStatus(self, name_or_can_id):
-    if not name_or_can_id in self.properties: return None
-    return self.properties[name_or_can_id][3]
+    prop_entry = self.findPropEntry(name_or_can_id)
+    return None if prop_entry is None else prop_entry.status
+  # When a remote property's data expires, as an Instant. None if the property doesn't have remote data.
+  def getExpiry(self, name_or_can_id):
+    prop_entry = self.findPropEntry(name_or_can_id)
+    if prop_entry is None or not prop_entry.status is REMOTE_DATA: return None
+    return Instant(prop_entry.deadline)
   
   def __getitem__(self, name_or_can_id):
     prop_entry = self.getPropEntry(name_or_can_id)
-    if prop_entry[3].isValid():
-      return prop_entry[2].getValue(lambda: self.flagLocalPropertyUpdate(prop_entry))
+    if prop_entry.status.isValid(): return prop_entry.prop.getValue(prop_entry.update_callback)
     return None
   
   def __setitem__(self, name_or_can_id, value):
     prop_entry = self.getPropEntry(name_or_can_id)
-    if prop_entry[2].setValue(value): # Assign the value change
+    if prop_entry.prop.setValue(value): # Assign the value change
       self.flagLocalPropertyUpdate(prop_entry) # Record the update for sending
-      self.updatePropStatus(prop_entry, LocalDataStatus())
   
-  def __iter__(self):
-    return filter(lambda s: isinstance(s, str), self.properties.keys())
+  def __iter__(self): return iter(self.property_names)
   
   # Process an incoming packet
   def receive(self, can_id, msg):
-    if not can_id in self.properties:
+    prop_entry = None if can_id >> 11 else self.properties_by_id[can_id] # Extended IDs are never registered
+    if prop_entry is None:
       self.warn_count_unknown_id += 1
-      print("WARN: Received packet with unknown ID 0x{:03X}".format(can_id))
+      key = can_id if can_id in self.unknown_ids or len(self.unknown_ids) < UNKNOWN_ID_LIMIT else None
+      self.unknown_ids[key] = self.unknown_ids.get(key, 0) + 1
+      self.warn("unknown_id", "Received packet with unknown ID 0x{:03X}", can_id)
       return False
     
-    prop_entry = self.properties[can_id]
-    def deserialize():
-      try: return prop_entry[2].deserializeValue(msg)
-      except Exception as e:
-        print("WARN: Exception in deserialize:", traceback.format_exception(e))
-        return False
-    if not deserialize():
+    prop_entry.received += 1
+    self.decode_countdown -= 1
+    if not self.decode_countdown: ok = self.timedDecode(prop_entry, msg)
+    else:
+      try: ok = prop_entry.prop.deserializeValue(msg)
+      except Exception as e: ok = self.decodeException(can_id, e)
+    if not ok:
       self.warn_count_corrupt += 1
-      print("WARN: Failed to decode packet with ID 0x{:03x}".format(can_id))
-      self.updatePropStatus(prop_entry, ErrorStatus())
+      prop_entry.corrupt += 1
+      self.warn("corrupt", "Failed to decode packet with ID 0x{:03X}", can_id)
+      self.updatePropStatus(prop_entry, ERROR)
+      self.propertyChanged(prop_entry)
       return False
     
-    if isinstance(prop_entry[3], LocalDataStatus):
+    if prop_entry.status is LOCAL_DATA:
       self.warn_id_local_transition = prop_entry
-      print("WARN: Transitioning from local to remote data. Somebody is using a duplicate ID.")
+      self.warn(
+        "local_transition",
+        "Transitioning from local to remote data for ID 0x{:03X}. Somebody is using a duplicate ID.",
+        can_id
+      )
     
-    prop_entry = self.updatePropStatus(
-      prop_entry,
-      RemoteDataStatus(Instant() + self.data_timeout)
-    )
-    self.property_expiry.append(prop_entry)
+    now = ticks_ms()
+    prop_entry.deadline = ticks_add(now, self.data_timeout)
+    if not prop_entry.history is None: prop_entry.history.record(now, msg)
+    if not prop_entry.status is REMOTE_DATA: self.updatePropStatus(prop_entry, REMOTE_DATA)
+    self.propertyChanged(prop_entry)
+    # Deadlines only move later, so a property that's already queued will be pushed again when its old item comes up
+    if not can_id in self.expiry_queued:
+      self.expiry_queued.add(can_id)
+      heappush(self.property_expiry, (ticks_diff(prop_entry.deadline, self.expiry_base), can_id))
     return True
   
-  # Transmit queued updates, remove expired remote properties, and process received messages in the queue
+  """
+    Restore remote data saved earlier (see snapshot.py), as if `msg` had just been received, but expiring after
+    `remaining_ms`. Only properties that don't have any data yet are restored, so nothing newer gets overwritten.
+    Returns whether it was restored.
+  """
+  def restoreRemote(self, prop_entry, msg, remaining_ms):
+    if not prop_entry.status is NO_DATA or remaining_ms <= 0: return False
+    try:
+      if not prop_entry.prop.deserializeValue(msg): return False
+    except Exception: return False
+    prop_entry.deadline = ticks_add(ticks_ms(), remaining_ms)
+    self.updatePropStatus(prop_entry, REMOTE_DATA)
+    self.propertyChanged(prop_entry)
+    # It had no data, so it can't be queued already
+    self.expiry_queued.add(prop_entry.can_id)
+    heappush(self.property_expiry, (ticks_diff(prop_entry.deadline, self.expiry_base), prop_entry.can_id))
+    return True
+  
+  # Decode a frame like `receive` does, and add how long it took to `decode_times`
+  def timedDecode(self, prop_entry, msg):
+    # With sampling off, this only comes up once in a billion frames
+    self.decode_countdown = self.decode_sample_interval or 0x3FFFFFFF
+    if self.decode_times is None: start = None
+    else: start = monotonic_ns()
+    try: ok = prop_entry.prop.deserializeValue(msg)
+    except Exception as e: ok = self.decodeException(prop_entry.can_id, e)
+    if not start is None: self.decode_times.add(monotonic_ns() - start)
+    return ok
+  def decodeException(self, can_id, e):
+    self.warn("deserialize", "Exception in deserialize for ID 0x{:03X}:", can_id, exception = e)
+    return False
+  
+  # Move `expiry_base` up to `now`. Every key shifts by the same amount, so the heap stays in order
+  def rebaseExpiry(self, now):
+    offset = ticks_diff(now, self.expiry_base)
+    self.property_expiry[:] = [(deadline - offset, can_id) for (deadline, can_id) in self.property_expiry]
+    self.expiry_base = now
+  
+  # Send a property's serialized `payload` now. With a transmit policy, `values` and `now` record what was sent and when
+  def transmitEntry(self, prop_entry, payload, values = None, now = None):
+    try: sent = self.transmitter.send(prop_entry.can_id, payload)
+    except Exception as e:
+      self.warn("send_exception", "Exception in transmitter send:", exception = e)
+      sent = False
+    if not sent:
+      prop_entry.send_failures += 1
+      self.warn("send", "Failed to send updates for {}", prop_entry.name)
+      return sent
+    prop_entry.sent += 1
+    if not prop_entry.policy is None:
+      prop_entry.sent_values = values
+      prop_entry.sent_at = now
+    if prop_entry.prop.valueSent(): self.queueTransmit(prop_entry)
+    return sent
+  
+  """
+    Transmit queued updates, remove expired remote properties, and process received messages in the queue. Returns True
+    if receiving stopped because of `receive_budget_frames` or `receive_budget_ms`, in which case there may be more
+    frames waiting: Call it again soon.
+  """
   def eventLoop(self):
-    def send(prop):
-      try: return self.transmitter.send(prop[0], prop[2].serializeValue())
-      except Exception as e:
-        print("WARN: Exception in transmitter send:", traceback.format_exception(e))
-        return False
-    
+    now = ticks_ms()
     if not self.transmitter is None:
-      while self.property_updates:
-        prop = self.property_updates.pop()
-        if not send(prop): print("WARN: Failed to send updates for", prop[1])
+      # Heartbeats go through the queue too, so they're sent in priority order and count towards the budget
+      for prop in self.policy_entries:
+        if not prop.status is LOCAL_DATA: continue
+        if prop.sent_at is None or ticks_diff(now, prop.sent_at) >= prop.policy.heartbeat: self.queueTransmit(prop)
+      
+      budget_frames = self.transmit_budget_frames
+      budget_bytes = self.transmit_budget_bytes
+      frames = 0
+      sent_bytes = 0
+      queue = self.transmit_queue
+      updates = self.property_updates
+      properties_by_id = self.properties_by_id
+      while queue:
+        if not budget_frames is None and frames >= budget_frames: break
+        prop = properties_by_id[queue[0][1]]
+        values = None
+        if not prop.policy is None:
+          values = prop.prop.fieldValues()
+          # Changes inside the deadband wait for the heartbeat
+          if not (
+            prop.sent_at is None or ticks_diff(now, prop.sent_at) >= prop.policy.heartbeat
+            or prop.policy.hasChanged(prop.sent_values, values)
+          ):
+            heappop(queue)
+            updates.discard(prop.can_id)
+            continue
+        payload = prop.prop.serializeValue()
+        # Anything over the byte budget waits for the next event loop, but a single frame always gets through
+        if frames and not budget_bytes is None and sent_bytes + len(payload) > budget_bytes: break
+        heappop(queue)
+        updates.discard(prop.can_id)
+        self.transmitEntry(prop, payload, values, now)
+        frames += 1
+        sent_bytes += len(payload)
     
     # Iterate over recent expiries, stop when there's nothing else to expire
-    while len(self.property_expiry) and self.property_expiry[0][3].expiry() <= Instant():
-      entry = self.property_expiry.pop(0)
-      # Double check that nothing has changed since this entry: Get the newest version
-      entry = self.properties[entry[0]]
-      if not entry[3].expiry() is None and entry[3].expiry() <= Instant():
-        self.updatePropStatus(entry, ExpiredStatus())
+    elapsed = ticks_diff(now, self.expiry_base)
+    if elapsed > EXPIRY_REBASE_INTERVAL:
+      self.rebaseExpiry(now)
+      elapsed = 0
+    expiry = self.property_expiry
+    while expiry and expiry[0][0] <= elapsed:
+      can_id = heappop(expiry)[1]
+      # Double check that nothing has changed since this entry was queued
+      entry = self.properties_by_id[can_id]
+      if not entry.status is REMOTE_DATA: self.expiry_queued.discard(can_id)
+      elif ticks_diff(entry.deadline, now) <= 0:
+        self.expiry_queued.discard(can_id)
+        self.expiry_lag.add(ticks_diff(now, entry.deadline))
+        self.updatePropStatus(entry, EXPIRED)
+        self.propertyChanged(entry)
+      else: heappush(expiry, (ticks_diff(entry.deadline, self.expiry_base), can_id)) # Renewed since it was queued
     
     # Process received packets
     def receive():
       try: return self.receiver.receive()
       except Exception as e:
-        print("WARN: Exception in receiver receive:", traceback.format_exception(e))
+        self.warn("receiver", "Exception in receiver receive:", exception = e)
         return None
+    self.receive_pending = False
     if not self.receiver is None:
-      while not (packet := receive()) is None:
+      budget_frames = self.receive_budget_frames
+      budget_ms = self.receive_budget_ms
+      frames = 0
+      start = ticks_ms()
+      while True:
+        if (
+          (not budget_frames is None and frames >= budget_frames)
+          or (not budget_ms is None and ticks_diff(ticks_ms(), start) >= budget_ms)
+        ):
+          self.receive_pending = True
+          break
+        packet = receive()
+        if packet is None: break
+        frames += 1
         try: self.receive(packet[0], packet[1])
-        except Exception as e:
-          print(
-            "WARN: Exception processing packet with ID 0x{:03X}".format(packet[0]),
-            traceback.format_exception(e)
-          )
+        except Exception as e: self.warn("packet", "Exception processing packet with ID 0x{:03X}:", packet[0], exception = e)
+      if frames > self.receive_high_water: self.receive_high_water = frames
+    return self.receive_pending
   
   def __str__(self):
     def formatProp(propname):
-      prop = self.properties[propname]
-      return '"{}" ({}) - {}'.format(propname, str(prop[3]), str(prop[2]))
+      prop = self.properties_by_name[propname]
+      return '"{}" ({}) - {}'.format(propname, str(prop.status), str(prop.prop))
     return '\n'.join(map(formatProp, self))
 
 if __name__ == "__main__":
@@ -365,6 +885,303 @@ if __name__ == "__main__":
     assert(isinstance(pr.getStatus(0), RemoteDataStatus))
     assert(not pr.warn_id_local_transition is None)
   
+  @test
+  def PropertyReceiveRenewsExpiry():
+    pr = PropertyRegistry(data_timeout=100)
+    pr.addProperty(0, "test", StructProperty(">B"))
+    pr.addProperty(1, "other", StructProperty(">B"))
+    pr.receive(0, bytearray((1,)))
+    pr.receive(1, bytearray((1,)))
+    time.sleep(0.06)
+    pr.receive(0, bytearray((2,))) # Renewed, so this one should outlive "other"
+    assert(len(pr.property_expiry) == 2) # Still only one item per property
+    time.sleep(0.06)
+    pr.eventLoop()
+    assert(isinstance(pr.getStatus(0), RemoteDataStatus))
+    assert(isinstance(pr.getStatus(1), ExpiredStatus))
+    assert(len(pr.property_expiry) == 1)
+    time.sleep(0.06)
+    pr.eventLoop()
+    assert(isinstance(pr.getStatus(0), ExpiredStatus))
+    assert(len(pr.property_expiry) == 0 and len(pr.expiry_queued) == 0)
+  @test
+  def PropertyExpiryDropsLocal():
+    pr = PropertyRegistry(data_timeout=50)
+    pr.addProperty(0, "test", StructProperty(">B"))
+    pr.receive(0, bytearray((1,)))
+    pr["test"] = 5
+    time.sleep(0.06)
+    pr.eventLoop()
+    assert(isinstance(pr.getStatus(0), LocalDataStatus))
+    assert(len(pr.property_expiry) == 0 and len(pr.expiry_queued) == 0)
+  @test
+  def PropertyExpiryRebase():
+    pr = PropertyRegistry(data_timeout=100)
+    pr.addProperty(0, "test", StructProperty(">B"))
+    # Pretend the registry has been up for a while
+    pr.expiry_base = ticks_add(pr.expiry_base, -EXPIRY_REBASE_INTERVAL - 1000)
+    pr.receive(0, bytearray((1,)))
+    pr.eventLoop()
+    assert(pr.property_expiry[0][0] <= 100)
+    assert(isinstance(pr.getStatus(0), RemoteDataStatus))
+    time.sleep(0.1)
+    pr.eventLoop()
+    assert(isinstance(pr.getStatus(0), ExpiredStatus))
+  @test
+  def PropertyEntriesUpdatedInPlace():
+    pr = PropertyRegistry(data_timeout=50)
+    pr.addProperty(3, "test", StructProperty(">B"))
+    entry = pr.getPropEntry("test")
+    assert(pr.getPropEntry(3) is entry)
+    assert(entry[0] == 3 and entry[1] == "test" and entry[3] is NO_DATA) # Still indexes like a tuple
+    (can_id, name, prop, status) = entry
+    assert(can_id == 3 and entry[-1] is NO_DATA and entry[1:3] == ("test", prop) and len(entry) == 4)
+    pr.receive(3, bytearray((1,)))
+    assert(pr.getPropEntry(3) is entry and entry.status is REMOTE_DATA)
+    expiry = pr.getExpiry("test")
+    assert(0 < expiry - Instant() <= 50)
+    pr.receive(3, bytearray((2,)))
+    assert(entry.status is REMOTE_DATA and pr.getExpiry("test") >= expiry)
+    pr["test"] = (4,)
+    assert(entry.status is LOCAL_DATA and pr.getExpiry("test") is None)
+    pr.receive(3, bytearray())
+    assert(entry.status is ERROR and isinstance(pr.getStatus("test"), ErrorStatus))
+  @test
+  def PropertyIndexes():
+    pr = PropertyRegistry()
+    pr.addProperty(0x7FF, "last", BaseProperty())
+    pr.addProperty(0, "first", BaseProperty())
+    pr.addProperty(5, "middle", BaseProperty())
+    assert(list(pr) == ["last", "first", "middle"]) # In the order they were added
+    assert(pr.getPropEntry(5) is pr.getPropEntry("middle"))
+    assert(pr.findPropEntry(6) is None and pr.findPropEntry("none") is None and pr.findPropEntry(-1) is None)
+    assert(pr.getStatus(0x800) is None)
+    assert(not pr.receive(0x1FFFF, bytearray())) # Extended ID
+    assert(not pr.receive(6, bytearray()))
+    assert(pr.warn_count_unknown_id == 2)
+  @test
+  def SubscribersSeeChanges():
+    pr = PropertyRegistry(data_timeout=50)
+    pr.addProperty(0, "a", StructProperty(">B"))
+    pr.addProperty(1, "b", StructProperty(">B"))
+    seen_a = []
+    seen_all = []
+    def onA(name, status): seen_a.append((name, str(status)))
+    pr.subscribe("a", onA)
+    pr.subscribe(None, lambda name, status: seen_all.append((name, str(status))))
+    start = pr.version
+    pr.receive(0, bytearray((1,)))
+    pr.receive(0, bytearray((2,)))
+    pr["b"] = (3,)
+    pr.receive(0, bytearray())
+    assert(seen_a == [("a", "REMOTE"), ("a", "REMOTE"), ("a", "REMOTE/ERROR")])
+    assert(seen_all == [("a", "REMOTE"), ("a", "REMOTE"), ("b", "LOCAL"), ("a", "REMOTE/ERROR")])
+    assert(pr.changedSince(start) == ["a", "b"])
+    version = pr.version
+    assert(pr.changedSince(version) == [])
+    pr.receive(1, bytearray((4,)))
+    time.sleep(0.06)
+    pr.eventLoop()
+    assert(seen_all[-1] == ("b", "REMOTE/EXPIRED"))
+    assert(pr.changedSince(version) == ["b"])
+    pr.unsubscribe("a", onA)
+    pr.receive(0, bytearray((5,)))
+    assert(len(seen_a) == 3 and seen_all[-1] == ("a", "REMOTE"))
+  @test
+  def SubscriberErrorsAreContained():
+    pr = PropertyRegistry()
+    pr.addProperty(0, "a", StructProperty(">B"))
+    def broken(name, status): raise ValueError("oops")
+    pr.subscribe("a", broken)
+    assert(pr.receive(0, bytearray((1,))))
+    assert(isinstance(pr.getStatus("a"), RemoteDataStatus))
+  class RecordingTransmitter(Transmitter):
+    def __init__(self): self.sent = []
+    def send(self, can_id, msg):
+      self.sent.append((can_id, bytes(msg)))
+      return True
+  @test
+  def TransmitPolicyDeadband():
+    txn = RecordingTransmitter()
+    pr = PropertyRegistry(transmitter=txn)
+    pr.addProperty(0, "test", StructProperty(">hB"))
+    pr.setTransmitPolicy("test", TransmitPolicy(60000, deadbands = { 0: 10 }))
+    pr["test"] = (100, 1)
+    pr.eventLoop()
+    assert(len(txn.sent) == 1) # The first value is always sent
+    pr["test"] = (105, 1)
+    pr.eventLoop()
+    pr["test"] = (90, 1) # Still within 10 of the last value sent
+    pr.eventLoop()
+    assert(len(txn.sent) == 1)
+    pr["test"] = (111, 1)
+    pr.eventLoop()
+    assert(txn.sent[-1] == (0, struct.pack(">hB", 111, 1)))
+    pr["test"] = (111, 2) # No deadband: Any change is sent
+    pr.eventLoop()
+    assert(len(txn.sent) == 3)
+  @test
+  def TransmitPolicyHeartbeat():
+    txn = RecordingTransmitter()
+    pr = PropertyRegistry(transmitter=txn)
+    pr.addProperty(0, "test", StructProperty(">B"))
+    pr.addProperty(1, "remote", StructProperty(">B"))
+    pr.setTransmitPolicy("test", TransmitPolicy(50, default_deadband = 5))
+    pr.setTransmitPolicy("remote", TransmitPolicy(50))
+    pr["test"] = (1,)
+    pr.receive(1, bytearray((1,)))
+    pr.eventLoop()
+    pr["test"] = (2,)
+    pr.eventLoop()
+    assert(txn.sent == [(0, bytes((1,)))])
+    time.sleep(0.06)
+    pr.eventLoop() # Not reassigned, but the heartbeat sends the latest value. Remote properties are never sent
+    assert(txn.sent == [(0, bytes((1,))), (0, bytes((2,)))])
+    pr.eventLoop()
+    assert(len(txn.sent) == 2)
+    pr.setTransmitPolicy("test", None)
+    pr["test"] = (2,)
+    pr.eventLoop()
+    assert(len(txn.sent) == 3)
+  @test
+  def TransmitQueueOrdersByPriority():
+    txn = RecordingTransmitter()
+    pr = PropertyRegistry(transmitter=txn)
+    for can_id in (5, 1, 9, 3): pr.addProperty(can_id, "p" + str(can_id), StructProperty(">B"))
+    pr.setTransmitPriority("p9", -1) # Like a status property
+    for can_id in (5, 1, 9, 3): pr[can_id] = (can_id,)
+    pr["p5"] = (6,) # Queued twice, sent once
+    pr.eventLoop()
+    assert([can_id for (can_id, msg) in txn.sent] == [9, 1, 3, 5])
+    assert(txn.sent[-1][1] == bytes((6,)))
+    assert(not pr.property_updates and not pr.transmit_queue)
+  @test
+  def TransmitBudgetCarriesOver():
+    txn = RecordingTransmitter()
+    pr = PropertyRegistry(transmitter=txn, transmit_budget_frames=2, transmit_budget_bytes=5)
+    for can_id in range(4): pr.addProperty(can_id, "p" + str(can_id), StructProperty(">H"))
+    for can_id in (3, 2, 1, 0): pr[can_id] = (can_id,)
+    pr.eventLoop()
+    assert([can_id for (can_id, msg) in txn.sent] == [0, 1])
+    pr["p3"] = (7,)
+    pr.setTransmitPriority("p3", -1)
+    pr.eventLoop() # The urgent one jumps the queue
+    assert([can_id for (can_id, msg) in txn.sent] == [0, 1, 3, 2])
+    pr.eventLoop()
+    assert([can_id for (can_id, msg) in txn.sent] == [0, 1, 3, 2])
+    pr.transmit_budget_bytes = 1 # Smaller than any frame, but one still gets through each loop
+    pr["p0"] = (1,)
+    pr["p1"] = (1,)
+    pr.eventLoop()
+    assert(len(txn.sent) == 5)
+    pr.eventLoop()
+    assert(len(txn.sent) == 6)
+    pr.transmit_budget_frames = None # Only the byte budget
+    for can_id in range(4): pr[can_id] = (can_id,)
+    pr.eventLoop()
+    assert(len(txn.sent) == 7)
+  class FloodReceiver(Receiver):
+    def __init__(self, count, delay = 0):
+      self.count = count
+      self.delay = delay
+    def receive(self):
+      if not self.count: return None
+      self.count -= 1
+      if self.delay: time.sleep(self.delay)
+      return (0, bytearray((self.count & 0xFF,)))
+  @test
+  def ReceiveBudgetFrames():
+    rxn = FloodReceiver(25)
+    pr = PropertyRegistry(receiver=rxn, receive_budget_frames=10)
+    pr.addProperty(0, "test", StructProperty(">B"))
+    assert(pr.eventLoop() and pr.receive_pending and rxn.count == 15)
+    assert(pr.eventLoop() and rxn.count == 5)
+    assert(not pr.eventLoop() and not pr.receive_pending and rxn.count == 0)
+  @test
+  def ReceiveBudgetTime():
+    rxn = FloodReceiver(1000, 0.002)
+    pr = PropertyRegistry(receiver=rxn, receive_budget_ms=20)
+    pr.addProperty(0, "test", StructProperty(">B"))
+    start = time.monotonic()
+    assert(pr.eventLoop())
+    assert(time.monotonic() - start < 0.2 and 0 < 1000 - rxn.count < 100)
+  @test
+  def ReceiveUnlimited():
+    rxn = FloodReceiver(25)
+    pr = PropertyRegistry(receiver=rxn)
+    pr.addProperty(0, "test", StructProperty(">B"))
+    assert(not pr.eventLoop() and rxn.count == 0)
+  @test
+  def StatsCountFrames():
+    pr = PropertyRegistry(data_timeout=10)
+    pr.addProperty(0, "a", StructProperty(">B"))
+    pr.addProperty(1, "b", StructProperty(">B"))
+    for _ in range(3): pr.receive(0, bytearray((1,)))
+    pr.receive(1, bytearray())
+    pr.receive(5, bytearray())
+    pr.receive(5, bytearray())
+    time.sleep(0.02)
+    pr.eventLoop()
+    stats = pr.getStats()
+    assert(stats["properties"]["a"]["received"] == 3 and stats["properties"]["a"]["rate"] > 0)
+    assert(stats["properties"]["b"]["received"] == 1 and stats["properties"]["b"]["corrupt"] == 1)
+    assert(stats["unknown_ids"] == { 5: 2 })
+    assert(stats["expiry_lag_ms"]["count"] == 1)
+    assert(stats["decode_ns"] is None or stats["decode_ns"]["count"] == 1) # Timed the first, then every 16th
+    assert(stats["warnings"] == { "corrupt": 1, "unknown_id": 2 })
+    # Rates only count frames since the last `getStats`
+    assert(pr.getStats()["properties"]["a"]["rate"] in (0, None))
+    pr.resetStats()
+    assert(pr.getStats()["properties"]["a"]["received"] == 0 and pr.getStats()["warnings"]["unknown_id"] == 0)
+  @test
+  def StatsCountSends():
+    txn = RecordingTransmitter()
+    pr = PropertyRegistry(transmitter=txn)
+    pr.addProperty(0, "a", StructProperty(">B"))
+    pr.addProperty(1, "b", StructProperty(">B"))
+    pr["a"] = (1,)
+    pr["b"] = (2,)
+    pr.eventLoop()
+    stats = pr.getStats()
+    assert(stats["properties"]["a"]["sent"] == 1 and stats["properties"]["b"]["sent"] == 1)
+    assert(stats["transmit_queue"] == 0 and stats["transmit_queue_high_water"] == 2)
+  @test
+  def StatsCountSendFailures():
+    class FailingTransmitter(Transmitter):
+      def send(self, can_id, msg): return False
+    pr = PropertyRegistry(transmitter=FailingTransmitter())
+    pr.addProperty(0, "a", StructProperty(">B"))
+    pr["a"] = (1,)
+    pr.eventLoop()
+    assert(pr.getStats()["properties"]["a"]["send_failures"] == 1)
+  @test
+  def WarningsAreRateLimited():
+    import builtins
+    printed = []
+    real_print = builtins.print
+    builtins.print = lambda *args: printed.append(" ".join(str(a) for a in args))
+    try:
+      pr = PropertyRegistry()
+      pr.warn_interval_ms = 50
+      for _ in range(10): pr.receive(6, bytearray())
+      pr.receive(7, bytearray()) # Same kind of warning, so it's held back too
+      time.sleep(0.06)
+      pr.receive(8, bytearray())
+    finally: builtins.print = real_print
+    assert(len(printed) == 2)
+    assert("0x006" in printed[0] and "0x008" in printed[1] and "10 more" in printed[1])
+    assert(pr.getStats()["warnings"]["unknown_id"] == 12)
+  @test
+  def FallbackHeapSorts():
+    import random
+    heap = []
+    values = [random.randrange(1000) for _ in range(500)]
+    for v in values: heapPush(heap, (v, 0))
+    assert([heapPop(heap)[0] for _ in values] == sorted(values))
+    heap = [(v, 0) for v in values]
+    heapMake(heap)
+    assert([heapPop(heap)[0] for _ in values] == sorted(values))
+  
   for test in tests.keys():
     print("Test", test, "----------------")
     try:
@@ -1,33 +1,186 @@
-import traceback
 from .base import BaseProperty
 from extendedstruct import *
 
 class ExtendedStructProperty(BaseProperty,ExtendedStruct):
   update_callback = None
-  def __init__(self, *fields): ExtendedStruct.__init__(self, *fields)
+  zero_copy = False
+  batch_depth = 0 # How many `with` blocks deep we are. Callbacks are held back until the outermost one exits
+  batch_dirty = False # Whether a field was written during the current `with` block
+  """
+  Arguments
+    *fields - The bitfields of the struct, in order. See `ExtendedStruct`.
+    zero_copy - If True, received frames are attached (see `ExtendedStruct.attach`) instead of copied into the struct.
+      The receiver must then leave each frame's memory alone until the next frame for this property arrives.
+  """
+  def __init__(self, *fields, zero_copy = False):
+    ExtendedStruct.__init__(self, *fields)
+    self.zero_copy = zero_copy
+  # The registry flags the property itself when this returns True, so there's no callback here
   def setValue(self, value):
     if not isinstance(value, dict): return False
-    for k in self:
-      if k in value: ExtendedStruct.__setitem__(self, k, value[k])
-    
-    try: self.update_callback()
-    except: pass
-    
+    self.fromDict(value)
     return True
   def getValue(self, update_callback):
     self.update_callback = update_callback
     return self
   def deserializeValue(self, msg):
-    try: self.setBytes(msg)
-    except Exception as e:
-      print("WARN: Bad extended struct packet:", traceback.format_exception(e))
-      return False
+    # CAN FD frames are padded up to the next valid length, so drop anything past the end of the struct
+    if len(msg) > 8 and len(msg) > len(self.own_buf): msg = msg[:len(self.own_buf)]
+    # The registry warns about packets that fail to decode
+    try:
+      if self.zero_copy: self.attach(msg)
+      else: self.setBytes(msg)
+    except Exception: return False
     return True
   def serializeValue(self): return self.getBytes()
+  def fieldValues(self): return self.toDict()
+  def getPayloadLength(self): return self.getByteLength()
+  def decodePayload(self, msg): return self.decodeBytes(msg)
   def __setitem__(self, i, v):
     ExtendedStruct.__setitem__(self, i, v)
+    if self.batch_depth: self.batch_dirty = True
+    else: self.notifyUpdate()
+  def notifyUpdate(self):
     if not self.update_callback is None:
       try: self.update_callback()
       except: pass
+  
+  """
+    Write several fields at once from a dictionary. The buffer is written once and the property is only flagged for
+    sending once, no matter how many fields change. Use this rather than assigning fields one at a time.
+  """
+  def update(self, values):
+    self.fromDict(values)
+    if self.batch_depth: self.batch_dirty = True
+    else: self.notifyUpdate()
+  
+  # Group field assignments in a `with` block so the property is only flagged for sending once, when the block exits:
+  #   with registry["weatherstation_ambient"] as ambient:
+  #     ambient["temperature"] = 21.5
+  #     ambient["humidity"] = 40.0
+  def __enter__(self):
+    self.batch_depth += 1
+    return self
+  def __exit__(self, u1, u2, u3):
+    self.batch_depth -= 1
+    if not self.batch_depth and self.batch_dirty:
+      self.batch_dirty = False
+      self.notifyUpdate()
   def __str__(self): return ExtendedStruct.__str__(self)
 
+if __name__ == "__main__":
+  import traceback
+  from .base import PropertyRegistry, Transmitter, ErrorStatus, LocalDataStatus
+  
+  tests = {}
+  failed_tests = set()
+  
+  def test(f):
+    tests[f.__name__] = f
+  
+  @test
+  def ZeroCopyReceive():
+    pr = PropertyRegistry(data_timeout=100)
+    pr.addProperty(0, "test", ExtendedStructProperty(IntField("a", 8), IntField("b", 8), zero_copy = True))
+    ring = bytearray((1, 2, 3, 4))
+    pr.receive(0, memoryview(ring)[2:4])
+    assert(pr["test"].isAttached())
+    assert(pr["test"].toDict() == { "a": 3, "b": 4 })
+    ring[3] = 5 # The property reads straight out of the receive buffer
+    assert(pr["test"]["b"] == 5)
+    assert(not pr.receive(0, memoryview(ring)))
+    assert(isinstance(pr.getStatus(0), ErrorStatus))
+  @test
+  def ZeroCopyLocalWriteDetaches():
+    pr = PropertyRegistry(data_timeout=100)
+    pr.addProperty(0, "test", ExtendedStructProperty(IntField("a", 8), IntField("b", 8), zero_copy = True))
+    frame = bytes((3, 4))
+    pr.receive(0, frame)
+    pr["test"]["a"] = 7
+    assert(not pr["test"].isAttached())
+    assert(pr["test"].toDict() == { "a": 7, "b": 4 })
+    assert(frame == bytes((3, 4)))
+  @test
+  def CanFdPaddingIgnored():
+    pr = PropertyRegistry(data_timeout=100)
+    pr.addProperty(0, "test", ExtendedStructProperty(IntField("a", 40), IntField("b", 40))) # 10 bytes, sent as 12
+    value = { "a": (1 << 39) + 5, "b": 123456789 }
+    pr["test"] = value
+    frame = pr["test"].serializeValue()
+    assert(len(frame) == 10)
+    assert(pr.receive(0, frame + bytes(2)))
+    assert(pr["test"].toDict() == value)
+    assert(not pr.receive(0, frame[:9])) # Frames that are too short are still errors
+  
+  # Counts how often the registry flags and rebuilds an entry, and records the frames it sends
+  class CountingRegistry(PropertyRegistry):
+    flags = 0
+    rebuilds = 0
+    def flagLocalPropertyUpdate(self, prop_entry):
+      self.flags += 1
+      return PropertyRegistry.flagLocalPropertyUpdate(self, prop_entry)
+    def updatePropStatus(self, prop_entry, status):
+      self.rebuilds += 1
+      return PropertyRegistry.updatePropStatus(self, prop_entry, status)
+  class CountingTransmitter(Transmitter):
+    def __init__(self): self.sent = []
+    def send(self, can_id, msg):
+      self.sent.append((can_id, bytes(msg)))
+      return True
+  def countingRegistry():
+    txn = CountingTransmitter()
+    pr = CountingRegistry(data_timeout=100, transmitter=txn)
+    pr.addProperty(0, "test", ExtendedStructProperty(IntField("a", 8), IntField("b", 8), IntField("c", 8)))
+    return (pr, txn)
+  
+  @test
+  def AssignDictFlagsOnce():
+    (pr, txn) = countingRegistry()
+    pr["test"] # A read hooks up the update callback, which must not cause a second flag
+    pr["test"] = { "a": 1, "b": 2, "c": 3 }
+    pr["test"]
+    assert(pr.flags == 1 and pr.rebuilds == 1)
+    pr["test"] = { "a": 4 } # Already local, so there's nothing to rebuild
+    assert(pr.flags == 2 and pr.rebuilds == 1)
+    pr.eventLoop()
+    assert(txn.sent == [(0, bytes((4, 2, 3)))])
+  @test
+  def UpdateFlagsOnce():
+    (pr, txn) = countingRegistry()
+    pr["test"] = {}
+    pr.eventLoop()
+    txn.sent.clear()
+    pr["test"].update({ "a": 1, "b": 2, "c": 3 })
+    assert(pr.flags == 2 and pr.rebuilds == 1)
+    pr.eventLoop()
+    assert(txn.sent == [(0, bytes((1, 2, 3)))])
+  @test
+  def WithBlockFlagsOnce():
+    (pr, txn) = countingRegistry()
+    pr["test"] = {}
+    pr.eventLoop()
+    txn.sent.clear()
+    with pr["test"] as s:
+      s["a"] = 1
+      with s: s["b"] = 2
+      s.update({ "c": 3 })
+      assert(pr.flags == 1)
+    assert(pr.flags == 2)
+    with pr["test"]: pass # Nothing written, nothing flagged
+    assert(pr.flags == 2)
+    pr.eventLoop()
+    assert(txn.sent == [(0, bytes((1, 2, 3)))])
+  
+  for test in tests.keys():
+    print("Test", test, "----------------")
+    try:
+      tests[test]()
+      print("TEST PASSED")
+    except:
+      failed_tests.add(test)
+      print("TEST FAILED", traceback.format_exc())
+  
+  print()
+  print("All tests complete,", len(failed_tests), "failed")
+  for test in failed_tests:
+    print(test, "FAILED")
@@ -0,0 +1,179 @@
+from array import array
+from adafruit_ticks import ticks_ms, ticks_add, ticks_diff
+
+"""
+  The last `capacity` payloads received for a property, with the ticks (see adafruit_ticks) each one arrived at. See
+  `PropertyRegistry.enableHistory`.
+
+  Everything lives in two preallocated buffers, an array of timestamps and a bytearray of raw payloads, so recording a
+  frame doesn't allocate anything. Payloads are only decoded (with the property's `decodePayload`) when they're
+  queried. Queries return samples oldest first, as (ticks, field values) pairs.
+"""
+class HistoryRing:
+  def __init__(self, capacity, prop):
+    length = prop.getPayloadLength()
+    if length is None: raise Exception("Property doesn't have a fixed length, so its history can't be kept")
+    if capacity < 1: raise Exception("History capacity must be at least 1")
+    self.prop = prop
+    self.capacity = capacity
+    self.payload_length = length
+    self.times = array("l", [0]) * capacity
+    self.payloads = bytearray(capacity * length)
+    self.next = 0 # Slot the next payload goes in
+    self.count = 0 # Slots in use
+
+  def record(self, ticks, msg):
+    length = self.payload_length
+    if len(msg) < length: return
+    i = self.next
+    self.times[i] = ticks
+    # CAN FD frames can be padded past the end of the payload
+    self.payloads[i*length:(i + 1)*length] = msg if len(msg) == length else msg[:length]
+    i += 1
+    self.next = 0 if i == self.capacity else i
+    if self.count < self.capacity: self.count += 1
+  def clear(self):
+    self.next = 0
+    self.count = 0
+  def __len__(self): return self.count
+
+  # Slot of the sample `age` places before the newest one
+  def slot(self, age): return (self.next - 1 - age) % self.capacity
+  def getTime(self, age): return self.times[self.slot(age)]
+  def getPayload(self, age):
+    start = self.slot(age) * self.payload_length
+    return bytes(self.payloads[start:start + self.payload_length])
+
+  """
+    Number of samples that arrived at or after `ticks`, as of `now` (in ticks, defaulting to the current time). Ticks
+    wrap around (every few days), so samples are compared by their age before `now`: Counting stops at the first one
+    that's older than `ticks`, or that seems to be from the future, which is what a sample from more than half a wrap
+    ago looks like.
+  """
+  def countSince(self, ticks, now = None):
+    if now is None: now = ticks_ms()
+    window = ticks_diff(now, ticks)
+    n = 0
+    while n < self.count:
+      age = ticks_diff(now, self.times[self.slot(n)])
+      if age < 0 or age > window: break
+      n += 1
+    return n
+
+  # The last `n` samples (or fewer, if there aren't that many yet)
+  def last(self, n):
+    n = min(n, self.count)
+    return [(self.getTime(age), self.prop.decodePayload(self.getPayload(age))) for age in range(n - 1, -1, -1)]
+  # Samples that arrived at or after `ticks`, as of `now` (see `countSince`)
+  def since(self, ticks, now = None): return self.last(self.countSince(ticks, now))
+  # Samples from the last `window_ms` milliseconds before `now` (in ticks, defaulting to the current time)
+  def window(self, window_ms, now = None):
+    if now is None: now = ticks_ms()
+    return self.since(ticks_add(now, -window_ms), now)
+
+  """
+    Summarize a numeric field over the last `window_ms` milliseconds (or the whole history, if None) as a dictionary of
+    `count`, `min`, `max` and `mean`. None if there are no samples in the window.
+  """
+  def aggregate(self, field, window_ms = None, now = None):
+    samples = self.last(self.count) if window_ms is None else self.window(window_ms, now)
+    if not samples: return None
+    values = [fields[field] for (ticks, fields) in samples]
+    return { "count": len(values), "min": min(values), "max": max(values), "mean": sum(values) / len(values) }
+
+if __name__ == "__main__":
+  import struct
+  import time
+  import traceback
+  from .base import PropertyRegistry, StructProperty, BaseProperty
+  from .extendedstruct import ExtendedStructProperty, IntField
+
+  tests = {}
+  failed_tests = set()
+
+  def test(f):
+    tests[f.__name__] = f
+
+  def ambientProperty(): return ExtendedStructProperty(
+    IntField("temperature", 16, base = -200, scale = 0.01, signed = False),
+    IntField("humidity", 8, base = 0, scale = 100.0/255.0, signed = False),
+  )
+  def ambientFrame(temperature):
+    prop = ambientProperty()
+    prop.fromDict({ "temperature": temperature, "humidity": 50.0 })
+    return prop.getBytes()
+
+  @test
+  def HistoryKeepsTheLastSamples():
+    pr = PropertyRegistry()
+    pr.addProperty(0, "ambient", ambientProperty())
+    history = pr.enableHistory("ambient", 4)
+    for t in range(6): pr.receive(0, ambientFrame(20 + t))
+    assert(len(history) == 4)
+    assert([round(fields["temperature"]) for (ticks, fields) in history.last(10)] == [22, 23, 24, 25])
+    assert([round(fields["temperature"]) for (ticks, fields) in history.last(2)] == [24, 25])
+    assert(pr["ambient"]["temperature"] > 24.9) # Queries don't touch the current value
+  @test
+  def HistoryWindows():
+    history = HistoryRing(8, StructProperty("<h"))
+    for (ticks, value) in ((1000, 1), (1500, 5), (2000, 3), (2500, -1)): history.record(ticks, struct.pack("<h", value))
+    assert([ticks for (ticks, fields) in history.since(1500, now = 2600)] == [1500, 2000, 2500])
+    assert(history.window(1000, now = 2600) == [(2000, { 0: 3 }), (2500, { 0: -1 })])
+    assert(history.aggregate(0, 1200, now = 2600) == { "count": 3, "min": -1, "max": 5, "mean": 7/3 })
+    assert(history.aggregate(0) == { "count": 4, "min": -1, "max": 5, "mean": 2 })
+    assert(history.aggregate(0, 10, now = 5000) is None)
+  @test
+  def HistoryWindowsAcrossTicksWraparound():
+    history = HistoryRing(8, StructProperty("<h"))
+    now = 300 # Just after the ticks wrapped around
+    # Over half a wrap ago, so it looks like it's from the future. `ticks_add` can't go half a wrap in one step
+    stale = ticks_add(ticks_add(now, -(1 << 27)), -(1 << 27) - 5000)
+    for (ticks, value) in ((stale, 100), (ticks_add(now, -1500), 1), (ticks_add(now, -500), 2), (200, 3)):
+      history.record(ticks, struct.pack("<h", value))
+    assert([fields[0] for (ticks, fields) in history.window(1000, now = now)] == [2, 3])
+    assert(history.aggregate(0, 60000, now = now) == { "count": 3, "min": 1, "max": 3, "mean": 2 })
+    assert(history.countSince(ticks_add(now, 100), now = now) == 0) # A start after `now` has no samples
+  @test
+  def HistoryOnlyRecordsReceivedData():
+    pr = PropertyRegistry()
+    pr.addProperty(0, "test", StructProperty("<B"))
+    history = pr.enableHistory(0, 4)
+    pr["test"] = (1,)
+    pr.receive(0, b"")  # Corrupt
+    pr.receive(0, b"\x02")
+    assert(history.last(4) == [(history.getTime(0), { 0: 2 })])
+    assert(pr.getHistory("test") is history)
+  @test
+  def HistoryTrimsPadding():
+    history = HistoryRing(2, StructProperty("<B"))
+    history.record(0, b"\x05\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+    assert(history.getPayload(0) == b"\x05")
+  @test
+  def HistoryNeedsFixedLength():
+    try:
+      HistoryRing(4, BaseProperty())
+      assert(False)
+    except AssertionError: raise
+    except Exception: pass
+  @test
+  def HistoryRecordIsCheap():
+    history = HistoryRing(256, ambientProperty())
+    frame = ambientFrame(20)
+    start = time.monotonic()
+    for i in range(100000): history.record(i, frame)
+    assert(time.monotonic() - start < 1.0)
+    assert(len(history) == 256 and history.getTime(0) == 99999)
+
+  for test in tests.keys():
+    print("Test", test, "----------------")
+    try:
+      tests[test]()
+      print("TEST PASSED")
+    except:
+      failed_tests.add(test)
+      print("TEST FAILED", traceback.format_exc())
+
+  print()
+  print("All tests complete,", len(failed_tests), "failed")
+  for test in failed_tests:
+    print(test, "FAILED")
@@ -0,0 +1,229 @@
+from .base import BaseProperty, LOCAL_DATA
+
+"""
+  Sends several small properties in one CAN frame, so they share the frame's header and arbitration instead of paying
+  for one each. Register one with `PropertyRegistry.addMultiplexed`.
+
+  The properties are split into groups, and each frame carries one group:
+    byte 0 - The selector: Which group this is (its index in `groups`)
+    byte 1 - A bit for each property in the group, set if its data is in the frame. Properties without local data are
+      left out (zeroed), so the receiver doesn't think there's data where there isn't
+    then - The serialized value of each property in the group, in order, at a fixed offset
+  Frames longer than 8 bytes need CAN FD, so keep groups to 6 bytes of properties for classic CAN.
+
+  Assigning a property queues its group. Groups are sent one frame at a time, in the order they were queued, all under
+  the multiplexed property's CAN ID and priority. A TransmitPolicy goes on the multiplexed property as a whole: Its
+  heartbeat sends every group that has local data.
+"""
+MAX_GROUP_SIZE = 8 # Properties per group; One bit each in the presence mask
+MAX_FRAME_LENGTH = 64 # The most CAN FD can carry
+HEADER_LENGTH = 2 # Selector and presence mask
+
+class MultiplexedProperty(BaseProperty):
+  def __init__(self, registry, groups):
+    self.registry = registry
+    self.groups = [] # For each selector, a tuple of (property entry, offset, length) for every property in the group
+    self.frame_lengths = [] # For each selector, the length of its frames
+    self.selectors = {} # Selector of each property, by CAN ID
+    self.entries = [] # Every property entry, in order
+    self.pending = [] # Selectors waiting to be sent, in the order they were queued
+    if not 0 < len(groups) <= 256: raise Exception("A multiplexed property needs between 1 and 256 groups")
+    for group in groups:
+      if not 0 < len(group) <= MAX_GROUP_SIZE:
+        raise Exception("Each multiplexed group needs between 1 and {:d} properties".format(MAX_GROUP_SIZE))
+      members = []
+      offset = HEADER_LENGTH
+      for name in group:
+        prop_entry = registry.getPropEntry(name)
+        if prop_entry.can_id in self.selectors or not prop_entry.carrier is None:
+          raise Exception("Property " + prop_entry.name + " is already multiplexed")
+        if not prop_entry.policy is None:
+          raise Exception("Property " + prop_entry.name + " has a transmit policy; Set it on the multiplexed property")
+        length = prop_entry.prop.getPayloadLength()
+        if length is None: raise Exception("Property " + prop_entry.name + " doesn't have a fixed length")
+        members.append((prop_entry, offset, length))
+        self.selectors[prop_entry.can_id] = len(self.groups)
+        self.entries.append(prop_entry)
+        offset += length
+      if offset > MAX_FRAME_LENGTH: raise Exception("Multiplexed group " + str(group) + " doesn't fit in one frame")
+      self.groups.append(tuple(members))
+      self.frame_lengths.append(offset)
+
+  # Queue the group `prop_entry` is in. Called by the registry when the property is assigned
+  def markPending(self, prop_entry):
+    selector = self.selectors[prop_entry.can_id]
+    if not selector in self.pending: self.pending.append(selector)
+
+  def getValue(self, update_callback): return None
+
+  # Unpack a frame and hand each property in it to the registry, as if it had been received on its own
+  def deserializeValue(self, msg):
+    if len(msg) < HEADER_LENGTH or msg[0] >= len(self.groups): return False
+    selector = msg[0]
+    members = self.groups[selector]
+    mask = msg[1]
+    if len(msg) < self.frame_lengths[selector] or mask >> len(members): return False
+    receive = self.registry.receive
+    for (i, (prop_entry, offset, length)) in enumerate(members):
+      if mask & (1 << i): receive(prop_entry.can_id, msg[offset:offset + length])
+    return True
+
+  # The frame for the group that's been waiting longest. With nothing queued (a heartbeat), queue every group that has
+  # local data first
+  def serializeValue(self):
+    if not self.pending:
+      for (selector, members) in enumerate(self.groups):
+        if any(prop_entry.status is LOCAL_DATA for (prop_entry, offset, length) in members): self.pending.append(selector)
+      if not self.pending: self.pending.append(0)
+    selector = self.pending[0]
+    frame = bytearray(self.frame_lengths[selector])
+    frame[0] = selector
+    for (i, (prop_entry, offset, length)) in enumerate(self.groups[selector]):
+      if not prop_entry.status is LOCAL_DATA: continue
+      payload = prop_entry.prop.serializeValue()
+      if not len(payload) == length:
+        raise Exception("Property " + prop_entry.name + " serialized to the wrong length for its multiplexed group")
+      frame[offset:offset + length] = payload
+      frame[1] |= 1 << i
+    return bytes(frame)
+  # Send the next group, if there is one
+  def valueSent(self):
+    if self.pending: self.pending.pop(0)
+    return len(self.pending) > 0
+
+  def __str__(self):
+    return "MultiplexedProperty: " + " | ".join(
+      ", ".join(prop_entry.name for (prop_entry, offset, length) in members) for members in self.groups
+    )
+
+if __name__ == "__main__":
+  import traceback
+  from .base import PropertyRegistry, StructProperty, Transmitter, TransmitPolicy, NO_DATA, REMOTE_DATA, ERROR
+
+  tests = {}
+  failed_tests = set()
+
+  def test(f):
+    tests[f.__name__] = f
+
+  class RecordingTransmitter(Transmitter):
+    def __init__(self): self.sent = []
+    def send(self, can_id, msg):
+      self.sent.append((can_id, bytes(msg)))
+      return True
+
+  # Properties "a" through "f" on IDs 0x10-0x15, with "a", "b" and "c" multiplexed in group 0, and "d" in group 1
+  def makeRegistry(**kwargs):
+    pr = PropertyRegistry(**kwargs)
+    pr.addProperty(0x10, "a", StructProperty("<H"))
+    pr.addProperty(0x11, "b", StructProperty("<H"))
+    pr.addProperty(0x12, "c", StructProperty("<B"))
+    pr.addProperty(0x13, "d", StructProperty("<I"))
+    pr.addProperty(0x14, "e", StructProperty("<B"))
+    pr.addProperty(0x15, "f", StructProperty("<B"))
+    pr.addMultiplexed(0x20, "mux", [["a", "b", "c"], ["d"]])
+    return pr
+
+  def deliver(txn, pr):
+    for (can_id, msg) in txn.sent: pr.receive(can_id, msg)
+
+  @test
+  def MultiplexedRoundTrip():
+    txn = RecordingTransmitter()
+    sender = makeRegistry(transmitter = txn)
+    sender["a"] = (0x1234,)
+    sender["c"] = (7,)
+    sender.eventLoop()
+    assert(txn.sent == [(0x20, bytes([0, 0b101, 0x34, 0x12, 0, 0, 7]))])
+    receiver = makeRegistry()
+    deliver(txn, receiver)
+    assert(receiver["a"] == (0x1234,) and receiver["c"] == (7,))
+    assert(receiver.getStatus("b") is NO_DATA and receiver.getStatus("d") is NO_DATA)
+    assert(receiver.getStatus("mux") is REMOTE_DATA)
+  @test
+  def EachGroupIsAFrame():
+    txn = RecordingTransmitter()
+    sender = makeRegistry(transmitter = txn)
+    sender["d"] = (1,)
+    sender["a"] = (2,)
+    sender["b"] = (3,)
+    sender.eventLoop()
+    assert([msg[0] for (can_id, msg) in txn.sent] == [1, 0]) # In the order they were queued
+    receiver = makeRegistry()
+    deliver(txn, receiver)
+    assert(receiver["a"] == (2,) and receiver["b"] == (3,) and receiver["d"] == (1,))
+  @test
+  def MultiplexedHalvesFrames():
+    txn = RecordingTransmitter()
+    sender = makeRegistry(transmitter = txn)
+    for name in ("a", "b", "c", "d", "e", "f"): sender[name] = (1,)
+    sender.eventLoop()
+    assert(len(txn.sent) == 4) # "e" and "f" on their own, plus two multiplexed frames for the other four
+  @test
+  def MultiplexedGroupsRespectBudget():
+    txn = RecordingTransmitter()
+    sender = makeRegistry(transmitter = txn, transmit_budget_frames = 1)
+    sender["a"] = (1,)
+    sender["d"] = (2,)
+    sender.eventLoop()
+    assert(len(txn.sent) == 1)
+    sender.eventLoop()
+    assert([msg[0] for (can_id, msg) in txn.sent] == [0, 1])
+    sender.eventLoop()
+    assert(len(txn.sent) == 2)
+  @test
+  def MultiplexedHeartbeatSendsLocalGroups():
+    txn = RecordingTransmitter()
+    sender = makeRegistry(transmitter = txn)
+    sender.setTransmitPolicy("mux", TransmitPolicy(0))
+    sender["b"] = (1,)
+    sender.eventLoop()
+    sender.eventLoop() # Heartbeat due straight away
+    assert([msg[0] for (can_id, msg) in txn.sent] == [0, 0])
+    try:
+      sender.setTransmitPolicy("a", TransmitPolicy(0))
+      assert(False)
+    except AssertionError: raise
+    except Exception: pass
+  @test
+  def MultiplexedStillReceivesOwnIds():
+    receiver = makeRegistry()
+    receiver.receive(0x13, bytes([1, 0, 0, 0]))
+    assert(receiver["d"] == (1,))
+  @test
+  def MultiplexedBadFrames():
+    receiver = makeRegistry()
+    assert(not receiver.receive(0x20, bytes([2, 1, 0, 0, 0, 0])))  # No group 2
+    assert(receiver.getStatus("mux") is ERROR)
+    assert(not receiver.receive(0x20, bytes([0, 1, 0])))  # Too short
+    assert(not receiver.receive(0x20, bytes([1, 0b10, 0, 0, 0, 0])))  # Group 1 only has one property
+    assert(receiver.getStatus("d") is NO_DATA)
+  @test
+  def MultiplexedRegistrationChecks():
+    def fails(f):
+      try: f()
+      except Exception: return True
+      return False
+    pr = makeRegistry()
+    pr.addProperty(0x30, "variable", BaseProperty())
+    pr.addProperty(0x31, "big", StructProperty("<QQQQQQQQ"))
+    assert(fails(lambda: pr.addMultiplexed(0x40, "m1", [["variable"]])))
+    assert(fails(lambda: pr.addMultiplexed(0x40, "m1", [["a"]]))) # Already multiplexed
+    assert(fails(lambda: pr.addMultiplexed(0x40, "m1", [["e", "big"]]))) # Doesn't fit
+    assert(fails(lambda: pr.addMultiplexed(0x40, "m1", [["e", "e"]])))
+    assert(fails(lambda: pr.addMultiplexed(0x40, "m1", [])))
+    assert(pr.findPropEntry("m1") is None and pr.getPropEntry("e").carrier is None)
+
+  for test in tests.keys():
+    print("Test", test, "----------------")
+    try:
+      tests[test]()
+      print("TEST PASSED")
+    except:
+      failed_tests.add(test)
+      print("TEST FAILED", traceback.format_exc())
+
+  print()
+  print("All tests complete,", len(failed_tests), "failed")
+  for test in failed_tests:
+    print(test, "FAILED")
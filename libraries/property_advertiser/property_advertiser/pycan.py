@@ -1,9 +1,25 @@
+import asyncio
 import can
-from .base import Transmitter, Receiver
+from .base import Transmitter, Receiver, EXTENDED_ID_FLAG, EXTENDED_ID_MASK
+
+# The payload lengths a CAN FD frame can have past 8 bytes. Longer properties are zero padded up to the next one
+CANFD_LENGTHS = (12, 16, 20, 24, 32, 48, 64)
 
 class PycanTransmitter(Transmitter):
   def __init__(self, can): self.can = can
-  def send(self, can_id, msg): return self.can.send(can.Message(arbitration_id=can_id, data=msg, is_extended_id=False))
+  # python-can's `send` returns None, and raises if the frame couldn't be sent. IDs with EXTENDED_ID_FLAG set (from a
+  # replayed trace, say) are sent as extended IDs
+  def send(self, can_id, msg):
+    extended = bool(can_id & EXTENDED_ID_FLAG)
+    can_id &= EXTENDED_ID_MASK
+    if len(msg) <= 8: self.can.send(can.Message(arbitration_id=can_id, data=msg, is_extended_id=extended))
+    else:
+      # Too big for classic CAN, so send it as CAN FD (the bus has to be set up with `fd=True`)
+      if len(msg) > CANFD_LENGTHS[-1]: raise ValueError("CAN FD payloads are at most 64 bytes")
+      length = next(l for l in CANFD_LENGTHS if l >= len(msg))
+      data = bytes(msg) + bytes(length - len(msg))
+      self.can.send(can.Message(arbitration_id=can_id, data=data, is_extended_id=extended, is_fd=True))
+    return True
 class PycanReceiver(Receiver):
   def __init__(self, can, timeout=2.0):
     self.can = can
@@ -14,9 +30,32 @@ class PycanReceiver(Receiver):
   def __enter__(self): return self
   def __exit__(self, u1, u2, u3): pass
   
+  # Extended IDs come back with EXTENDED_ID_FLAG set. The registry ignores them, but a TraceRecorder keeps them apart
   def receive(self):
     msg = self.can.recv(self.timeout)
-    return None if msg is None else (msg.arbitration_id, msg.data)
+    if msg is None: return None
+    return (msg.arbitration_id | (EXTENDED_ID_FLAG if msg.is_extended_id else 0), msg.data)
+
+"""
+  Receives frames for `AsyncPropertyRegistry.run` (see aio.py): `async for (can_id, msg) in receiver` waits for each
+  frame without a timeout. A python-can Notifier reads the bus in the background (or straight from the event loop, for
+  buses like socketcan that have a file descriptor), so create this from inside a running event loop.
+"""
+class AsyncPycanReceiver:
+  def __init__(self, bus):
+    self.reader = can.AsyncBufferedReader()
+    self.notifier = can.Notifier(bus, [self.reader], loop = asyncio.get_running_loop())
+  def deinit(self): self.notifier.stop()
+  
+  # For use in `with` statements
+  def __enter__(self): return self
+  def __exit__(self, u1, u2, u3): self.deinit()
+  
+  async def receive(self):
+    msg = await self.reader.get_message()
+    return (msg.arbitration_id | (EXTENDED_ID_FLAG if msg.is_extended_id else 0), msg.data)
+  def __aiter__(self): return self
+  async def __anext__(self): return await self.receive()
 
 class CanBusInterface(PycanTransmitter, PycanReceiver):
   def __init__(self, *args, timeout=2.0, **kwargs):
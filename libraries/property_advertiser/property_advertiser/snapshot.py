@@ -0,0 +1,239 @@
+import mmap
+import os
+import struct
+import time
+from adafruit_ticks import ticks_ms, ticks_diff
+from .base import REMOTE_DATA
+from .multiplexed import MultiplexedProperty
+
+"""
+  Save a registry's remote data to a file, and load it back after a restart, so the gateway has valid data right away
+  instead of waiting for every node's next broadcast. Each property keeps whatever time it had left before expiring,
+  minus however long the process was down (by the wall clock).
+
+  Only remote data is saved: Local properties belong to this process, which will assign them again anyway.
+
+  The file is a header (SNAPSHOT_HEADER: magic, format version, property count, and wall clock time when it was written)
+  followed by a record per property (SNAPSHOT_RECORD: CAN ID, milliseconds until it expires, name length, payload
+  length), each followed by the property's name and raw payload. Names are checked on load, so a snapshot from an
+  older registry layout can't put data into the wrong property.
+"""
+SNAPSHOT_MAGIC = b"PASN"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sBHd")
+SNAPSHOT_RECORD = struct.Struct("<HiBB")
+
+# Serialize the registry's remote data as snapshot bytes. `now` (wall clock seconds) is for tests
+def dumpSnapshot(registry, now = None):
+  now_ticks = ticks_ms()
+  records = []
+  for name in registry:
+    prop_entry = registry.getPropEntry(name)
+    # Multiplexed properties only carry other properties, which are saved on their own
+    if not prop_entry.status is REMOTE_DATA or isinstance(prop_entry.prop, MultiplexedProperty): continue
+    remaining = ticks_diff(prop_entry.deadline, now_ticks)
+    if remaining <= 0: continue
+    try: payload = bytes(prop_entry.prop.serializeValue())
+    except Exception as e:
+      registry.warn("snapshot", "Couldn't serialize {} for the snapshot:", name, exception = e)
+      continue
+    encoded_name = name.encode("utf-8")
+    # Name and payload lengths are single bytes, so longer ones can't be saved
+    if len(encoded_name) > 0xFF or len(payload) > 0xFF:
+      registry.warn("snapshot", "{} has a name or payload too long for the snapshot", name)
+      continue
+    records.append(SNAPSHOT_RECORD.pack(prop_entry.can_id, remaining, len(encoded_name), len(payload)))
+    records.append(encoded_name)
+    records.append(payload)
+  header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(records) // 3, time.time() if now is None else now)
+  return header + b"".join(records)
+
+"""
+  Write a snapshot of the registry to `path`. It's written to a temporary file first and renamed over `path`, so a
+  crash partway through leaves the previous snapshot in place.
+"""
+def saveSnapshot(registry, path, now = None):
+  data = dumpSnapshot(registry, now)
+  temp_path = path + ".tmp"
+  with open(temp_path, "wb") as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(temp_path, path)
+
+# Parse snapshot bytes into (wall clock time written, [(CAN ID, name, milliseconds left, payload)]). Raises ValueError
+# (or struct.error) if they're corrupt
+def parseSnapshot(data):
+  with memoryview(data) as view:
+    if len(view) < SNAPSHOT_HEADER.size: raise ValueError("Snapshot is too short")
+    (magic, version, count, written) = SNAPSHOT_HEADER.unpack_from(view, 0)
+    if not magic == SNAPSHOT_MAGIC or not version == SNAPSHOT_VERSION: raise ValueError("Not a snapshot this can read")
+    records = []
+    offset = SNAPSHOT_HEADER.size
+    for _ in range(count):
+      (can_id, remaining, name_length, payload_length) = SNAPSHOT_RECORD.unpack_from(view, offset)
+      offset += SNAPSHOT_RECORD.size
+      name = str(view[offset:offset + name_length], "utf-8")
+      offset += name_length
+      payload = bytes(view[offset:offset + payload_length]) # A copy, since the data may be unmapped afterwards
+      offset += payload_length
+      if not len(payload) == payload_length: raise ValueError("Snapshot is truncated")
+      records.append((can_id, name, remaining, payload))
+  return (written, records)
+
+"""
+  Restore remote data from snapshot bytes (anything that supports the buffer protocol). Properties that already have
+  data, that aren't registered under the same CAN ID and name anymore, or whose data would have expired by `now` (wall
+  clock seconds, defaulting to the current time) are skipped. Returns the number of properties restored. Corrupt bytes
+  raise ValueError (or struct.error) before anything is restored.
+"""
+def loadSnapshotBytes(registry, data, now = None):
+  (written, records) = parseSnapshot(data)
+  # Clocks can go backwards (say, NTP fixing the time after boot), but a snapshot can't be younger than zero
+  age_ms = max(0, int(((time.time() if now is None else now) - written) * 1000))
+  restored = 0
+  for (can_id, name, remaining, payload) in records:
+    prop_entry = registry.findPropEntry(can_id)
+    if prop_entry is None or not prop_entry.name == name: continue
+    if registry.restoreRemote(prop_entry, payload, remaining - age_ms): restored += 1
+  return restored
+
+"""
+  Restore remote data from the snapshot at `path` (see `loadSnapshotBytes`). The file is memory mapped rather than
+  read. A missing or empty file restores nothing, and so does a corrupt one, with a warning. Returns the number of
+  properties restored.
+"""
+def loadSnapshot(registry, path, now = None):
+  try: f = open(path, "rb")
+  except FileNotFoundError: return 0
+  with f:
+    if os.fstat(f.fileno()).st_size == 0: return 0
+    with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+      try: return loadSnapshotBytes(registry, data, now)
+      except (ValueError, struct.error) as e:
+        registry.warn("snapshot", "Couldn't load the snapshot at {}:", path, exception = e)
+        return 0
+
+if __name__ == "__main__":
+  import tempfile
+  import traceback
+  from .base import PropertyRegistry, StructProperty, NO_DATA, LOCAL_DATA
+  from .extendedstruct import ExtendedStructProperty, IntField
+
+  tests = {}
+  failed_tests = set()
+
+  def test(f):
+    tests[f.__name__] = f
+
+  def makeRegistry(data_timeout = 10000):
+    pr = PropertyRegistry(data_timeout = data_timeout)
+    pr.addProperty(0, "a", StructProperty("<H"))
+    pr.addProperty(1, "b", ExtendedStructProperty(IntField("x", 12, scale = 0.5), IntField("y", 12)))
+    pr.addProperty(2, "local", StructProperty("<B"))
+    pr.addProperty(3, "none", StructProperty("<B"))
+    pr.addProperty(4, "muxed", StructProperty("<B"))
+    pr.addMultiplexed(5, "mux", [["muxed"]])
+    return pr
+
+  @test
+  def SnapshotRoundTrip():
+    pr = makeRegistry()
+    pr.receive(0, struct.pack("<H", 1234))
+    pr.receive(1, b"\x10\x20\x30")
+    pr.receive(5, b"\x00\x01\x09") # The multiplexed property itself isn't saved, just "muxed"
+    pr["local"] = (5,)
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, "registry.snapshot")
+      saveSnapshot(pr, path, now = 1000.0)
+      assert(os.listdir(d) == ["registry.snapshot"])
+      restored = makeRegistry()
+      assert(loadSnapshot(restored, path, now = 1001.0) == 3)
+      assert(restored["muxed"] == (9,) and restored.getStatus("mux") is NO_DATA)
+    assert(restored["a"] == (1234,) and restored["b"].getBytes() == b"\x10\x20\x30")
+    assert(restored.getStatus("local") is NO_DATA and restored.getStatus("none") is NO_DATA)
+    # Restored data expires when it would have, minus the second the process was "down"
+    remaining = restored.getPropEntry("a").deadline - ticks_ms()
+    assert(8900 < remaining <= 9000)
+    assert(len(restored.property_expiry) == 3)
+  @test
+  def SnapshotSkipsExpiredData():
+    pr = makeRegistry(data_timeout = 5000)
+    pr.receive(0, struct.pack("<H", 1))
+    data = dumpSnapshot(pr, now = 1000.0)
+    assert(loadSnapshotBytes(makeRegistry(), data, now = 1006.0) == 0)
+    assert(loadSnapshotBytes(makeRegistry(), data, now = 1004.0) == 1)
+    assert(loadSnapshotBytes(makeRegistry(), data, now = 900.0) == 1) # Clock went backwards
+  @test
+  def SnapshotChecksNames():
+    pr = makeRegistry()
+    pr.receive(0, struct.pack("<H", 1))
+    data = dumpSnapshot(pr)
+    other = PropertyRegistry()
+    other.addProperty(0, "renamed", StructProperty("<H"))
+    assert(loadSnapshotBytes(other, data) == 0)
+  @test
+  def SnapshotKeepsNewerData():
+    pr = makeRegistry()
+    pr.receive(0, struct.pack("<H", 1))
+    data = dumpSnapshot(pr)
+    restored = makeRegistry()
+    restored.receive(0, struct.pack("<H", 2))
+    restored["b"] = { "x": 1 }
+    assert(loadSnapshotBytes(restored, data) == 0)
+    assert(restored["a"] == (2,) and restored.getStatus("b") is LOCAL_DATA)
+  @test
+  def SnapshotSkipsLongNames():
+    pr = makeRegistry()
+    long_name = "\u00e9" * 128 # 256 bytes in UTF-8
+    pr.addProperty(6, long_name, StructProperty("<B"))
+    pr.receive(0, struct.pack("<H", 1))
+    pr.receive(6, b"\x01")
+    data = dumpSnapshot(pr)
+    assert(pr.warnings["snapshot"][2] == 1)
+    restored = makeRegistry()
+    restored.addProperty(6, long_name, StructProperty("<B"))
+    assert(loadSnapshotBytes(restored, data) == 1)
+    assert(restored["a"] == (1,) and restored.getStatus(long_name) is NO_DATA)
+  @test
+  def SnapshotMissingOrCorrupt():
+    pr = makeRegistry()
+    pr.receive(0, struct.pack("<H", 1))
+    pr.receive(1, b"\x01\x02\x03")
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, "registry.snapshot")
+      assert(loadSnapshot(makeRegistry(), path) == 0)
+      open(path, "wb").close()
+      assert(loadSnapshot(makeRegistry(), path) == 0)
+      with open(path, "wb") as f: f.write(dumpSnapshot(pr)[:-2]) # Second record cut short
+      restored = makeRegistry()
+      assert(loadSnapshot(restored, path) == 0 and restored.getStatus("a") is NO_DATA)
+      with open(path, "wb") as f: f.write(b"garbage")
+      assert(loadSnapshot(makeRegistry(), path) == 0)
+  @test
+  def SnapshotLoadsQuickly():
+    pr = PropertyRegistry()
+    for can_id in range(2000): pr.addProperty(can_id, "p" + str(can_id), StructProperty("<HBH"))
+    for can_id in range(2000): pr.receive(can_id, struct.pack("<HBH", can_id, 1, 2))
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, "registry.snapshot")
+      saveSnapshot(pr, path)
+      restored = PropertyRegistry()
+      for can_id in range(2000): restored.addProperty(can_id, "p" + str(can_id), StructProperty("<HBH"))
+      start = time.monotonic()
+      assert(loadSnapshot(restored, path) == 2000)
+      assert(time.monotonic() - start < 0.5)
+
+  for test in tests.keys():
+    print("Test", test, "----------------")
+    try:
+      tests[test]()
+      print("TEST PASSED")
+    except:
+      failed_tests.add(test)
+      print("TEST FAILED", traceback.format_exc())
+
+  print()
+  print("All tests complete,", len(failed_tests), "failed")
+  for test in failed_tests:
+    print(test, "FAILED")
@@ -0,0 +1,397 @@
+import mmap
+import os
+import struct
+import time
+from bisect import bisect_left
+from .base import REMOTE_DATA
+from .multiplexed import MultiplexedProperty
+
+"""
+  An append-only store of received frames on disk, for keeping months of history on the Pi without a database, where
+  `history.HistoryRing` only keeps the last few samples in memory. Every frame is a fixed-width record (wall clock
+  timestamp in milliseconds, CAN ID, payload length, payload) appended to the current segment file. Segments are named
+  after the timestamp of their first record and hold up to `segment_records` records each, so old history can be
+  dropped a whole file at a time.
+
+  Writes are batched in memory and only written (and fsynced) every `flush_records` records or `flush_interval_ms`
+  milliseconds, whichever comes first, so the SD card sees a handful of writes a minute rather than one per frame. A
+  crash loses at most the unflushed batch.
+
+  Reads memory map each segment and binary search a sparse index (the timestamp of every `INDEX_INTERVAL`th record) to
+  find where a time range starts, so a query only touches the records it returns. Payloads are kept serialized and
+  decoded with the registry's own property layouts when they're queried. Timestamps only ever go forward: If the clock
+  jumps back, new records keep the last timestamp until it catches up.
+"""
+
+# Segment files start with a header: Magic, format version, and the payload width of every record in the file
+SEGMENT_HEADER = struct.Struct("<4sBBH")
+SEGMENT_MAGIC = b"HSEG"
+SEGMENT_VERSION = 1
+SEGMENT_SUFFIX = ".seg"
+SEGMENT_NAME = "{:016d}-{:04d}" + SEGMENT_SUFFIX # First timestamp, and a count of earlier segments that start with it
+RECORD_HEADER = struct.Struct("<qHB") # Timestamp (ms), CAN ID, payload length
+INDEX_INTERVAL = 256 # Records between sparse index entries
+
+# The struct for whole records with a given payload width
+def recordStruct(payload_width): return struct.Struct(RECORD_HEADER.format + "{:d}s".format(payload_width))
+
+# One segment file, and the sparse index of the records written to it so far
+class Segment:
+  def __init__(self, path, first_time, payload_width):
+    self.path = path
+    self.first_time = first_time
+    self.record = recordStruct(payload_width)
+    self.count = 0 # Records on disk
+    self.index_times = [] # Timestamp of every INDEX_INTERVAL-th record
+
+  def recordOffset(self, n): return SEGMENT_HEADER.size + n*self.record.size
+
+  # Index whatever's been written since the last time. Records never change once written, so this is only done once
+  def extendIndex(self, data):
+    n = len(self.index_times) * INDEX_INTERVAL
+    while n < self.count:
+      self.index_times.append(struct.unpack_from("<q", data, self.recordOffset(n))[0])
+      n += INDEX_INTERVAL
+
+  # The (timestamp, CAN ID, payload) of each record between `start` and `end` (inclusive; None for unbounded), in order
+  def read(self, start, end, can_ids):
+    if not self.count: return
+    with open(self.path, "rb") as f:
+      with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        self.extendIndex(data)
+        n = 0
+        # Start at the last index entry before `start`: Records at `start` can come before an entry that's equal to it
+        if not start is None: n = max(0, bisect_left(self.index_times, start) - 1) * INDEX_INTERVAL
+        unpack = self.record.unpack_from
+        for n in range(n, self.count):
+          (timestamp, can_id, length, payload) = unpack(data, self.recordOffset(n))
+          if not start is None and timestamp < start: continue
+          if not end is None and timestamp > end: return
+          if can_ids is None or can_id in can_ids: yield (timestamp, can_id, payload[:length])
+
+class HistoryStore:
+  """
+  Arguments
+    directory - Where segment files go. Created if it doesn't exist, and reopened (carrying on from the newest
+      segment) if it does
+    payload_width - Payload bytes in each record. 8 fits classic CAN; Use 64 for CAN FD
+    segment_records - Records per segment file
+    flush_records, flush_interval_ms - Write buffered records once there are this many, or once the oldest has waited
+      this long
+    max_segments - Delete the oldest segments past this many. None keeps everything
+  """
+  def __init__(
+    self,
+    directory,
+    payload_width = 8,
+    segment_records = 1 << 18,
+    flush_records = 1024,
+    flush_interval_ms = 10000,
+    max_segments = None
+  ):
+    if not 0 < payload_width <= 255: raise Exception("Payload width must be between 1 and 255 bytes")
+    if not max_segments is None and max_segments < 1: raise Exception("A history store needs at least one segment")
+    self.directory = directory
+    self.payload_width = payload_width
+    self.record = recordStruct(payload_width)
+    self.segment_records = segment_records
+    self.flush_records = flush_records
+    self.flush_interval_ms = flush_interval_ms
+    self.max_segments = max_segments
+    self.buffer = bytearray() # Records waiting to be written to the newest segment
+    self.buffered = 0
+    self.buffered_since = None # time.monotonic() when the oldest buffered record was added
+    self.last_time = None # Timestamp of the newest record
+    self.file = None # The newest segment, open for appending
+    self.flushes = 0
+    self.dropped = 0 # Frames `attach` couldn't record because they're longer than `payload_width`
+
+    os.makedirs(directory, exist_ok = True)
+    self.segments = []
+    for name in sorted(os.listdir(directory)):
+      if not name.endswith(SEGMENT_SUFFIX): continue
+      segment = self.openSegment(os.path.join(directory, name), int(name[:16]))
+      if not segment is None: self.segments.append(segment)
+    if self.segments:
+      newest = self.segments[-1]
+      if newest.count:
+        with open(newest.path, "rb") as f:
+          f.seek(newest.recordOffset(newest.count - 1))
+          self.last_time = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))[0]
+
+  # Load an existing segment, cutting off a record that was only partly written when the process stopped
+  def openSegment(self, path, first_time):
+    with open(path, "rb") as f: header = f.read(SEGMENT_HEADER.size)
+    if len(header) < SEGMENT_HEADER.size: return None
+    (magic, version, payload_width, reserved) = SEGMENT_HEADER.unpack(header)
+    if not magic == SEGMENT_MAGIC or not version == SEGMENT_VERSION: return None
+    segment = Segment(path, first_time, payload_width)
+    size = os.path.getsize(path)
+    segment.count = (size - SEGMENT_HEADER.size) // segment.record.size
+    if not segment.recordOffset(segment.count) == size: os.truncate(path, segment.recordOffset(segment.count))
+    return segment
+
+  # Start a new segment for records from `first_time` on
+  def startSegment(self, first_time):
+    if not self.file is None: self.file.close()
+    # Segments can start at the same time when the clock stalls, so they're numbered to keep them apart
+    sequence = sum(1 for segment in self.segments if segment.first_time == first_time)
+    path = os.path.join(self.directory, SEGMENT_NAME.format(first_time, sequence))
+    self.file = open(path, "wb")
+    self.file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, self.payload_width, 0))
+    self.segments.append(Segment(path, first_time, self.payload_width))
+    while not self.max_segments is None and len(self.segments) > self.max_segments:
+      os.remove(self.segments.pop(0).path)
+
+  # Add a record. `timestamp` is in wall clock milliseconds, defaulting to now
+  def append(self, can_id, payload, timestamp = None):
+    if len(payload) > self.payload_width:
+      raise Exception("Payload is longer than the store's payload width of {:d}".format(self.payload_width))
+    timestamp = int(time.time() * 1000) if timestamp is None else int(timestamp)
+    if not self.last_time is None and timestamp < self.last_time: timestamp = self.last_time
+
+    newest = self.segments[-1] if self.segments else None
+    if (
+      newest is None or not newest.record.size == self.record.size
+      or newest.count + self.buffered >= self.segment_records
+    ):
+      self.flush()
+      self.startSegment(timestamp)
+    elif self.file is None: self.file = open(newest.path, "ab")
+
+    self.buffer += self.record.pack(timestamp, can_id, len(payload), bytes(payload))
+    self.buffered += 1
+    self.last_time = timestamp
+    if self.buffered_since is None: self.buffered_since = time.monotonic()
+    if self.buffered >= self.flush_records: self.flush()
+    elif (time.monotonic() - self.buffered_since) * 1000 >= self.flush_interval_ms: self.flush()
+
+  # Write buffered records to disk now. Call it periodically if frames can stop arriving for a while
+  def flush(self):
+    if not self.buffered: return
+    self.file.write(self.buffer)
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.segments[-1].count += self.buffered
+    self.buffer = bytearray()
+    self.buffered = 0
+    self.buffered_since = None
+    self.flushes += 1
+
+  def close(self):
+    self.flush()
+    if not self.file is None: self.file.close()
+    self.file = None
+
+  # For use in `with` statements
+  def __enter__(self): return self
+  def __exit__(self, u1, u2, u3): self.close()
+
+  """
+    Every record with a timestamp from `start` to `end` (inclusive, in wall clock milliseconds; None for no limit), as
+    (timestamp, CAN ID, payload), oldest first. Pass a collection of CAN IDs as `can_ids` to only get those. Includes
+    records that haven't been flushed yet.
+  """
+  def read(self, start = None, end = None, can_ids = None):
+    for (i, segment) in enumerate(self.segments):
+      # Segments are in time order, so this one ends where the next one starts
+      if not end is None and segment.first_time > end: return
+      if not start is None and i + 1 < len(self.segments) and self.segments[i + 1].first_time < start: continue
+      for record in segment.read(start, end, can_ids): yield record
+    for offset in range(0, len(self.buffer), self.record.size):
+      (timestamp, can_id, length, payload) = self.record.unpack_from(self.buffer, offset)
+      if not start is None and timestamp < start: continue
+      if not end is None and timestamp > end: return
+      if can_ids is None or can_id in can_ids: yield (timestamp, can_id, payload[:length])
+
+  """
+    Decode a property's history with the registry's own layout: Yields (timestamp, field values) like `read`, using the
+    property's `decodePayload`. Records that don't decode are skipped.
+  """
+  def query(self, registry, name_or_can_id, start = None, end = None):
+    prop_entry = registry.getPropEntry(name_or_can_id)
+    length = prop_entry.prop.getPayloadLength()
+    for (timestamp, can_id, payload) in self.read(start, end, (prop_entry.can_id,)):
+      try: values = prop_entry.prop.decodePayload(payload if length is None else payload[:length])
+      except Exception: continue
+      if not values is None: yield (timestamp, values)
+
+  """
+    Record every frame `registry` receives from now on. Returns the subscriber, for `registry.unsubscribe(None, ...)`.
+    Multiplexed properties aren't recorded themselves, but the properties they carry are.
+
+    Records hold the property's value serialized again after it's received, not the bytes off the bus, so CAN FD
+    padding is left out. Values longer than `payload_width` (CAN FD properties in a store with the default width of 8)
+    can't be recorded: They're counted in `dropped` and reported through the registry's `warn`.
+  """
+  def attach(self, registry):
+    def onChange(name, status):
+      if not status is REMOTE_DATA: return
+      prop_entry = registry.getPropEntry(name)
+      if isinstance(prop_entry.prop, MultiplexedProperty): return
+      payload = prop_entry.prop.serializeValue()
+      if len(payload) > self.payload_width:
+        self.dropped += 1
+        registry.warn(
+          "history_dropped", "Payload for {} is longer than the history store's payload width of {:d}",
+          name, self.payload_width
+        )
+        return
+      self.append(prop_entry.can_id, payload)
+    registry.subscribe(None, onChange)
+    return onChange
+
+if __name__ == "__main__":
+  import tempfile
+  import traceback
+  from .base import PropertyRegistry, StructProperty
+  from .extendedstruct import ExtendedStructProperty, IntField
+
+  tests = {}
+  failed_tests = set()
+
+  def test(f):
+    tests[f.__name__] = f
+
+  def ambientProperty(): return ExtendedStructProperty(
+    IntField("temperature", 16, base = -200, scale = 0.01, signed = False),
+    IntField("humidity", 8, base = 0, scale = 100.0/255.0, signed = False),
+  )
+
+  @test
+  def StoreRoundTrip():
+    with tempfile.TemporaryDirectory() as d:
+      with HistoryStore(d) as store:
+        for i in range(100): store.append(i % 3, bytes([i]), timestamp = 1000 + i)
+        assert(store.flushes == 0) # Still batched
+        assert(len(list(store.read())) == 100) # Unflushed records are still read
+      with HistoryStore(d) as store:
+        records = list(store.read())
+        assert(records[0] == (1000, 0, b"\x00") and records[-1] == (1099, 0, b"\x63"))
+        assert([r[0] for r in store.read(1050, 1052)] == [1050, 1051, 1052])
+        assert([r[0] for r in store.read(1090, can_ids = (1,))] == [1091, 1094, 1097])
+  @test
+  def StoreSegmentsAndIndex():
+    with tempfile.TemporaryDirectory() as d:
+      with HistoryStore(d, segment_records = 1000, flush_records = 300) as store:
+        for i in range(3500): store.append(0x10, i.to_bytes(2, "little"), timestamp = 10*i)
+        assert(len(store.segments) == 4)
+        assert(store.flushes < 20) # A few fsyncs per segment, not one per record
+        assert([r[0] for r in store.read(12340, 12370)] == [12340, 12350, 12360, 12370])
+        assert(len(list(store.read(0, 34990))) == 3500)
+        assert(list(store.read(40000)) == [])
+      assert(sorted(os.listdir(d))[1] == "{:016d}-0000.seg".format(10000))
+  @test
+  def StoreRecoversFromPartialWrites():
+    with tempfile.TemporaryDirectory() as d:
+      with HistoryStore(d) as store:
+        for i in range(10): store.append(1, b"\x01\x02", timestamp = 100 + i)
+      path = os.path.join(d, os.listdir(d)[0])
+      with open(path, "ab") as f: f.write(b"\x00\x01\x02") # A record cut short by a crash
+      with HistoryStore(d) as store:
+        assert(len(list(store.read())) == 10)
+        store.append(1, b"\x03", timestamp = 50) # Clock went backwards
+      with HistoryStore(d) as store:
+        assert(list(store.read())[-1] == (109, 1, b"\x03"))
+  @test
+  def StoreDropsOldSegments():
+    with tempfile.TemporaryDirectory() as d:
+      with HistoryStore(d, segment_records = 10, flush_records = 10, max_segments = 2) as store:
+        for i in range(45): store.append(0, b"", timestamp = i)
+        assert([r[0] for r in store.read()] == list(range(30, 45)))
+      assert(len(os.listdir(d)) == 2)
+  @test
+  def StoreKeepsSegmentsWithTheSameStart():
+    with tempfile.TemporaryDirectory() as d:
+      with HistoryStore(d, segment_records = 10) as store:
+        for i in range(25): store.append(0, bytes([i]), timestamp = 7)
+      assert(len(os.listdir(d)) == 3)
+      with HistoryStore(d) as store: assert([r[2][0] for r in store.read(7, 7)] == list(range(25)))
+  @test
+  def StoreReadsRunsOfEqualTimestamps():
+    with tempfile.TemporaryDirectory() as d:
+      with HistoryStore(d) as store:
+        # Several index entries with the same timestamp
+        for i in range(3*INDEX_INTERVAL): store.append(0, b"", timestamp = 100)
+        for i in range(INDEX_INTERVAL): store.append(1, b"", timestamp = 101)
+        store.flush()
+        assert(len(list(store.read(100, 100))) == 3*INDEX_INTERVAL)
+        assert(len(list(store.read(101, 101))) == INDEX_INTERVAL)
+    with tempfile.TemporaryDirectory() as d:
+      with HistoryStore(d) as store:
+        # Three records per millisecond, so index entries land in the middle of a millisecond
+        for i in range(3*INDEX_INTERVAL): store.append(0, bytes([i % 3]), timestamp = 100 + i//3)
+        store.flush()
+        for t in range(100, 100 + INDEX_INTERVAL): assert([r[2][0] for r in store.read(t, t)] == [0, 1, 2])
+  @test
+  def StoreRejectsLongPayloads():
+    with tempfile.TemporaryDirectory() as d:
+      with HistoryStore(d, payload_width = 2) as store:
+        try:
+          store.append(0, b"\x00\x01\x02")
+          assert(False)
+        except AssertionError: raise
+        except Exception: pass
+  @test
+  def StoreRecordsAndDecodesRegistryData():
+    pr = PropertyRegistry()
+    pr.addProperty(0x10, "ambient", ambientProperty())
+    pr.addProperty(0x11, "local", StructProperty("<B"))
+    pr.addProperty(0x12, "muxed", StructProperty("<H"))
+    pr.addMultiplexed(0x13, "mux", [["muxed"]])
+    with tempfile.TemporaryDirectory() as d:
+      with HistoryStore(d) as store:
+        subscriber = store.attach(pr)
+        sender = ambientProperty()
+        for temperature in (20, 21, 22):
+          sender.fromDict({ "temperature": temperature, "humidity": 50.0 })
+          pr.receive(0x10, sender.getBytes())
+        pr["local"] = (1,) # Local data isn't recorded
+        pr.receive(0x10, b"") # Neither are corrupt frames
+        pr.receive(0x13, bytes([0, 1, 0x34, 0x12])) # Recorded as "muxed", not "mux"
+        pr.unsubscribe(None, subscriber)
+        pr.receive(0x10, sender.getBytes())
+        assert([can_id for (timestamp, can_id, payload) in store.read()] == [0x10, 0x10, 0x10, 0x12])
+        assert([round(fields["temperature"]) for (timestamp, fields) in store.query(pr, "ambient")] == [20, 21, 22])
+        assert([fields for (timestamp, fields) in store.query(pr, 0x12)] == [{ 0: 0x1234 }])
+        assert(store.dropped == 0)
+  @test
+  def StoreCountsPayloadsTooLongToRecord():
+    pr = PropertyRegistry()
+    pr.addProperty(0x10, "short", StructProperty("<B"))
+    pr.addProperty(0x11, "long", StructProperty("<QQ"))
+    with tempfile.TemporaryDirectory() as d:
+      with HistoryStore(d) as store:
+        store.attach(pr)
+        pr.receive(0x11, bytes(16))
+        pr.receive(0x10, b"\x01")
+        pr.receive(0x11, bytes(16))
+        assert(store.dropped == 2)
+        assert(pr.warnings["history_dropped"][2] == 2 and not "subscriber" in pr.warnings)
+        assert(list(store.read()) == [(store.last_time, 0x10, b"\x01")])
+  @test
+  def StoreAppendIsCheap():
+    with tempfile.TemporaryDirectory() as d:
+      with HistoryStore(d, segment_records = 50000) as store:
+        start = time.monotonic()
+        for i in range(100000): store.append(0x123, b"\x01\x02\x03\x04\x05\x06", timestamp = i)
+        store.flush()
+        elapsed = time.monotonic() - start
+        assert(elapsed < 2.0)
+        start = time.monotonic()
+        assert(len(list(store.read(99000, 99099))) == 100)
+        assert(time.monotonic() - start < 0.05)
+
+  for test in tests.keys():
+    print("Test", test, "----------------")
+    try:
+      tests[test]()
+      print("TEST PASSED")
+    except:
+      failed_tests.add(test)
+      print("TEST FAILED", traceback.format_exc())
+
+  print()
+  print("All tests complete,", len(failed_tests), "failed")
+  for test in failed_tests:
+    print(test, "FAILED")
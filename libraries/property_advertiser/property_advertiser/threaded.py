@@ -0,0 +1,181 @@
+import threading
+import time
+import traceback
+from collections import deque
+from .base import Receiver
+
+"""
+  Wraps a blocking Receiver (like PycanReceiver) in a thread that keeps pulling frames from it, so the bus (or the
+  gateway's serial port) is still drained while the main thread is busy uploading or waiting on something else. Frames
+  wait in a bounded queue until `PropertyRegistry.eventLoop` picks them up; Set the registry's `receive_budget_frames`
+  to take them in batches.
+
+  When the queue is full, new frames are dropped and counted in `dropped`, much like a CAN controller's receive buffer
+  overrunning. Only the main thread should use the registry; The thread only ever touches the wrapped receiver.
+"""
+class ThreadedReceiver(Receiver):
+  received = 0 # Frames put in the queue
+  dropped = 0 # Frames dropped because the queue was full
+  errors = 0 # Exceptions from the wrapped receiver
+  high_water = 0 # The most frames that have been waiting in the queue at once
+
+  def __init__(
+    self,
+    receiver,
+    max_queued = 1024, # Most frames waiting in the queue. Past this, new frames are dropped
+    timeout = 1.0, # Longest `receive` waits for a frame when the queue is empty, in seconds. 0 never waits
+    error_delay = 0.1 # Seconds to wait after the wrapped receiver raises, so a broken port doesn't spin the thread
+  ):
+    self.receiver = receiver
+    self.max_queued = max_queued
+    self.timeout = timeout
+    self.error_delay = error_delay
+    self.queue = deque()
+    self.ready = threading.Event() # Set when a frame has been queued
+    self.running = True
+    self.thread = threading.Thread(target = self.run, name = "ThreadedReceiver", daemon = True)
+    self.thread.start()
+
+  # Stop the thread. It finishes whatever `receive` it's blocked in first, so this waits up to the wrapped timeout
+  def deinit(self):
+    self.running = False
+    if not self.thread is threading.current_thread(): self.thread.join()
+    if hasattr(self.receiver, "deinit"): self.receiver.deinit()
+
+  # For use in `with` statements
+  def __enter__(self): return self
+  def __exit__(self, u1, u2, u3): self.deinit()
+
+  # The receive thread
+  def run(self):
+    queue = self.queue
+    while self.running:
+      try: packet = self.receiver.receive()
+      except Exception as e:
+        self.errors += 1
+        print("WARN: Exception in threaded receiver:", traceback.format_exception(e))
+        time.sleep(self.error_delay)
+        continue
+      if packet is None: continue
+      # Only this thread adds frames, so the queue can't grow past `max_queued` between the check and the append
+      depth = len(queue)
+      if depth >= self.max_queued:
+        self.dropped += 1
+        continue
+      queue.append(packet)
+      self.received += 1
+      if depth >= self.high_water: self.high_water = depth + 1
+      self.ready.set()
+
+  # Frames waiting in the queue
+  def pending(self): return len(self.queue)
+  # Included in `PropertyRegistry.getStats`
+  def getStats(self):
+    return {
+      "pending": len(self.queue),
+      "received": self.received,
+      "dropped": self.dropped,
+      "errors": self.errors,
+      "high_water": self.high_water
+    }
+
+  def receive(self):
+    try: return self.queue.popleft()
+    except IndexError: pass
+    if not self.timeout: return None
+    # Clear before checking again, so a frame queued in between still wakes us up
+    self.ready.clear()
+    if not self.queue: self.ready.wait(self.timeout)
+    try: return self.queue.popleft()
+    except IndexError: return None
+
+if __name__ == "__main__":
+  from .base import PropertyRegistry, StructProperty
+
+  tests = {}
+  failed_tests = set()
+
+  def test(f):
+    tests[f.__name__] = f
+
+  # Hands out `count` frames, each after `delay` seconds, then nothing (after the same delay)
+  class SlowReceiver(Receiver):
+    def __init__(self, count, delay = 0.0):
+      self.count = count
+      self.delay = delay
+      self.calls = 0
+    def receive(self):
+      time.sleep(self.delay)
+      self.calls += 1
+      if self.calls > self.count: return None
+      return (0, bytes([self.calls % 256]))
+  class BrokenReceiver(Receiver):
+    def __init__(self): self.calls = 0
+    def receive(self):
+      self.calls += 1
+      if self.calls == 1: raise ValueError("bad serial data")
+      if self.calls == 2: return (0, b"\x2A")
+      time.sleep(0.01)
+      return None
+
+  def waitUntil(condition, timeout = 2.0):
+    end = time.monotonic() + timeout
+    while not condition():
+      assert(time.monotonic() < end)
+      time.sleep(0.001)
+
+  @test
+  def FramesArriveInOrder():
+    with ThreadedReceiver(SlowReceiver(100), timeout = 0) as rxn:
+      waitUntil(lambda: rxn.received == 100)
+      assert([rxn.receive()[1][0] for _ in range(100)] == list(range(1, 101)))
+      assert(rxn.receive() is None)
+  @test
+  def FullQueueDropsAndCounts():
+    with ThreadedReceiver(SlowReceiver(100), max_queued = 10, timeout = 0) as rxn:
+      waitUntil(lambda: rxn.received + rxn.dropped == 100)
+      assert(rxn.received == 10 and rxn.dropped == 90 and rxn.high_water == 10)
+      assert(PropertyRegistry(receiver = rxn).getStats()["receiver"]["dropped"] == 90)
+      # The oldest frames are kept
+      assert([rxn.receive()[1][0] for _ in range(10)] == list(range(1, 11)))
+  @test
+  def ReceiveWaitsForFrames():
+    with ThreadedReceiver(SlowReceiver(1, delay = 0.05), timeout = 1.0) as rxn:
+      start = time.monotonic()
+      assert(rxn.receive() == (0, b"\x01"))
+      assert(time.monotonic() - start < 0.5)
+  @test
+  def ReceiveTimesOut():
+    with ThreadedReceiver(SlowReceiver(0, delay = 0.01), timeout = 0.05) as rxn:
+      start = time.monotonic()
+      assert(rxn.receive() is None)
+      assert(time.monotonic() - start >= 0.04)
+  @test
+  def ReceiverErrorsAreContained():
+    with ThreadedReceiver(BrokenReceiver(), timeout = 1.0, error_delay = 0.01) as rxn:
+      assert(rxn.receive() == (0, b"\x2A"))
+      assert(rxn.errors == 1)
+  @test
+  def RegistryDrainsInBatches():
+    with ThreadedReceiver(SlowReceiver(50), timeout = 0) as rxn:
+      pr = PropertyRegistry(receiver = rxn, receive_budget_frames = 20)
+      pr.addProperty(0, "test", StructProperty(">B"))
+      waitUntil(lambda: rxn.received == 50)
+      assert(pr.eventLoop() and rxn.pending() == 30)
+      assert(pr.eventLoop() and rxn.pending() == 10)
+      assert(not pr.eventLoop() and rxn.pending() == 0)
+      assert(pr["test"] == (50,))
+
+  for test in tests.keys():
+    print("Test", test, "----------------")
+    try:
+      tests[test]()
+      print("TEST PASSED")
+    except:
+      failed_tests.add(test)
+      print("TEST FAILED", traceback.format_exc())
+
+  print()
+  print("All tests complete,", len(failed_tests), "failed")
+  for test in failed_tests:
+    print(test, "FAILED")
@@ -0,0 +1,293 @@
+import mmap
+import os
+import struct
+import time
+from .base import Receiver, CAN_ID_COUNT, EXTENDED_ID_FLAG, EXTENDED_ID_MASK
+
+"""
+  Record raw frames from a bus to a trace file, and play them back later: Into a PropertyRegistry (through
+  TraceReceiver, like any other receiver) or out through a transmitter (with `replayTrace`), at the speed they were
+  recorded, N times faster, or as fast as possible. Field captures then make for repeatable load tests, and decoder or
+  expiry changes can be benchmarked against real traffic with no hardware attached.
+
+  The file is a header (TRACE_HEADER: magic, format version, and wall clock time when recording started) followed by a
+  record per frame (TRACE_RECORD: microseconds since the previous frame, CAN ID, payload length), each followed by the
+  frame's payload. A classic CAN frame takes 17 bytes. Gaps longer than about 71 minutes are shortened to that. CAN IDs
+  are 32 bits, with EXTENDED_ID_FLAG set for extended IDs, and frames come back from `readTrace` with it still set.
+  Version 1 traces (16-bit IDs, so standard IDs only) can still be read.
+"""
+TRACE_MAGIC = b"PATR"
+TRACE_VERSION = 2
+TRACE_HEADER = struct.Struct("<4sBxxxd")
+TRACE_RECORD = struct.Struct("<IIB")
+TRACE_RECORDS = { 1: struct.Struct("<IHB"), TRACE_VERSION: TRACE_RECORD } # Record layout for each readable version
+MAX_GAP_US = 0xFFFFFFFF
+
+def monotonicUs(): return time.monotonic_ns() // 1000
+
+"""
+  Writes frames to a trace file. Either call `record` for each frame, or pass a Receiver (such as a PycanReceiver on a
+  serial_can2.SerialBus) and use this in its place: Every frame it receives is recorded on the way through.
+
+  Frames are buffered, so call `flush` now and then (and `deinit` when done) to get them onto disk. IDs wider than 11
+  bits are recorded as extended even without EXTENDED_ID_FLAG, since a standard ID can't be. IDs that don't fit in 29
+  bits aren't CAN IDs at all: They're counted in `skipped` rather than recorded.
+"""
+class TraceRecorder(Receiver):
+  def __init__(self, path, receiver = None, now = None):
+    self.receiver = receiver
+    self.file = open(path, "wb", buffering = 1 << 16)
+    self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, time.time() if now is None else now))
+    self.last_us = None # When the previous frame was recorded, in microseconds
+    self.frames = 0
+    self.skipped = 0
+
+  # Record a frame. `timestamp_us` is monotonic microseconds (defaulting to now); Only the gaps between them are kept
+  def record(self, can_id, msg, timestamp_us = None):
+    if can_id >= CAN_ID_COUNT: can_id |= EXTENDED_ID_FLAG
+    if can_id & ~(EXTENDED_ID_FLAG | EXTENDED_ID_MASK):
+      self.skipped += 1
+      return
+    if timestamp_us is None: timestamp_us = monotonicUs()
+    gap = 0 if self.last_us is None else min(MAX_GAP_US, max(0, timestamp_us - self.last_us))
+    self.last_us = timestamp_us
+    self.file.write(TRACE_RECORD.pack(gap, can_id, len(msg)))
+    self.file.write(msg)
+    self.frames += 1
+
+  def receive(self):
+    packet = self.receiver.receive()
+    if not packet is None: self.record(packet[0], packet[1])
+    return packet
+
+  # Write buffered frames, and make sure they're on disk
+  def flush(self):
+    self.file.flush()
+    os.fsync(self.file.fileno())
+  def deinit(self):
+    self.file.close()
+    if hasattr(self.receiver, "deinit"): self.receiver.deinit()
+
+  # For use in `with` statements
+  def __enter__(self): return self
+  def __exit__(self, u1, u2, u3): self.deinit()
+
+"""
+  Read a trace file into (wall clock time recording started, [(microseconds since the first frame, CAN ID, payload)]).
+  The file is memory mapped rather than read. A frame cut short at the end (the recorder stopped partway through
+  writing it) is left out. Raises ValueError if it isn't a trace file.
+"""
+def readTrace(path):
+  with open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size < TRACE_HEADER.size: raise ValueError("Trace is too short")
+    with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+      (magic, version, started) = TRACE_HEADER.unpack_from(data, 0)
+      record = TRACE_RECORDS.get(version)
+      if not magic == TRACE_MAGIC or record is None: raise ValueError("Not a trace this can read")
+      frames = []
+      offset = TRACE_HEADER.size
+      size = len(data)
+      elapsed = 0
+      unpack = record.unpack_from
+      while offset + record.size <= size:
+        (gap, can_id, length) = unpack(data, offset)
+        offset += record.size
+        if offset + length > size: break
+        elapsed += gap
+        frames.append((elapsed, can_id, data[offset:offset + length]))
+        offset += length
+  return (started, frames)
+
+"""
+  Hands out the frames of a trace (as returned by `readTrace`) like a bus would: Each frame once it's due, `speed` times
+  faster than recorded (so 1 is real time, 10 is ten times faster). With a speed of None, frames come back to back,
+  as fast as the registry can take them; Set `receive_budget_frames` on the registry so expiry still gets a turn.
+
+  Like PycanReceiver, `receive` waits up to `timeout` seconds for the next frame. It returns None once the trace is
+  finished; Check `finished()`. Timing starts from the first `receive`. Note that the registry still expires data by
+  the real clock, so replaying faster than real time makes data expire later (in trace time) than it would have.
+"""
+class TraceReceiver(Receiver):
+  def __init__(self, frames, speed = 1.0, timeout = 1.0):
+    if not speed is None and speed <= 0: raise Exception("Replay speed must be positive, or None for as fast as possible")
+    self.frames = frames
+    self.speed = speed
+    self.timeout = timeout
+    self.next = 0 # Index of the next frame to hand out
+    self.start_us = None # When the first frame was handed out
+
+  def finished(self): return self.next >= len(self.frames)
+
+  # How long until the next frame is due, in seconds
+  def nextDue(self):
+    if self.speed is None or self.start_us is None: return 0
+    (elapsed, can_id, msg) = self.frames[self.next]
+    due_us = self.start_us + (elapsed - self.frames[0][0]) / self.speed
+    return max(0, (due_us - monotonicUs()) / 1000000)
+
+  def receive(self):
+    if self.finished(): return None
+    wait = self.nextDue()
+    if wait > self.timeout:
+      time.sleep(self.timeout)
+      return None
+    if wait: time.sleep(wait)
+    if self.start_us is None: self.start_us = monotonicUs()
+    (elapsed, can_id, msg) = self.frames[self.next]
+    self.next += 1
+    return (can_id, msg)
+
+"""
+  Play a trace's frames (as returned by `readTrace`) into `handler(can_id, msg)`: A transmitter's `send` to put them
+  back on a bus, or a registry's `receive` to decode them without an event loop. Paced like TraceReceiver; Speed None
+  doesn't wait at all. Returns the number of frames played.
+"""
+def replayTrace(frames, handler, speed = None):
+  receiver = TraceReceiver(frames, speed, timeout = float("inf"))
+  count = 0
+  while True:
+    packet = receiver.receive()
+    if packet is None: return count
+    handler(packet[0], packet[1])
+    count += 1
+
+if __name__ == "__main__":
+  import tempfile
+  import traceback
+  from .base import PropertyRegistry, StructProperty
+
+  tests = {}
+  failed_tests = set()
+
+  def test(f):
+    tests[f.__name__] = f
+
+  class ListReceiver(Receiver):
+    def __init__(self, frames): self.frames = list(frames)
+    def receive(self): return self.frames.pop(0) if self.frames else None
+
+  # Write `frames` of (monotonic microseconds, CAN ID, payload) to a trace file in `d`, and return its path
+  def writeTrace(d, frames, now = None):
+    path = os.path.join(d, "test.trace")
+    with TraceRecorder(path, now = now) as recorder:
+      for (timestamp, can_id, msg) in frames: recorder.record(can_id, msg, timestamp)
+    return path
+
+  @test
+  def TraceRoundTrip():
+    with tempfile.TemporaryDirectory() as d:
+      path = writeTrace(d, ((5000, 0x10, b"\x01\x02"), (5250, 0x7FF, b""), (9000, 0x11, bytes(64))), now = 1234.5)
+      assert(os.path.getsize(path) == TRACE_HEADER.size + 3*TRACE_RECORD.size + 66)
+      (started, frames) = readTrace(path)
+    assert(started == 1234.5)
+    assert(frames == [(0, 0x10, b"\x01\x02"), (250, 0x7FF, b""), (4000, 0x11, bytes(64))])
+  @test
+  def TraceRecordsReceivedFrames():
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, "test.trace")
+      with TraceRecorder(path, ListReceiver([(1, b"\x01"), (2, b"\x02")])) as recorder:
+        assert(recorder.receive() == (1, b"\x01"))
+        assert(recorder.receive() == (2, b"\x02"))
+        assert(recorder.receive() is None)
+        assert(recorder.frames == 2)
+      assert([(can_id, msg) for (elapsed, can_id, msg) in readTrace(path)[1]] == [(1, b"\x01"), (2, b"\x02")])
+  @test
+  def TraceKeepsExtendedIds():
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, "test.trace")
+      received = [(0x1ABCDEF, b"\x01"), (0x10 | EXTENDED_ID_FLAG, b"\x02"), (0x10, b"\x03"), (1 << 29, b"\x04")]
+      with TraceRecorder(path, ListReceiver(received)) as recorder:
+        for _ in received: recorder.receive()
+        assert(recorder.frames == 3 and recorder.skipped == 1)
+      (started, frames) = readTrace(path)
+    # Extended 0x10 stays apart from standard 0x10
+    sent = []
+    assert(replayTrace(frames, lambda can_id, msg: sent.append((can_id, msg))) == 3)
+    assert(sent == [(0x1ABCDEF | EXTENDED_ID_FLAG, b"\x01"), (0x10 | EXTENDED_ID_FLAG, b"\x02"), (0x10, b"\x03")])
+    pr = PropertyRegistry(receiver = TraceReceiver(frames, speed = None))
+    pr.addProperty(0x10, "p", StructProperty("<B"))
+    while not pr.receiver.finished(): pr.eventLoop()
+    assert(pr["p"] == (3,))
+    assert(pr.getStats()["unknown_ids"] == { 0x1ABCDEF | EXTENDED_ID_FLAG: 1, 0x10 | EXTENDED_ID_FLAG: 1 })
+  @test
+  def TraceReadsVersion1():
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, "test.trace")
+      with open(path, "wb") as f:
+        f.write(TRACE_HEADER.pack(TRACE_MAGIC, 1, 12.0))
+        f.write(TRACE_RECORDS[1].pack(0, 0x123, 1) + b"\x01" + TRACE_RECORDS[1].pack(50, 0x7FF, 0))
+      assert(readTrace(path) == (12.0, [(0, 0x123, b"\x01"), (50, 0x7FF, b"")]))
+  @test
+  def TraceToleratesTruncation():
+    with tempfile.TemporaryDirectory() as d:
+      path = writeTrace(d, ((0, 1, b"\x01\x02\x03"), (10, 2, b"\x04\x05\x06")))
+      with open(path, "r+b") as f: f.truncate(os.path.getsize(path) - 1) # Last frame cut short
+      assert(len(readTrace(path)[1]) == 1)
+      with open(path, "wb") as f: f.write(b"garbage, not a trace")
+      try:
+        readTrace(path)
+        assert(False)
+      except ValueError: pass
+  @test
+  def TraceClampsGaps():
+    with tempfile.TemporaryDirectory() as d:
+      path = writeTrace(d, ((10**12, 1, b""), (0, 2, b""), (2*10**12, 3, b""))) # Clock went backwards, then a long gap
+      assert([elapsed for (elapsed, can_id, msg) in readTrace(path)[1]] == [0, 0, MAX_GAP_US])
+  @test
+  def TraceReplaysAtSpeed():
+    frames = [(i*20000, i, bytes([i])) for i in range(11)] # 200ms of frames
+    sent = []
+    start = time.monotonic()
+    assert(replayTrace(frames, lambda can_id, msg: sent.append((time.monotonic(), can_id)), speed = 4.0) == 11)
+    elapsed = time.monotonic() - start
+    assert(0.045 <= elapsed < 0.2)
+    assert([can_id for (t, can_id) in sent] == list(range(11)))
+    # Timing is kept between frames, not just overall
+    assert(sent[5][0] - sent[0][0] >= 0.024)
+    start = time.monotonic()
+    assert(replayTrace(frames, lambda can_id, msg: None) == 11)
+    assert(time.monotonic() - start < 0.02)
+  @test
+  def TraceReceiverWaitsForFrames():
+    receiver = TraceReceiver([(0, 1, b""), (300000, 2, b"")], speed = 1.0, timeout = 0.05)
+    assert(receiver.receive() == (1, b""))
+    assert(receiver.receive() is None) # Not due for another 300ms
+    receiver.speed = 10.0
+    start = time.monotonic()
+    assert(receiver.receive() == (2, b""))
+    assert(time.monotonic() - start < 0.05)
+    assert(receiver.finished() and receiver.receive() is None)
+  @test
+  def TraceFeedsRegistry():
+    with tempfile.TemporaryDirectory() as d:
+      path = writeTrace(d, [(i*1000, i % 4, struct.pack("<H", i)) for i in range(1000)])
+      (started, frames) = readTrace(path)
+    pr = PropertyRegistry(receiver = TraceReceiver(frames, speed = None), receive_budget_frames = 100)
+    for can_id in range(4): pr.addProperty(can_id, "p" + str(can_id), StructProperty("<H"))
+    loops = 0
+    while pr.eventLoop(): loops += 1
+    assert(loops == 10 and pr.receiver.finished())
+    assert([pr["p" + str(can_id)] for can_id in range(4)] == [(996,), (997,), (998,), (999,)])
+  @test
+  def TraceReadsQuickly():
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, "test.trace")
+      with TraceRecorder(path) as recorder:
+        for i in range(100000): recorder.record(i % 64, b"\x01\x02\x03\x04\x05", i*100)
+      start = time.monotonic()
+      assert(len(readTrace(path)[1]) == 100000)
+      assert(time.monotonic() - start < 0.5)
+
+  for test in tests.keys():
+    print("Test", test, "----------------")
+    try:
+      tests[test]()
+      print("TEST PASSED")
+    except:
+      failed_tests.add(test)
+      print("TEST FAILED", traceback.format_exc())
+
+  print()
+  print("All tests complete,", len(failed_tests), "failed")
+  for test in failed_tests:
+    print(test, "FAILED")